@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#%%
+import torch
+from torch.nn import functional as F
+import argparse, time
+from torchvision import transforms
+
+from unsuper.trainer import vae_trainer
+from unsuper.ensemble_trainer import ensemble_trainer
+from unsuper.data.mnist_data_loader import mnist_data_loader
+from unsuper.helper.encoder_decoder import get_encoder, get_decoder
+from unsuper.helper.losses import vae_loss
+from unsuper.models import get_model
+from unsuper.helper.spatial_transformer import get_transformer
+
+#%%
+def argparser():
+    """ Argument parser for the benchmark script """
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--name', type=str, default='precision', help='benchmark to run')
+    parser.add_argument('--models', type=str, nargs='+', default=['vae', 'vitae_ci', 'vitae_ui'], help='models to benchmark')
+    parser.add_argument('--ed_type', type=str, default='mlp', help='encoder/decoder type')
+    parser.add_argument('--stn_type', type=str, default='affinediff', help='transformation type to use')
+    parser.add_argument('--latent_dim', type=int, default=2, help='dimensionality of the latent space')
+    parser.add_argument('--density', type=str, default='bernoulli', help='output density')
+    parser.add_argument('--n_epochs', type=int, default=5, help='number of training epochs')
+    parser.add_argument('--batch_size', type=int, default=256, help='size of the batches')
+    parser.add_argument('--iw_samples', type=int, default=16, help='number of importance weighted samples (for the estimator benchmark)')
+    parser.add_argument('--n_members', type=int, default=5, help='number of members (for the ensemble benchmark)')
+    parser.add_argument('--n_steps', type=int, default=20, help='number of timed steps (for step benchmarks)')
+    parser.add_argument('--num_points', type=int, default=1000, help='number of points in each class')
+    parser.add_argument('--lr', type=float, default=1e-3, help='learning rate for adam optimizer')
+    args = parser.parse_args()
+    return args
+
+#%%
+def build_trainer(args, model_name, img_size, seed=0, model_kwargs={}, **kwargs):
+    """ Model, optimizer and trainer, all constructed with the same seed """
+    torch.manual_seed(seed)
+    model = get_model(model_name)(input_shape = img_size,
+                                  latent_dim = args.latent_dim, 
+                                  encoder = get_encoder(args.ed_type), 
+                                  decoder = get_decoder(args.ed_type), 
+                                  outputdensity = args.density,
+                                  ST_type = args.stn_type,
+                                  **model_kwargs)
+    optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
+    return vae_trainer(img_size, model, optimizer, **kwargs)
+
+#%%
+def train_epochs(trainer, loader, n_epochs, n_warmup=0, iw_samples=1):
+    """ Trains with train_step and returns the throughput in samples/sec. The
+        first n_warmup steps (e.g. compilation) are not included in the timing """
+    trainer.model.train()
+    step, n_samples, start = 0, 0, time.time()
+    for epoch in range(1, n_epochs+1):
+        for data, _ in loader:
+            data = data.reshape(-1, *trainer.input_shape).to(torch.float32).to(trainer.device)
+            trainer.train_step(data, iw_samples=iw_samples, epoch=epoch, warmup=n_epochs)
+            step += 1
+            if step == n_warmup:
+                n_samples, start = 0, time.time()
+            elif step > n_warmup:
+                n_samples += data.shape[0]
+    return n_samples / (time.time() - start)
+
+#%%
+def test_elbo(trainer, loader):
+    """ Average test ELBO with a fixed seed """
+    trainer.model.eval()
+    torch.manual_seed(0)
+    elbo, n = 0.0, 0
+    with torch.no_grad():
+        for data, _ in loader:
+            data = data.reshape(-1, *trainer.input_shape).to(torch.float32).to(trainer.device)
+            out = trainer.model(data, 1, 1)
+            elbo += vae_loss(data, *out, 1, 1, trainer.model.latent_dim, None, None,
+                             1.0, trainer.outputdensity)[0].item()
+            n += 1
+    return elbo / n
+
+#%%
+def precision_benchmark(args, trainloader, testloader, img_size):
+    """ Throughput and final test ELBO of bf16 autocast versus fp32 """
+    print('{0:10s} {1:6s} {2:>12s} {3:>12s}'.format('model', 'mode', 'samples/sec', 'test ELBO'))
+    for model_name in args.models:
+        for mode in ['fp32', 'bf16']:
+            trainer = build_trainer(args, model_name, img_size, precision=mode)
+            throughput = train_epochs(trainer, trainloader, args.n_epochs)
+            elbo = test_elbo(trainer, testloader)
+            print('{0:10s} {1:6s} {2:12.1f} {3:12.3f}'.format(model_name, mode, throughput, elbo))
+
+#%%
+def compile_benchmark(args, trainloader, testloader, img_size):
+    """ Throughput of the torch.compile training step versus eager mode """
+    print('{0:10s} {1:>14s} {2:>14s} {3:>8s}'.format('model', 'eager', 'compiled', 'speedup'))
+    for model_name in args.models:
+        res = [ ]
+        for mode in [None, 'default']:
+            trainer = build_trainer(args, model_name, img_size, compile_mode=mode)
+            res.append(train_epochs(trainer, trainloader, args.n_epochs, n_warmup=5))
+        print('{0:10s} {1:14.1f} {2:14.1f} {3:8.2f}'.format(model_name, res[0], res[1], res[1]/res[0]))
+
+#%%
+def step_memory(trainer, data):
+    """ Bytes of activations saved for the backward pass during a training
+        step (tensors that are recomputed by checkpointing are not saved), and
+        the peak allocated bytes when running on the gpu """
+    saved = { }
+    def pack(t):
+        saved[(t.data_ptr(), t.shape)] = t.numel() * t.element_size()
+        return t
+    if trainer.device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats(trainer.device)
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        trainer.train_step(data)
+    peak = torch.cuda.max_memory_allocated(trainer.device) if trainer.device.type == 'cuda' else float('nan')
+    return sum(saved.values()), peak
+
+#%%
+def checkpoint_benchmark(args, trainloader, testloader, img_size):
+    """ Saved activation memory, peak memory and time of a training step 
+        with different stages checkpointed """
+    stages = [None, ['stn'], ['encoder', 'decoder', 'stn']]
+    print('{0:10s} {1:24s} {2:>12s} {3:>12s} {4:>12s}'.format(
+            'model', 'checkpoint', 'saved MB', 'peak MB', 'ms/step'))
+    data = next(iter(trainloader))[0].reshape(-1, *img_size).to(torch.float32)
+    for model_name in args.models:
+        for checkpoint in stages:
+            if model_name == 'vae' and checkpoint is not None and 'stn' in checkpoint:
+                checkpoint = [c for c in checkpoint if c != 'stn'] or None
+                if checkpoint is None: continue
+            trainer = build_trainer(args, model_name, img_size, 
+                                    model_kwargs={'checkpoint': checkpoint})
+            trainer.model.train()
+            x = data.to(trainer.device)
+            saved, peak = step_memory(trainer, x)
+            start = time.time()
+            for _ in range(args.n_steps):
+                trainer.train_step(x)
+            if trainer.device.type == 'cuda': torch.cuda.synchronize()
+            ms = 1000 * (time.time() - start) / args.n_steps
+            print('{0:10s} {1:24s} {2:12.1f} {3:12.1f} {4:12.2f}'.format(
+                    model_name, str(checkpoint), saved / 2**20, peak / 2**20, ms))
+
+#%%
+def gradient_snr(trainer, data, iw_samples, n_repeats=20):
+    """ Signal-to-noise ratio (|mean| / std over repeated noise draws) of the
+        encoder gradients on a fixed batch, averaged over all encoder weights """
+    params = [p for n, p in trainer.model.named_parameters() if n.startswith('encoder')]
+    grads = [ ]
+    for _ in range(n_repeats):
+        trainer.model.zero_grad()
+        loss = trainer.forward_loss(data, 1, iw_samples, 1.0, 1.0)[0]
+        (-loss).backward()
+        grads.append(torch.cat([p.grad.flatten() for p in params if p.grad is not None]))
+    grads = torch.stack(grads)
+    snr = grads.mean(dim=0).abs() / (grads.std(dim=0) + 1e-12)
+    trainer.model.zero_grad()
+    return snr.mean().item()
+
+#%%
+def estimator_benchmark(args, trainloader, testloader, img_size):
+    """ Encoder gradient SNR and final test ELBO of the iwae, stl and dreg
+        gradient estimators """
+    print('{0:10s} {1:6s} {2:>10s} {3:>12s}'.format('model', 'est.', 'enc. SNR', 'test ELBO'))
+    data = next(iter(trainloader))[0].reshape(-1, *img_size).to(torch.float32)
+    for model_name in args.models:
+        for estimator in ['iwae', 'stl', 'dreg']:
+            trainer = build_trainer(args, model_name, img_size, estimator=estimator)
+            trainer.model.train()
+            snr = gradient_snr(trainer, data.to(trainer.device), args.iw_samples)
+            train_epochs(trainer, trainloader, args.n_epochs, iw_samples=args.iw_samples)
+            elbo = test_elbo(trainer, testloader)
+            print('{0:10s} {1:6s} {2:10.4f} {3:12.3f}'.format(model_name, estimator, snr, elbo))
+
+#%%
+def ensemble_benchmark(args, trainloader, testloader, img_size):
+    """ Throughput of training one model per learning rate sequentially versus
+        as a vectorized ensemble in one process """
+    lrs = [10**(-i) for i in range(args.n_members)]
+    print('{0:10s} {1:>8s} {2:>14s} {3:>14s} {4:>8s}'.format(
+            'model', 'members', 'sequential', 'ensemble', 'speedup'))
+    for model_name in args.models:
+        start = time.time()
+        for lr in lrs:
+            args.lr = lr
+            trainer = build_trainer(args, model_name, img_size)
+            train_epochs(trainer, trainloader, args.n_epochs)
+        sequential = len(lrs) * args.n_epochs * len(trainloader.dataset) / (time.time() - start)
+        
+        models = [build_trainer(args, model_name, img_size, seed=i).model for i in range(len(lrs))]
+        trainer = ensemble_trainer(img_size, models, lrs)
+        start = time.time()
+        for epoch in range(1, args.n_epochs+1):
+            for data, _ in trainloader:
+                data = data.reshape(-1, *img_size).to(torch.float32).to(trainer.device)
+                trainer.train_step(data, epoch=epoch, warmup=args.n_epochs)
+        ensemble = len(lrs) * args.n_epochs * len(trainloader.dataset) / (time.time() - start)
+        print('{0:10s} {1:8d} {2:14.1f} {3:14.1f} {4:8.2f}'.format(
+                model_name, len(lrs), sequential, ensemble, ensemble / sequential))
+
+#%%
+def affine_grid_benchmark(args, trainloader, testloader, img_size):
+    """ Forward + backward time of the cached-grid affine warp versus 
+        F.affine_grid + F.grid_sample for different batch sizes """
+    stn = get_transformer('affine')(img_size)
+    def reference(x, theta):
+        grid = F.affine_grid(theta, torch.Size([x.shape[0], *img_size]), align_corners=False)
+        return F.grid_sample(x, grid, align_corners=False)
+    
+    print('{0:>8s} {1:>14s} {2:>14s} {3:>8s} {4:>10s}'.format(
+            'batch', 'affine_grid ms', 'cached ms', 'speedup', 'max diff'))
+    for batch_size in [1, 16, 64, 256, 1024, 4096]:
+        x = torch.rand(batch_size, *img_size)
+        theta = (torch.eye(2, 3)[None] + 0.1*torch.randn(batch_size, 2, 3)).requires_grad_()
+        times = [ ]
+        for fn in [reference, stn.warp]:
+            for i in range(args.n_steps + 5):
+                if i == 5: start = time.time()
+                fn(x, theta).sum().backward()
+            times.append(1000 * (time.time() - start) / args.n_steps)
+        with torch.no_grad():
+            diff = (reference(x, theta) - stn.warp(x, theta)).abs().max().item()
+        print('{0:8d} {1:14.3f} {2:14.3f} {3:8.2f} {4:10.2e}'.format(
+                batch_size, times[0], times[1], times[0] / times[1], diff))
+
+#%%
+def get_benchmark(name):
+    benchmarks = {'precision': precision_benchmark,
+                  'compile': compile_benchmark,
+                  'checkpoint': checkpoint_benchmark,
+                  'estimator': estimator_benchmark,
+                  'ensemble': ensemble_benchmark,
+                  'affine_grid': affine_grid_benchmark,
+                  }
+    assert (name in benchmarks), 'Benchmark not found, choose between: ' \
+            + ', '.join([k for k in benchmarks.keys()])
+    return benchmarks[name]
+
+#%%
+if __name__ == '__main__':
+    args = argparser()
+    benchmark = get_benchmark(args.name)
+    
+    trainloader, testloader = mnist_data_loader(root='unsuper/data', 
+                                                transform=transforms.ToTensor(),
+                                                download=True,
+                                                num_points=args.num_points,
+                                                batch_size=args.batch_size)
+    img_size = (1, 28, 28)
+    benchmark(args, trainloader, testloader, img_size)
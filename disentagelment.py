@@ -9,7 +9,6 @@ Created on Mon Jan 14 06:53:55 2019
 import torch
 import argparse, datetime
 from torchvision import transforms
-import numpy as np
 
 from unsuper.trainer import vae_trainer
 from unsuper.data.mnist_data_loader import mnist_data_loader
@@ -17,6 +16,8 @@ from unsuper.data.perception_data_loader import perception_data_loader
 from unsuper.helper.utility import model_summary
 from unsuper.helper.encoder_decoder import get_encoder, get_decoder
 from unsuper.models import get_model
+from unsuper.helper.latents import extract_reconstructions
+from unsuper.helper.knn import knn_accuracy
 
 #%%
 def argparser():
@@ -50,6 +51,7 @@ def argparser():
     ds.add_argument('--num_points', type=int, default=10000, help='number of points in each class')
     ds.add_argument('--logdir', type=str, default='res', help='where to store results')
     ds.add_argument('--dataset', type=str, default='mnist', help='dataset to use')
+    ds.add_argument('--cache_dir', type=str, default='', help='where preprocessed datasets are cached (e.g. unsuper/data/cache), empty string to disable')
     
     # Parse and return
     args = parser.parse_args()
@@ -78,7 +80,8 @@ if __name__ == '__main__':
                                                     download=True,
                                                     classes=args.classes,
                                                     num_points=args.num_points,
-                                                    batch_size=args.batch_size)
+                                                    batch_size=args.batch_size,
+                                                    cache_dir=args.cache_dir or None)
         img_size = (1, 28, 28)
     elif args.dataset == 'perception':
         trainloader, testloader = perception_data_loader(root='unsuper/data', 
@@ -86,7 +89,8 @@ if __name__ == '__main__':
                                                          download=True,
                                                          classes=args.classes,
                                                          num_points=args.num_points,
-                                                         batch_size=args.batch_size)
+                                                         batch_size=args.batch_size,
+                                                         cache_dir=args.cache_dir or None)
         testloader=None
         img_size = (1, 428, 214)
 
@@ -121,40 +125,11 @@ if __name__ == '__main__':
     
     #%%
     if args.dataset == 'mnist':
-        Xtrain = np.zeros((60000, 784))
-        Ytrain = np.zeros((60000,))
-        Xtest = np.zeros((10000, 784))
-        Ytest = np.zeros((10000, ))
-        
-        counter = 0
-        for i, (data, labels) in enumerate(trainloader):
-            # Feed forward data
-            data = data.reshape(-1, *Trainer.input_shape).to(torch.float32).to(Trainer.device)
-            out = Trainer.model.semantics(data, 1, 1, 1.0)
-            
-            n = data.shape[0]
-            Xtrain[counter:counter+n] = out[0].detach().cpu().numpy().reshape(n, -1)
-            Ytrain[counter:counter+n] = labels.numpy()
-            counter += n
-            
-        counter = 0
-        for i, (data, labels) in enumerate(testloader):
-            # Feed forward data
-            data = data.reshape(-1, *Trainer.input_shape).to(torch.float32).to(Trainer.device)
-            out = Trainer.model.semantics(data, 1, 1, 1.0)
-            
-            n = data.shape[0]
-            Xtest[counter:counter+n] = out[0].detach().cpu().numpy().reshape(n, -1)
-            Ytest[counter:counter+n] = labels.numpy()
-            counter += n
-        
+        Xtrain, Ytrain = extract_reconstructions(Trainer.model, trainloader, Trainer.input_shape)
+        Xtest, Ytest = extract_reconstructions(Trainer.model, testloader, Trainer.input_shape)
     else:
         raise ValueError('Wrong dataset')
         
     #%%
-    from sklearn.neighbors.classification import KNeighborsClassifier
-    classifier = KNeighborsClassifier()
-    classifier.fit(Xtrain, Ytrain)
-    Ypred = classifier.predict(Xtest)
-    print(np.mean(Ypred == Ytest))
+    print(knn_accuracy(Xtrain, Ytrain, Xtest, Ytest, k=5))
     
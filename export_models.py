@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#%%
+import torch
+import argparse, os
+
+from unsuper.helper.encoder_decoder import get_encoder, get_decoder
+from unsuper.helper.export import (export_model, load_exported, example_inputs,
+                                   check_parity, benchmark_latency,
+                                   encoder_graph, decoder_graph, reconstruction_graph)
+from unsuper.models import get_model
+
+#%%
+def argparser():
+    """ Argument parser for the export script """
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--models', type=str, nargs='+', default=['vae', 'vitae_ci', 'vitae_ui'], help='models to export')
+    parser.add_argument('--stn_types', type=str, nargs='+', default=['affine', 'affinediff', 'affinedecomp'], help='transformation types to export')
+    parser.add_argument('--formats', type=str, nargs='+', default=['torchscript', 'onnx'], help='export formats')
+    parser.add_argument('--model_path', type=str, default='', help='trained state dict to load (only with a single model/stn_type)')
+    parser.add_argument('--ed_type', type=str, default='mlp', help='encoder/decoder type')
+    parser.add_argument('--latent_dim', type=int, default=2, help='dimensionality of the latent space')
+    parser.add_argument('--density', type=str, default='bernoulli', help='output density')
+    parser.add_argument('--batch_size', type=int, default=64, help='batch size for parity and latency checks')
+    parser.add_argument('--tol', type=float, default=1e-4, help='maximal absolute difference allowed')
+    parser.add_argument('--folder', type=str, default='res/export', help='where to store the exported graphs')
+    args = parser.parse_args()
+    return args
+
+#%%
+if __name__ == '__main__':
+    args = argparser()
+    img_size = (1, 28, 28)
+    
+    failed = [ ]
+    for model_name in args.models:
+        # The vae does not use a transformer, so only export it once
+        stn_types = args.stn_types[:1] if model_name == 'vae' else args.stn_types
+        for stn_type in stn_types:
+            model = get_model(model_name)(input_shape = img_size,
+                                          latent_dim = args.latent_dim, 
+                                          encoder = get_encoder(args.ed_type), 
+                                          decoder = get_decoder(args.ed_type), 
+                                          outputdensity = args.density,
+                                          ST_type = stn_type)
+            if args.model_path:
+                model.load_state_dict(torch.load(args.model_path, map_location='cpu'))
+            model.eval()
+            
+            graphs = {'encoder': encoder_graph(model),
+                      'decoder': decoder_graph(model),
+                      'reconstruction': reconstruction_graph(model)}
+            inputs = example_inputs(model, img_size, args.batch_size)
+            for fmt in args.formats:
+                folder = os.path.join(args.folder, model_name, stn_type, fmt)
+                try:
+                    paths = export_model(model, img_size, folder, fmt=fmt)
+                except Exception as e:
+                    print('{0:10s} {1:14s} {2:12s} export failed: {3}'.format(
+                            model_name, stn_type, fmt, e))
+                    failed.append((model_name, stn_type, fmt))
+                    continue
+                
+                for name, path in paths.items():
+                    exported = load_exported(path)
+                    diff = check_parity(graphs[name], exported, inputs[name])
+                    t_eager = benchmark_latency(graphs[name], inputs[name])
+                    t_export = benchmark_latency(exported, inputs[name])
+                    print('{0:10s} {1:14s} {2:12s} {3:15s} max diff {4:.2e}  eager {5:.3f} ms  exported {6:.3f} ms'.format(
+                            model_name, stn_type, fmt, name, diff, 1000*t_eager, 1000*t_export))
+                    if diff > args.tol:
+                        failed.append((model_name, stn_type, fmt, name))
+    
+    if failed:
+        print('Failed:', failed)
+        raise SystemExit(1)
@@ -17,6 +17,8 @@ from unsuper.data.perception_data_loader import perception_data_loader
 from unsuper.helper.utility import model_summary
 from unsuper.helper.encoder_decoder import get_encoder, get_decoder
 from unsuper.models import get_model
+from unsuper.helper.latents import extract_latents
+from unsuper.data.synthetic_data import generate_dataset
 
 #%%
 def argparser():
@@ -50,6 +52,7 @@ def argparser():
     ds.add_argument('--num_points', type=int, default=10000, help='number of points in each class')
     ds.add_argument('--logdir', type=str, default='idb_test', help='where to store results')
     ds.add_argument('--dataset', type=str, default='mnist', help='dataset to use')
+    ds.add_argument('--cache_dir', type=str, default='', help='where preprocessed datasets are cached (e.g. unsuper/data/cache), empty string to disable')
     
     # Parse and return
     args = parser.parse_args()
@@ -74,7 +77,8 @@ if __name__ == '__main__':
                                                 download=True,
                                                 classes=args.classes,
                                                 num_points=args.num_points,
-                                                batch_size=args.batch_size)
+                                                batch_size=args.batch_size,
+                                                cache_dir=args.cache_dir or None)
     img_size = (1, 28, 28)
 
     # Construct model
@@ -108,37 +112,7 @@ if __name__ == '__main__':
     torch.save(model.state_dict(), logdir + '/trained_model.pt')
     
     #%% build new dataset
-    class sample_data(torch.utils.data.Dataset):
-        def __init__(self, n, model=None):
-            self.n = n
-            if model:
-                X=np.zeros((n, 1, 28, 28))
-                y=np.zeros((n, ))
-                self.latent = [np.zeros((n, 2)) for _ in range(model.latent_spaces)]
-                for b in range(int(n/100)):
-                    x, zs = model.special_sample(100)
-                    X[100*b:100*(b+1)] = x.cpu()
-                    for i in range(model.latent_spaces):
-                        self.latent[i][100*b:100*(b+1)] = zs[i].cpu()
-                self.data = torch.tensor(X)
-                self.targets = torch.tensor(y)
-        
-        def fromfiles(self, name_x, name_y):
-            self.data = torch.load(name_x)
-            self.targets = torch.load(name_y)
-        
-        def __getitem__(self, index):
-            img, target = self.data[index], int(self.targets[index])
-            return img, target
-
-        def __len__(self):
-            return self.n
-                
-    train = sample_data(60000, model)
-    torch.save(train.data, 'samples_x.pt')
-    torch.save(train.targets, 'samples_y.pt')
-    #train = sample_data(60000, None)
-    #train.fromfiles('samples_x.pt', 'samples_y.pt')
+    train = generate_dataset(model, 60000, logdir + '/samples')
     
     trainloader = torch.utils.data.DataLoader(train, batch_size = args.batch_size)
     #testloader = torch.utils.data.DataLoader(test, batch_size = 500)
@@ -211,23 +185,10 @@ if __name__ == '__main__':
     torch.save(model4.state_dict(), logdir + '/trained_model4.pt')
     
     #%% save latent codes
-    latent1 = train.latent
-    latent2 = [np.zeros((60000, 4))]
-    latent3 = [np.zeros((60000, 4))]
-    latent4 = [np.zeros((60000, 2)), np.zeros((60000, 2))]
-    
-    counter = 0
-    for (X, _) in trainloader:
-        X = X.reshape(-1, 1, 28, 28).to(torch.float32).cuda()
-        _, _, _, zs2, _ = model2.semantics(X)
-        _, _, _, zs3, _ = model3.semantics(X)
-        _, _, _, zs4, _ = model4.semantics(X)
-        n = X.shape[0]
-        latent2[0][counter:counter+n] = zs2[0].detach().cpu()
-        latent3[0][counter:counter+n] = zs3[0].detach().cpu()
-        latent4[0][counter:counter+n] = zs4[0].detach().cpu()
-        latent4[1][counter:counter+n] = zs4[1].detach().cpu()
-        counter += n
+    latent1 = [l.numpy() for l in train.latent]
+    latent2, _ = extract_latents(model2, trainloader, img_size, mode='semantics')
+    latent3, _ = extract_latents(model3, trainloader, img_size, mode='semantics')
+    latent4, _ = extract_latents(model4, trainloader, img_size, mode='semantics')
 
     np.save(logdir + '/latent1', latent1)
     np.save(logdir + '/latent2', latent2)
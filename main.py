@@ -8,14 +8,19 @@ Created on Fri Oct 12 12:18:28 2018
 
 #%%
 import torch
-import argparse, datetime
+import argparse, datetime, sys
 from torchvision import transforms
 
 from unsuper.trainer import vae_trainer
+from unsuper.ensemble_trainer import ensemble_trainer
 from unsuper.data.mnist_data_loader import mnist_data_loader
 from unsuper.data.perception_data_loader import perception_data_loader
 from unsuper.helper.utility import model_summary
 from unsuper.helper.encoder_decoder import get_encoder, get_decoder
+from unsuper.helper.convergence import convergence_monitor
+from unsuper.helper.hooks import profiler_hook, torch_profiler_hook
+from unsuper.helper.memory import memory_hook
+from unsuper.helper.schedulers import kl_annealing, switch_schedule, get_lr_scheduler
 from unsuper.models import get_model
 
 #%%
@@ -27,6 +32,9 @@ def argparser():
     ms.add_argument('--model', type=str, default='vae', help='model to train')
     ms.add_argument('--ed_type', type=str, default='mlp', help='encoder/decoder type')
     ms.add_argument('--stn_type', type=str, default='affinediff', help='transformation type to use')
+    ms.add_argument('--checkpoint', type=str, nargs='+', default=None, help='stages to recompute in the backward pass to save memory (encoder, decoder, stn)')
+    ms.add_argument('--noise', type=str, default='normal', help='noise for the reparameterization (normal, antithetic, sobol)')
+    ms.add_argument('--stats_every', type=int, default=1, help='log transformation statistics at most every N epochs')
     ms.add_argument('--beta', type=float, default=16.0, help='beta value for beta-vae model')
     
     # Training settings
@@ -35,13 +43,30 @@ def argparser():
     ts.add_argument('--eval_epoch', type=int, default=1000, help='when to evaluate log(p(x))')
     ts.add_argument('--batch_size', type=int, default=1024, help='size of the batches')
     ts.add_argument('--warmup', type=int, default=100, help='number of warmup epochs for kl-terms')
-    ts.add_argument('--lr', type=float, default=1e-3, help='learning rate for adam optimizer')
+    ts.add_argument('--lr', type=float, nargs='+', default=[1e-3], help='learning rate for adam optimizer (several values trains an ensemble in one process)')
+    ts.add_argument('--lr_schedule', type=str, default='constant', help='learning rate schedule, updated every step (constant, onecycle, cosine), the lr is the peak value')
+    ts.add_argument('--kl_schedule', type=str, default='linear', help='annealing of the kl-terms, updated every step (constant, linear over the warmup epochs, cyclical)')
+    ts.add_argument('--kl_cycles', type=int, default=4, help='number of cycles for cyclical kl annealing')
+    ts.add_argument('--switch_ramp', type=int, default=0, help='number of epochs after warmup over which the learned output variance is faded in (0 switches at once)')
+    ts.add_argument('--patience', type=int, default=None, help='stop when the test ELBO has not improved for this many epochs (default: no early stopping)')
+    ts.add_argument('--min_delta', type=float, default=0.0, help='minimum increase of the test ELBO that counts as an improvement')
+    ts.add_argument('--max_eval_interval', type=int, default=8, help='maximum number of epochs between test evaluations when using early stopping')
+    ts.add_argument('--micro_batch_size', type=int, default=None, help='split each batch into chunks of this size and accumulate gradients (saves memory)')
+    ts.add_argument('--precision', type=str, default='fp32', help='fp32 or bf16 (autocast for encoder/decoder layers)')
+    ts.add_argument('--distributed', action='store_true', help='data parallel training over the gloo backend (launch with torchrun)')
+    ts.add_argument('--phase_profile', action='store_true', help='record time per training phase, samples/sec and peak memory (tensorboard + profile.json)')
+    ts.add_argument('--memory_every', type=int, default=None, help='record memory per submodule and phase every N steps (tensorboard + memory.json)')
+    ts.add_argument('--profile', action='store_true', help='run torch.profiler over a window of steps, saves chrome traces and an operator table in the logdir')
+    ts.add_argument('--profile_schedule', type=int, nargs=4, default=[10, 1, 1, 3], help='profiler window: skip_first wait warmup active (in steps)')
+    ts.add_argument('--profile_top_k', type=int, default=30, help='number of operators in the profiler table')
+    ts.add_argument('--compile_mode', type=str, default=None, help='torch.compile mode for the training step (default, reduce-overhead, max-autotune)')
     
     # Hyper settings
     hp = parser.add_argument_group('Variational settings')
     hp.add_argument('--latent_dim', type=int, default=2, help='dimensionality of the latent space')
     hp.add_argument('--density', type=str, default='bernoulli', help='output density')    
     hp.add_argument('--eq_samples', type=int, default=1, help='number of MC samples over the expectation over E_q(z|x)')
+    hp.add_argument('--estimator', type=str, default='iwae', help='gradient estimator for the encoder (iwae, stl, dreg)')
     hp.add_argument('--iw_samples', type=int, default=1, help='number of importance weighted samples')
     
     # Dataset settings
@@ -50,9 +75,28 @@ def argparser():
     ds.add_argument('--num_points', type=int, default=10000, help='number of points in each class')
     ds.add_argument('--logdir', type=str, default='beta_final16', help='where to store results')
     ds.add_argument('--dataset', type=str, default='mnist', help='dataset to use')
+    ds.add_argument('--cache_dir', type=str, default='', help='where preprocessed datasets are cached (e.g. unsuper/data/cache), empty string to disable')
     
     # Parse and return
     args = parser.parse_args()
+    
+    # The ensemble trainer (several learning rates) does not support everything
+    if len(args.lr) > 1:
+        unsupported = [flag for flag, used in [
+                ('--patience', args.patience is not None),
+                ('--precision', args.precision != 'fp32'),
+                ('--compile_mode', args.compile_mode is not None),
+                ('--micro_batch_size', args.micro_batch_size is not None),
+                ('--checkpoint', args.checkpoint is not None),
+                ('--estimator', args.estimator != 'iwae'),
+                ('--noise sobol', args.noise == 'sobol'),
+                ('--lr_schedule', args.lr_schedule != 'constant'),
+                ('--distributed', args.distributed),
+                ('--phase_profile', args.phase_profile),
+                ('--memory_every', args.memory_every is not None),
+                ('--profile', args.profile)] if used]
+        if unsupported:
+            parser.error(', '.join(unsupported) + ' can not be used with several learning rates')
     return args
 
 #%%
@@ -66,6 +110,13 @@ if __name__ == '__main__':
     else:
         logdir = 'res/' + args.model + '/' + args.logdir
     
+    # Distributed setup, rank 0 prepares the data before the other processes load it
+    rank = 0
+    if args.distributed:
+        torch.distributed.init_process_group('gloo')
+        rank = torch.distributed.get_rank()
+        if rank != 0: torch.distributed.barrier()
+    
     # Load data
     print('Loading data')
     if args.dataset == 'mnist':
@@ -78,7 +129,9 @@ if __name__ == '__main__':
                                                     download=True,
                                                     classes=args.classes,
                                                     num_points=args.num_points,
-                                                    batch_size=args.batch_size)
+                                                    batch_size=args.batch_size,
+                                                    distributed=args.distributed,
+                                                    cache_dir=args.cache_dir or None)
         img_size = (1, 28, 28)
     elif args.dataset == 'perception':
         trainloader, testloader = perception_data_loader(root='unsuper/data', 
@@ -86,26 +139,79 @@ if __name__ == '__main__':
                                                          download=True,
                                                          classes=args.classes,
                                                          num_points=args.num_points,
-                                                         batch_size=args.batch_size)
+                                                         batch_size=args.batch_size,
+                                                         distributed=args.distributed,
+                                                         cache_dir=args.cache_dir or None)
         img_size = (1, 400, 200)
+    if args.distributed and rank == 0: torch.distributed.barrier()
 
     # Construct model
     model_class = get_model(args.model)
-    model = model_class(input_shape = img_size,
-                        latent_dim = args.latent_dim, 
-                        encoder = get_encoder(args.ed_type), 
-                        decoder = get_decoder(args.ed_type), 
-                        outputdensity = args.density,
-                        ST_type = args.stn_type)
+    build_model = lambda: model_class(input_shape = img_size,
+                                      latent_dim = args.latent_dim, 
+                                      encoder = get_encoder(args.ed_type), 
+                                      decoder = get_decoder(args.ed_type), 
+                                      outputdensity = args.density,
+                                      ST_type = args.stn_type,
+                                      checkpoint = args.checkpoint,
+                                      noise = args.noise,
+                                      stats_every = args.stats_every)
+    
+    # Schedules of the kl-terms and the output variance, updated every step
+    n_steps = args.n_epochs * len(trainloader)
+    kl_schedule = kl_annealing(args.kl_schedule, 
+                               warmup_steps=args.warmup * len(trainloader),
+                               cycle_steps=max(n_steps // args.kl_cycles, 1))
+    switch = switch_schedule(start_steps=args.warmup * len(trainloader),
+                             ramp_steps=args.switch_ramp * len(trainloader))
+    
+    # Several learning rates, train one model per learning rate in this process
+    if len(args.lr) > 1:
+        Trainer = ensemble_trainer(img_size, [build_model() for _ in args.lr], args.lr,
+                                   betas=len(args.lr)*[args.beta])
+        Trainer.fit(trainloader=trainloader, 
+                    n_epochs=args.n_epochs, 
+                    warmup=args.warmup, 
+                    logdir=logdir,
+                    testloader=testloader,
+                    eq_samples=args.eq_samples, 
+                    iw_samples=args.iw_samples,
+                    kl_schedule=kl_schedule,
+                    switch=switch)
+        for i, m in enumerate(Trainer.unstack()):
+            torch.save(m.state_dict(), logdir + '/member_' + str(i) + '/trained_model.pt')
+        sys.exit()
+    model = build_model()
     
     # Summary of model
     #model_summary(model)
     
     # Optimizer
-    optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
+    optimizer = torch.optim.Adam(model.parameters(), lr=args.lr[0])
     
     # Train model
-    Trainer = vae_trainer(img_size, model, optimizer)
+    Trainer = vae_trainer(img_size, model, optimizer, precision=args.precision,
+                          compile_mode=args.compile_mode,
+                          micro_batch_size=args.micro_batch_size,
+                          estimator=args.estimator)
+    monitor = None
+    if args.patience is not None:
+        monitor = convergence_monitor(patience=args.patience, 
+                                      min_delta=args.min_delta,
+                                      max_interval=args.max_eval_interval)
+    hooks = [ ]
+    if args.phase_profile:
+        hooks.append(profiler_hook())
+    if args.memory_every is not None:
+        hooks.append(memory_hook(every=args.memory_every))
+    if args.profile:
+        skip_first, wait, warmup, active = args.profile_schedule
+        hooks.append(torch_profiler_hook(wait=wait, warmup=warmup, active=active,
+                                         skip_first=skip_first, top_k=args.profile_top_k))
+    
+    # Learning rate schedule, updated every step
+    lr_scheduler = get_lr_scheduler(args.lr_schedule, optimizer, n_steps)
+    
     Trainer.fit(trainloader=trainloader, 
                 n_epochs=args.n_epochs, 
                 warmup=args.warmup, 
@@ -114,7 +220,15 @@ if __name__ == '__main__':
                 eq_samples=args.eq_samples, 
                 iw_samples=args.iw_samples,
                 beta=args.beta,
-                eval_epoch=args.eval_epoch)
+                eval_epoch=args.eval_epoch,
+                monitor=monitor,
+                hooks=hooks,
+                kl_schedule=kl_schedule,
+                switch=switch,
+                lr_scheduler=lr_scheduler)
     
     # Save model
-    torch.save(model.state_dict(), logdir + '/trained_model.pt')
+    if rank == 0:
+        torch.save(model.state_dict(), logdir + '/trained_model.pt')
+    if args.distributed:
+        torch.distributed.destroy_process_group()
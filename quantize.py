@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#%%
+import torch
+import argparse
+from torchvision import transforms
+
+from unsuper.data.mnist_data_loader import mnist_data_loader
+from unsuper.helper.encoder_decoder import get_encoder, get_decoder
+from unsuper.helper.quantization import quantize_model, quantization_report
+from unsuper.models import get_model
+
+#%%
+def argparser():
+    """ Argument parser for the quantization script """
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--model_path', type=str, default='res/vae/trained_model.pt', help='trained state dict to quantize')
+    parser.add_argument('--model', type=str, default='vae', help='model type')
+    parser.add_argument('--ed_type', type=str, default='mlp', help='encoder/decoder type')
+    parser.add_argument('--stn_type', type=str, default='affinediff', help='transformation type to use')
+    parser.add_argument('--latent_dim', type=int, default=2, help='dimensionality of the latent space')
+    parser.add_argument('--density', type=str, default='bernoulli', help='output density')
+    parser.add_argument('--batch_size', type=int, default=256, help='size of the batches')
+    parser.add_argument('--n_batches', type=int, default=20, help='number of test batches to evaluate the ELBO on')
+    parser.add_argument('--max_drift', type=float, default=0.01, help='maximal relative ELBO drift for saving the quantized model')
+    parser.add_argument('--no_fold', action='store_true', help='do not fold batchnorm into the linear layers')
+    args = parser.parse_args()
+    return args
+
+#%%
+if __name__ == '__main__':
+    args = argparser()
+    img_size = (1, 28, 28)
+    
+    _, testloader = mnist_data_loader(root='unsuper/data', 
+                                      transform=transforms.ToTensor(),
+                                      download=True,
+                                      batch_size=args.batch_size)
+    
+    model = get_model(args.model)(input_shape = img_size,
+                                  latent_dim = args.latent_dim, 
+                                  encoder = get_encoder(args.ed_type), 
+                                  decoder = get_decoder(args.ed_type), 
+                                  outputdensity = args.density,
+                                  ST_type = args.stn_type)
+    model.load_state_dict(torch.load(args.model_path, map_location='cpu'))
+    
+    qmodel = quantize_model(model, fold=not args.no_fold)
+    report = quantization_report(model, qmodel, testloader, img_size, args.n_batches)
+    for k, v in report.items():
+        print('{0:15s} {1:.5f}'.format(k, v))
+    
+    if report['relative_drift'] <= args.max_drift:
+        path = args.model_path.replace('.pt', '_int8.pt')
+        torch.save(qmodel, path)
+        print('Saved quantized model to', path)
+    else:
+        print('ELBO drift too large, quantized model not saved')
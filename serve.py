@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#%%
+import torch
+import argparse
+
+from unsuper.helper.encoder_decoder import get_encoder, get_decoder
+from unsuper.models import get_model
+from unsuper.serving import inference_server
+
+#%%
+def argparser():
+    """ Argument parser for the serving script """
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    # Model settings
+    ms = parser.add_argument_group('Model settings')
+    ms.add_argument('--model_path', type=str, default='res/vitae_ci/trained_model.pt', help='trained state dict to load')
+    ms.add_argument('--model', type=str, default='vitae_ci', help='model to serve')
+    ms.add_argument('--ed_type', type=str, default='mlp', help='encoder/decoder type')
+    ms.add_argument('--stn_type', type=str, default='affinediff', help='transformation type to use')
+    ms.add_argument('--latent_dim', type=int, default=2, help='dimensionality of the latent space')
+    ms.add_argument('--density', type=str, default='bernoulli', help='output density')
+    ms.add_argument('--dataset', type=str, default='mnist', help='dataset the model was trained on')
+    
+    # Server settings
+    ss = parser.add_argument_group('Server settings')
+    ss.add_argument('--host', type=str, default='127.0.0.1', help='host to bind to')
+    ss.add_argument('--port', type=int, default=8000, help='port to bind to')
+    ss.add_argument('--max_batch_size', type=int, default=256, help='maximum number of items in a micro batch')
+    ss.add_argument('--max_latency', type=float, default=0.005, help='maximum seconds a request waits for its micro batch')
+    
+    # Parse and return
+    args = parser.parse_args()
+    return args
+
+#%%
+if __name__ == '__main__':
+    # Input arguments
+    args = argparser()
+    img_size = (1, 28, 28) if args.dataset == 'mnist' else (1, 400, 200)
+    
+    # Construct and load model
+    model_class = get_model(args.model)
+    model = model_class(input_shape = img_size,
+                        latent_dim = args.latent_dim, 
+                        encoder = get_encoder(args.ed_type), 
+                        decoder = get_decoder(args.ed_type), 
+                        outputdensity = args.density,
+                        ST_type = args.stn_type)
+    model.load_state_dict(torch.load(args.model_path, map_location='cpu'))
+    if torch.cuda.is_available(): model.cuda()
+    
+    # Serve
+    server = inference_server(model, img_size, host=args.host, port=args.port,
+                              max_batch_size=args.max_batch_size,
+                              max_latency=args.max_latency)
+    print('Serving on http://{0}:{1}'.format(*server.address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+#%%
+import os
+import pytest
+torch = pytest.importorskip('torch')
+from unsuper.data.cache import cached_dataset, transform_spec
+
+#%%
+class Compose:
+    def __init__(self, transforms):
+        self.transforms = transforms
+    def __repr__(self):
+        return 'Compose(' + ', '.join([repr(t) for t in self.transforms]) + ')'
+
+class Normalize:
+    def __init__(self, mean):
+        self.mean = mean
+    def __repr__(self):
+        return 'Normalize(mean={0})'.format(self.mean)
+
+class Lambda:
+    def __init__(self, fn):
+        self.fn = fn
+    def __repr__(self):
+        return 'Lambda()'
+
+class RandomCrop:
+    def __repr__(self):
+        return 'RandomCrop()'
+
+#%%
+@pytest.fixture
+def source(tmp_path):
+    path = str(tmp_path / 'source.bin')
+    with open(path, 'wb') as f:
+        f.write(b'version 1')
+    return path
+
+class builder:
+    """ Build function that counts how often it is called """
+    def __init__(self):
+        self.calls = 0
+    def __call__(self):
+        self.calls += 1
+        return torch.utils.data.TensorDataset(torch.full((5, 1, 2, 2), float(self.calls)),
+                                              torch.arange(5))
+
+def _n_files(cache_dir):
+    return len([f for f in os.listdir(cache_dir) if f.endswith('.pt')])
+
+#%%
+def test_cache_hit(tmp_path, source):
+    cache_dir, build = str(tmp_path / 'cache'), builder()
+    d1 = cached_dataset(cache_dir, source, build, train=True, classes=[1, 2])
+    d2 = cached_dataset(cache_dir, source, build, train=True, classes=[1, 2])
+    assert build.calls == 1
+    assert torch.equal(d1.tensors[0], d2.tensors[0])
+    assert torch.equal(d1.tensors[1], d2.tensors[1])
+
+def test_spec_changes_the_key(tmp_path, source):
+    cache_dir, build = str(tmp_path / 'cache'), builder()
+    cached_dataset(cache_dir, source, build, train=True, classes=[1, 2])
+    cached_dataset(cache_dir, source, build, train=False, classes=[1, 2])
+    cached_dataset(cache_dir, source, build, train=True, classes=[1, 3])
+    cached_dataset(cache_dir, source, build, train=True, classes=[1, 2],
+                   transform=Normalize(0.5))
+    cached_dataset(cache_dir, source, build, train=True, classes=[1, 2],
+                   transform=Normalize(0.1))
+    assert build.calls == 5
+    assert _n_files(cache_dir) == 5
+
+def test_changed_source_invalidates(tmp_path, source):
+    cache_dir, build = str(tmp_path / 'cache'), builder()
+    cached_dataset(cache_dir, source, build, train=True)
+    with open(source, 'wb') as f:
+        f.write(b'version 2')
+    d = cached_dataset(cache_dir, source, build, train=True)
+    assert build.calls == 2
+    assert (d.tensors[0] == 2).all()
+
+def test_touched_source_still_hits(tmp_path, source):
+    # The key depends on the contents, not on the modification time
+    cache_dir, build = str(tmp_path / 'cache'), builder()
+    cached_dataset(cache_dir, source, build, train=True)
+    st = os.stat(source)
+    os.utime(source, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    cached_dataset(cache_dir, source, build, train=True)
+    assert build.calls == 1
+
+def test_source_created_by_build(tmp_path):
+    cache_dir, source = str(tmp_path / 'cache'), str(tmp_path / 'downloaded.bin')
+    inner = builder()
+    def build():
+        with open(source, 'wb') as f:
+            f.write(b'downloaded')
+        return inner()
+    cached_dataset(cache_dir, source, build, train=True)
+    cached_dataset(cache_dir, source, build, train=True)
+    assert inner.calls == 1
+
+@pytest.mark.parametrize('transform', [Lambda(lambda x: x), RandomCrop(),
+                                       Compose([Normalize(0.5), Compose([Lambda(abs)])])])
+def test_uncacheable_transforms(tmp_path, source, transform):
+    assert transform_spec(transform) is None
+    cache_dir, build = str(tmp_path / 'cache'), builder()
+    cached_dataset(cache_dir, source, build, transform=transform)
+    cached_dataset(cache_dir, source, build, transform=transform)
+    assert build.calls == 2
+    assert not os.path.exists(cache_dir) or _n_files(cache_dir) == 0
+
+def test_disabled(source):
+    build = builder()
+    cached_dataset(None, source, build, train=True)
+    cached_dataset(None, source, build, train=True)
+    assert build.calls == 2
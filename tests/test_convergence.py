@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+#%%
+import pytest
+pytest.importorskip('torch')
+from unsuper.helper.convergence import convergence_monitor
+
+#%%
+def _run(monitor, metric, n_epochs):
+    evaluated = [ ]
+    for epoch in range(n_epochs):
+        if monitor.should_evaluate(epoch):
+            evaluated.append(epoch)
+            monitor.update(epoch, metric(epoch))
+            if monitor.stop:
+                break
+    return evaluated
+
+#%%
+def test_evaluates_every_epoch_while_improving():
+    # Improves every epoch, so the interval stays at one
+    monitor = convergence_monitor(patience=10)
+    assert _run(monitor, lambda e: e, 20) == list(range(20))
+
+def test_plateau_is_evaluated_sparsely_and_stops():
+    monitor = convergence_monitor(patience=16, max_interval=8)
+    evaluated = _run(monitor, lambda e: min(e, 5), 100)
+    assert monitor.stop and monitor.best_epoch == 5
+    # After the plateau starts the interval doubles: 1, 2, 4, 8, 8, ...
+    assert evaluated[:9] == [0, 1, 2, 3, 4, 5, 6, 8, 12]
+    assert evaluated[-1] - monitor.best_epoch >= 16
+
+def test_start_does_not_force_evaluation_every_epoch():
+    # The warmup only delays stopping, evaluations follow the normal schedule
+    monitor = convergence_monitor(patience=4, max_interval=2, start=20)
+    evaluated = _run(monitor, lambda e: 0.0, 40)
+    assert len(evaluated) < 20
+    assert monitor.stop and evaluated[-1] >= 24
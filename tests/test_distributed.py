@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+#%%
+import os, json, math, socket
+import pytest
+torch = pytest.importorskip('torch')
+pytest.importorskip('tensorboardX')
+pytest.importorskip('torchvision')
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from unsuper.trainer import vae_trainer
+from unsuper.models import get_model
+from unsuper.helper.encoder_decoder import get_encoder, get_decoder
+from unsuper.helper.convergence import convergence_monitor
+
+pytestmark = pytest.mark.skipif(not dist.is_available(), reason='torch.distributed not available')
+
+#%%
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def _worker(rank, world_size, port, folder):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    try:
+        # Same data on all ranks, the sampler gives each rank its own shard.
+        # The model is initialized differently on each rank, DDP broadcasts
+        # the parameters of rank 0
+        torch.manual_seed(0)
+        train = torch.utils.data.TensorDataset(torch.rand(48, 1, 28, 28).round(),
+                                               torch.zeros(48, dtype=torch.int64))
+        test = torch.utils.data.TensorDataset(torch.rand(8, 1, 28, 28).round(),
+                                              torch.zeros(8, dtype=torch.int64))
+        torch.manual_seed(rank)
+        model = get_model('vae')(input_shape=(1, 28, 28), latent_dim=2,
+                                 encoder=get_encoder('mlp'), decoder=get_decoder('mlp'),
+                                 outputdensity='bernoulli')
+        sampler = torch.utils.data.DistributedSampler(train)
+        trainloader = torch.utils.data.DataLoader(train, batch_size=8, sampler=sampler)
+        testloader = torch.utils.data.DataLoader(test, batch_size=8)
+        trainer = vae_trainer((1, 28, 28), model, torch.optim.Adam(model.parameters(), lr=1e-3))
+        trainer.fit(trainloader, n_epochs=2, warmup=1,
+                    logdir=os.path.join(folder, 'rank' + str(rank)),
+                    testloader=testloader, monitor=convergence_monitor(patience=5))
+
+        # Parameters of all ranks
+        flat = torch.cat([p.detach().flatten() for p in model.parameters()])
+        gathered = [torch.zeros_like(flat) for _ in range(world_size)]
+        dist.all_gather(gathered, flat)
+        if rank == 0:
+            with open(os.path.join(folder, 'result.json'), 'w') as f:
+                json.dump({'identical': all([torch.equal(flat, g) for g in gathered]),
+                           'steps': len(trainloader)}, f)
+    finally:
+        dist.destroy_process_group()
+
+#%%
+@pytest.mark.parametrize('world_size', [2, 4])
+def test_ddp_gloo(tmp_path, world_size):
+    mp.spawn(_worker, args=(world_size, _free_port(), str(tmp_path)), nprocs=world_size)
+    with open(os.path.join(str(tmp_path), 'result.json')) as f:
+        result = json.load(f)
+
+    # Each rank only saw its shard, and all ranks ended with the same parameters
+    assert result['steps'] == math.ceil(48 / world_size / 8)
+    assert result['identical']
+
+    # Only rank 0 writes tensorboard logs and checkpoints
+    files = os.listdir(os.path.join(str(tmp_path), 'rank0'))
+    assert any([f.startswith('events') for f in files])
+    assert 'best_model.pt' in files
+    for rank in range(1, world_size):
+        assert not os.path.exists(os.path.join(str(tmp_path), 'rank' + str(rank)))
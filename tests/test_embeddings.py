@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+#%%
+import os
+import pytest
+torch = pytest.importorskip('torch')
+np = pytest.importorskip('numpy')
+from unsuper.helper.embeddings import embedding_exporter
+
+#%%
+class _writer:
+    """ Records the calls to add_embedding """
+    def __init__(self):
+        self.embeddings = { }
+    def add_embedding(self, mat, metadata, label_img, tag):
+        self.embeddings[tag] = (mat, metadata, label_img)
+
+def _export(logdir, n_points=23, batch_size=5, latent_dims=(2, 4), max_sprites=7):
+    torch.manual_seed(0)
+    zs = [torch.randn(n_points, d) for d in latent_dims]
+    labels = torch.randint(0, 10, (n_points,))
+    images = torch.rand(n_points, 1, 56, 56)
+    exporter = embedding_exporter(logdir, 'test', n_points, list(latent_dims),
+                                  max_sprites=max_sprites, sprite_size=28)
+    # Batch size that does not divide the number of points
+    for i in range(0, n_points, batch_size):
+        idx = slice(i, i + batch_size)
+        exporter.add([z[idx] for z in zs], labels[idx], images[idx])
+    writer = _writer()
+    exporter.write(writer)
+    return zs, labels, writer
+
+#%%
+def test_memmap_round_trip(tmp_path):
+    logdir = str(tmp_path / 'logs')
+    zs, labels, writer = _export(logdir)
+    loaded = np.load(os.path.join(logdir, 'test_labels.npy'), mmap_mode='r')
+    assert (loaded == labels.numpy()).all()
+    for j, z in enumerate(zs):
+        loaded = np.load(os.path.join(logdir, 'test_latent_space' + str(j) + '.npy'), mmap_mode='r')
+        assert loaded.dtype == np.float32 and loaded.shape == tuple(z.shape)
+        assert np.allclose(loaded, z.numpy())
+
+def test_projector_subset(tmp_path):
+    zs, labels, writer = _export(str(tmp_path))
+    mat, metadata, label_img = writer.embeddings['test_latent_space0']
+    # Only max_sprites points, and 2d latents padded to 3 dimensions
+    assert mat.shape == (7, 3)
+    assert torch.allclose(mat[:, :2], zs[0][:7]) and (mat[:, 2] == 0).all()
+    assert metadata == labels[:7].tolist()
+    assert label_img.shape == (7, 1, 28, 28)
+    assert writer.embeddings['test_latent_space1'][0].shape == (7, 4)
+
+def test_default_logdir_is_current_folder(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    _export('')
+    assert os.path.exists(os.path.join(str(tmp_path), 'test_labels.npy'))
+
+def test_too_many_points(tmp_path):
+    exporter = embedding_exporter(str(tmp_path), 'test', 3, [2])
+    with pytest.raises(AssertionError):
+        exporter.add([torch.zeros(4, 2)], torch.zeros(4, dtype=torch.int64))
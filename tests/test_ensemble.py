@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+#%%
+import copy
+import pytest
+torch = pytest.importorskip('torch')
+pytest.importorskip('tensorboardX')
+pytest.importorskip('torchvision')
+from unsuper.ensemble_trainer import ensemble_trainer
+from unsuper.trainer import vae_trainer
+from unsuper.models import get_model
+from unsuper.helper.encoder_decoder import get_encoder, get_decoder
+from unsuper.helper.sampling import gaussian_sampler
+
+#%%
+img_size = (1, 28, 28)
+lrs, betas = [1e-3, 3e-3], [1.0, 0.5]
+
+@pytest.fixture(autouse=True)
+def fixed_noise(monkeypatch):
+    """ Deterministic noise, such that the members and the single models see
+        the same samples """
+    def sample_noise(self, batch_size, n_samples, latent_dim, device, dtype=torch.float32):
+        eps = torch.linspace(-1.5, 1.5, n_samples*latent_dim, device=device, dtype=dtype)
+        return eps.reshape(1, n_samples, latent_dim).expand(batch_size, -1, -1)
+    monkeypatch.setattr(gaussian_sampler, 'sample_noise', sample_noise)
+
+def _models(model_name, noise='normal'):
+    models = [ ]
+    for seed in range(len(lrs)):
+        torch.manual_seed(seed)
+        models.append(get_model(model_name)(input_shape = img_size,
+                                            latent_dim = 2,
+                                            encoder = get_encoder('mlp'),
+                                            decoder = get_decoder('mlp'),
+                                            outputdensity = 'bernoulli',
+                                            ST_type = 'affine',
+                                            noise = noise))
+    return models
+
+def _batches(n=3):
+    torch.manual_seed(2)
+    return [torch.rand(8, *img_size).round() for _ in range(n)]
+
+#%%
+@pytest.mark.parametrize('model_name', ['vae', 'vitae_ci'])
+def test_matches_single_model_training(model_name):
+    models = _models(model_name)
+    singles = [copy.deepcopy(m) for m in models]
+    ensemble = ensemble_trainer(img_size, models, lrs, betas)
+    trainers = [vae_trainer(img_size, m, torch.optim.Adam(m.parameters(), lr=lr))
+                for m, lr in zip(singles, lrs)]
+
+    for step, data in enumerate(_batches()):
+        kl_weight, switch = 0.25*(step+1), 0.5
+        loss, recon, kl = ensemble.train_step(data, 1, 2, switch, kl_weight=kl_weight)
+        for i, (trainer, beta) in enumerate(zip(trainers, betas)):
+            l, r, k = trainer.train_step(data, 1, 2, switch, kl_weight=kl_weight*beta)
+            assert torch.allclose(loss[i], l, rtol=1e-5, atol=1e-5)
+            assert torch.allclose(recon[i], r, rtol=1e-5, atol=1e-5)
+            assert torch.allclose(kl[i], torch.stack(k), rtol=1e-5, atol=1e-5)
+
+    # The unstacked members are the separately trained models
+    for member, single in zip(ensemble.unstack(), singles):
+        for (name, p1), (_, p2) in zip(member.named_parameters(), single.named_parameters()):
+            assert torch.allclose(p1, p2, rtol=1e-4, atol=1e-6), name
+
+def test_unstack_gives_independent_models():
+    models = _models('vae')
+    ensemble = ensemble_trainer(img_size, models, lrs, betas)
+    ensemble.train_step(_batches(1)[0], kl_weight=1.0)
+    members = ensemble.unstack()
+    assert members[0] is models[0] and members[1] is models[1]
+    for name, p in members[0].named_parameters():
+        assert torch.equal(p, ensemble.params[name][0])
+        assert not torch.equal(p, members[1].state_dict()[name])
+    for name, b in members[1].named_buffers():
+        assert torch.equal(b, ensemble.buffers[name][1])
+
+    # Changing a member does not change the stacked parameters
+    with torch.no_grad():
+        next(members[0].parameters()).add_(1.0)
+    name = next(members[0].named_parameters())[0]
+    assert not torch.equal(next(members[0].parameters()), ensemble.params[name][0])
+
+def test_evaluate_does_not_change_batchnorm_statistics():
+    models = _models('vae')
+    ensemble = ensemble_trainer(img_size, models, lrs, betas)
+    buffers = {k: b.clone() for k, b in ensemble.buffers.items()}
+    loader = [(data, torch.zeros(8)) for data in _batches(2)]
+    elbo = ensemble.evaluate(loader)
+    assert elbo.shape == (len(lrs),)
+    for k, b in ensemble.buffers.items():
+        assert torch.equal(b, buffers[k]), k
+    assert ensemble.base.training
+
+def test_sobol_noise_is_rejected():
+    with pytest.raises(AssertionError):
+        ensemble_trainer(img_size, _models('vae', noise='sobol'), lrs, betas)
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+#%%
+import pytest
+torch = pytest.importorskip('torch')
+pytest.importorskip('tensorboardX')
+pytest.importorskip('torchvision')
+from torch import nn
+import torch.nn.functional as F
+from unsuper.trainer import vae_trainer
+from unsuper.helper.sampling import gaussian_sampler
+
+#%%
+class toy_hierarchical(nn.Module):
+    """ Small linear gaussian model with two latent spaces, where (as in
+        VITAE_CI) the second encoder sees the first latent sample """
+    def __init__(self, input_dim=3, latent_dim=2):
+        super(toy_hierarchical, self).__init__()
+        self.latent_dim = latent_dim
+        self.latent_spaces = 2
+        self.outputdensity = 'gaussian'
+        self.enc1 = nn.Linear(input_dim, 2*latent_dim)
+        self.dec1 = nn.Linear(latent_dim, input_dim)
+        self.enc2 = nn.Linear(input_dim, 2*latent_dim)
+        self.dec2 = nn.Linear(2*latent_dim, input_dim)
+        self.log_var = nn.Parameter(torch.zeros(input_dim))
+        self.sampler1 = gaussian_sampler()
+        self.sampler2 = gaussian_sampler()
+
+    def _encode(self, enc, x):
+        mu, v = enc(x).chunk(2, dim=1)
+        return mu, F.softplus(v) + 0.1
+
+    def forward(self, x, eq_samples=1, iw_samples=1, switch=1.0):
+        mu1, var1 = self._encode(self.enc1, x)
+        z1 = self.sampler1(mu1, var1, eq_samples, iw_samples)
+        mu2, var2 = self._encode(self.enc2, x.repeat(eq_samples*iw_samples, 1) + self.dec1(z1))
+        z2 = self.sampler2(mu2, var2, 1, 1)
+        x_mu, x_var = self.likelihood([z1, z2], switch)
+        return x_mu, x_var, [z1, z2], [mu1, mu2], [var1, var2]
+
+    def posterior(self, x, z):
+        mu1, var1 = self._encode(self.enc1, x)
+        n = z[0].shape[0] // x.shape[0]
+        mu2, var2 = self._encode(self.enc2, x.repeat(n, 1) + self.dec1(z[0]))
+        return [mu1, mu2], [var1, var2]
+
+    def likelihood(self, z, switch=1.0):
+        x_mu = self.dec2(torch.cat(z, dim=1))
+        return x_mu, self.log_var.exp().expand_as(x_mu)
+
+#%%
+def _gradients(model, estimator, x, iw_samples, n_repeats):
+    """ Gradients of the bound for n_repeats independent noise draws """
+    trainer = vae_trainer((x.shape[1],), model, torch.optim.SGD(model.parameters(), lr=0.0),
+                          estimator=estimator)
+    grads = [ ]
+    for _ in range(n_repeats):
+        model.zero_grad()
+        loss, _, _ = trainer.forward_loss(x, 1, iw_samples, 1.0, 1.0)
+        loss.backward()
+        grads.append(torch.cat([p.grad.flatten() for p in model.parameters()]))
+    return torch.stack(grads)
+
+def _assert_same_expectation(g1, g2):
+    se = (g1.var(dim=0) / g1.shape[0] + g2.var(dim=0) / g2.shape[0]).sqrt()
+    diff = (g1.mean(dim=0) - g2.mean(dim=0)).abs()
+    assert (diff <= 5*se + 1e-4).all(), (diff, se)
+
+#%%
+@pytest.mark.parametrize('estimator', ['stl', 'dreg'])
+def test_bound_value_does_not_depend_on_estimator(estimator):
+    torch.manual_seed(0)
+    model = toy_hierarchical()
+    x = torch.randn(16, 3)
+    values = [ ]
+    for e in ['iwae', estimator]:
+        trainer = vae_trainer((3,), model, torch.optim.SGD(model.parameters(), lr=0.0),
+                              estimator=e)
+        torch.manual_seed(1)
+        values.append(trainer.forward_loss(x, 1, 4, 1.0, 1.0)[0].item())
+    assert values[0] == pytest.approx(values[1], rel=1e-6)
+
+def test_stl_is_unbiased_for_single_sample():
+    # With iw_samples > 1 stl is biased, so it is compared on the plain ELBO
+    torch.manual_seed(0)
+    model = toy_hierarchical()
+    x = torch.randn(1, 3).repeat(2000, 1)
+    g_iwae = _gradients(model, 'iwae', x, 1, 30)
+    g_stl = _gradients(model, 'stl', x, 1, 30)
+    _assert_same_expectation(g_iwae, g_stl)
+
+def test_dreg_is_unbiased():
+    torch.manual_seed(0)
+    model = toy_hierarchical()
+    x = torch.randn(1, 3).repeat(2000, 1)
+    g_iwae = _gradients(model, 'iwae', x, 8, 30)
+    g_dreg = _gradients(model, 'dreg', x, 8, 30)
+    _assert_same_expectation(g_iwae, g_dreg)
+
+def test_dreg_reduces_encoder_variance():
+    torch.manual_seed(0)
+    model = toy_hierarchical()
+    x = torch.randn(1, 3).repeat(200, 1)
+    n_enc1 = sum(p.numel() for p in model.enc1.parameters())
+    g_iwae = _gradients(model, 'iwae', x, 32, 30)[:, :n_enc1]
+    g_dreg = _gradients(model, 'dreg', x, 32, 30)[:, :n_enc1]
+    assert g_dreg.var(dim=0).sum() < g_iwae.var(dim=0).sum()
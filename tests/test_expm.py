@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+#%%
+import pytest
+torch = pytest.importorskip('torch')
+from unsuper.helper.expm import torch_expm
+
+#%%
+def _matrices(n=10, seed=0):
+    # Mixed norms, such that the matrices need a different number of squarings
+    torch.manual_seed(seed)
+    A = torch.randn(n, 3, 3, dtype=torch.float64) * torch.logspace(-2, 2, n, dtype=torch.float64)[:,None,None]
+    A[:,2,:] = 0
+    return A
+
+#%%
+def test_eager_matches_matrix_exp():
+    A = _matrices()
+    assert torch.allclose(torch_expm(A), torch.linalg.matrix_exp(A), rtol=1e-6, atol=1e-8)
+
+def test_traced_matches_eager():
+    # Traced with small matrices (no squarings), evaluated on large ones. The
+    # traced graph must not bake in the number of squarings of the example
+    traced = torch.jit.trace(torch_expm, (_matrices(seed=1) * 1e-3,))
+    A = _matrices()
+    assert torch.allclose(traced(A), torch_expm(A), rtol=1e-6, atol=1e-8)
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+#%%
+import pytest
+torch = pytest.importorskip('torch')
+pytest.importorskip('torchvision')
+from unsuper.helper.encoder_decoder import get_encoder, get_decoder
+from unsuper.helper.export import (export_model, load_exported, example_inputs,
+                                   encoder_graph, decoder_graph, reconstruction_graph)
+from unsuper.models import get_model
+
+#%%
+img_size = (1, 28, 28)
+cases = [('vae', 'affine')] + [(m, s) for m in ['vitae_ci', 'vitae_ui']
+                               for s in ['affine', 'affinediff', 'affinedecomp']]
+
+def _model(model_name, stn_type):
+    torch.manual_seed(0)
+    model = get_model(model_name)(input_shape = img_size,
+                                  latent_dim = 2,
+                                  encoder = get_encoder('mlp'),
+                                  decoder = get_decoder('mlp'),
+                                  outputdensity = 'bernoulli',
+                                  ST_type = stn_type)
+    # Random initialization gives transformations away from the identity, 
+    # such that the matrix exponential and the inverse are exercised
+    return model.eval()
+
+def _graphs(model):
+    return {'encoder': encoder_graph(model),
+            'decoder': decoder_graph(model),
+            'reconstruction': reconstruction_graph(model)}
+
+def _assert_parity(graphs, exported, inputs, atol):
+    with torch.no_grad():
+        for name, graph in graphs.items():
+            out1, out2 = graph(*inputs[name]), exported[name](*inputs[name])
+            if not isinstance(out1, tuple): out1, out2 = (out1,), (out2,)
+            for o1, o2 in zip(out1, out2):
+                assert o1.shape == o2.shape, name
+                assert torch.allclose(o1, o2, atol=atol), \
+                    (name, (o1 - o2).abs().max().item())
+
+#%%
+@pytest.mark.parametrize('model_name, stn_type', cases)
+def test_torchscript_parity(tmp_path, model_name, stn_type):
+    model = _model(model_name, stn_type)
+    paths = export_model(model, img_size, str(tmp_path), fmt='torchscript', batch_size=16)
+    exported = {name: load_exported(p) for name, p in paths.items()}
+    # Another batch size than the one used for tracing
+    inputs = example_inputs(model, img_size, batch_size=7)
+    _assert_parity(_graphs(model), exported, inputs, atol=1e-5)
+
+@pytest.mark.parametrize('model_name, stn_type', cases)
+def test_onnx_parity(tmp_path, model_name, stn_type):
+    pytest.importorskip('onnx')
+    pytest.importorskip('onnxruntime')
+    model = _model(model_name, stn_type)
+    paths = export_model(model, img_size, str(tmp_path), fmt='onnx', batch_size=16)
+    exported = {name: load_exported(p) for name, p in paths.items()}
+    inputs = example_inputs(model, img_size, batch_size=7)
+    _assert_parity(_graphs(model), exported, inputs, atol=1e-4)
+
+@pytest.mark.parametrize('model_name, stn_type', cases)
+def test_graphs_match_model(model_name, stn_type):
+    # The graphs that are exported compute the same as the model itself
+    model = _model(model_name, stn_type)
+    x = example_inputs(model, img_size, batch_size=5)['encoder'][0]
+    with torch.no_grad():
+        for z1, z2 in zip(encoder_graph(model)(x), model.latent_representation(x)):
+            assert torch.allclose(z1, z2)
+        if model.latent_spaces == 1:
+            assert torch.allclose(reconstruction_graph(model)(x),
+                                  model.decoder(model.latent_representation(x)[0])[0])
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+#%%
+import pytest
+torch = pytest.importorskip('torch')
+np = pytest.importorskip('numpy')
+neighbors = pytest.importorskip('sklearn.neighbors')
+from unsuper.helper.knn import knn_classifier
+
+#%%
+def _fit_both(Xtrain, ytrain, k):
+    # Chunk sizes that do not divide the number of points
+    ours = knn_classifier(k, query_chunk=7, train_chunk=13, dtype=torch.float64)
+    ours.fit(Xtrain, ytrain)
+    theirs = neighbors.KNeighborsClassifier(n_neighbors=k, algorithm='brute')
+    theirs.fit(Xtrain, ytrain)
+    return ours, theirs
+
+def _unambiguous(d_all, k):
+    """ Rows where the k'th and (k+1)'th nearest distances differ, such that
+        the set of k nearest neighbours is unique """
+    d_sorted = np.sort(d_all, axis=1)
+    return ~np.isclose(d_sorted[:, k-1], d_sorted[:, k])
+
+#%%
+@pytest.mark.parametrize('k', [1, 4, 5])
+def test_matches_sklearn_on_random_data(k):
+    rng = np.random.RandomState(0)
+    Xtrain, Xtest = rng.randn(101, 6), rng.randn(37, 6)
+    ytrain, ytest = rng.randint(0, 3, 101), rng.randint(0, 3, 37)
+    ours, theirs = _fit_both(Xtrain, ytrain, k)
+
+    d1, i1 = ours.kneighbors(Xtest)
+    d2, i2 = theirs.kneighbors(Xtest)
+    assert np.allclose(d1.numpy(), d2, atol=1e-8)
+    assert (i1.numpy() == i2).all()
+    assert (ours.predict(Xtest).numpy() == theirs.predict(Xtest)).all()
+    assert ours.score(Xtest, ytest) == pytest.approx(theirs.score(Xtest, ytest))
+
+def test_vote_ties_pick_smallest_class():
+    # With k=4 and two classes many points get 2-2 votes
+    rng = np.random.RandomState(1)
+    Xtrain, Xtest = rng.randn(60, 2), rng.randn(200, 2)
+    ytrain = rng.randint(0, 2, 60) * 5 + 3 # classes 3 and 8
+    ours, theirs = _fit_both(Xtrain, ytrain, 4)
+    assert (ours.predict(Xtest).numpy() == theirs.predict(Xtest)).all()
+
+def test_distance_ties():
+    # Points on an integer grid give many equal distances. The distances must
+    # match, and where the k nearest neighbours are unique so must they
+    rng = np.random.RandomState(2)
+    Xtrain = rng.randint(0, 4, size=(90, 2)).astype(np.float64)
+    Xtest = rng.randint(0, 4, size=(25, 2)).astype(np.float64)
+    ytrain = rng.randint(0, 3, 90)
+    k = 5
+    ours, theirs = _fit_both(Xtrain, ytrain, k)
+
+    d1, i1 = ours.kneighbors(Xtest)
+    d2, i2 = theirs.kneighbors(Xtest)
+    assert np.allclose(d1.numpy(), d2, atol=1e-8)
+
+    d_all = np.sqrt(((Xtest[:, None] - Xtrain[None]) ** 2).sum(-1))
+    rows = _unambiguous(d_all, k)
+    assert rows.any()
+    for r in np.where(rows)[0]:
+        assert set(i1[r].tolist()) == set(i2[r].tolist())
+    assert (ours.predict(Xtest).numpy()[rows] == theirs.predict(Xtest)[rows]).all()
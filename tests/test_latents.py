@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+#%%
+import pytest
+torch = pytest.importorskip('torch')
+np = pytest.importorskip('numpy')
+pytest.importorskip('torchvision')
+from unsuper.helper.encoder_decoder import get_encoder, get_decoder
+from unsuper.helper.latents import extract_latents, extract_reconstructions
+from unsuper.models import get_model
+
+#%%
+img_size = (1, 28, 28)
+
+def _setup(model_name='vitae_ci'):
+    torch.manual_seed(0)
+    model = get_model(model_name)(input_shape = img_size,
+                                  latent_dim = 2,
+                                  encoder = get_encoder('mlp'),
+                                  decoder = get_decoder('mlp'),
+                                  outputdensity = 'bernoulli',
+                                  ST_type = 'affine')
+    data = torch.utils.data.TensorDataset(torch.rand(23, *img_size),
+                                          torch.arange(23) % 10)
+    return model, data
+
+def _running_stats(model):
+    return [b.clone() for name, b in model.named_buffers() if 'running' in name]
+
+#%%
+@pytest.mark.parametrize('model_name', ['vae', 'vitae_ci', 'vitae_ui'])
+def test_latents_match_model_in_eval_mode(tmp_path, model_name):
+    model, data = _setup(model_name)
+    stats = _running_stats(model)
+    # Batch size that does not divide the number of points
+    latents, labels = extract_latents(model, data, img_size, batch_size=5,
+                                      memmap_dir=str(tmp_path))
+    assert model.training
+    assert all([torch.equal(s1, s2) for s1, s2 in zip(stats, _running_stats(model))])
+
+    model.eval()
+    with torch.no_grad():
+        expected = model.latent_representation(data.tensors[0])
+    for z, e in zip(latents, expected):
+        assert np.allclose(np.asarray(z), e.numpy(), atol=1e-6)
+    assert (labels == data.tensors[1].numpy()).all()
+
+def test_eval_mode_is_kept():
+    model, data = _setup()
+    model.eval()
+    extract_latents(model, data, img_size, batch_size=5, mode='semantics')
+    assert not model.training
+
+def test_mode_is_restored_after_an_error():
+    model, data = _setup()
+    with pytest.raises(AssertionError):
+        extract_latents(model, data, img_size, out=[np.empty((23, 2), dtype=np.float32)])
+    def broken(x):
+        raise RuntimeError('broken')
+    model.latent_representation = broken
+    with pytest.raises(RuntimeError):
+        extract_latents(model, data, img_size)
+    assert model.training
+
+def test_reconstructions(tmp_path):
+    model, data = _setup('vae')
+    recon, labels = extract_reconstructions(model, data, img_size, batch_size=7,
+                                            memmap_dir=str(tmp_path))
+    assert recon.shape == (23, 28*28) and recon.dtype == np.float32
+    assert ((recon >= 0) & (recon <= 1)).all()
+    assert model.training
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+#%%
+import pytest
+torch = pytest.importorskip('torch')
+from torch import nn
+from unsuper.helper.hooks import phase_timer
+from unsuper.helper.memory import activation_tracker, module_memory
+from unsuper.helper.utility import memconsumption
+
+#%%
+class _net(nn.Module):
+    def __init__(self):
+        super(_net, self).__init__()
+        self.encoder = nn.Linear(10, 20)
+        self.decoder = nn.Linear(20, 10)
+
+    def forward(self, x):
+        return self.decoder(self.encoder(x).relu())
+
+#%%
+def test_cpu_phases_are_recorded():
+    timer = phase_timer()
+    timer.track_memory = 'cpu'
+    with timer('forward'):
+        x = torch.zeros(2**20)
+    peaks = timer.reset_peaks()
+    assert peaks['forward'] > x.numel() * x.element_size()
+    assert timer.reset_peaks() == { }
+
+def test_module_memory_and_activations():
+    model = _net()
+    optimizer = torch.optim.Adam(model.parameters())
+    x = torch.randn(8, 10)
+    with activation_tracker(model) as tracker:
+        loss = model(x).pow(2).sum()
+    loss.backward()
+    optimizer.step()
+
+    report = module_memory(model, optimizer)
+    assert report['encoder']['params'] == (10*20 + 20) * 4
+    assert report['encoder']['grads'] == report['encoder']['params']
+    assert report['encoder']['optimizer'] >= 2 * report['encoder']['params']
+    # The decoder saves its input (8 x 20 floats) for the backward pass
+    assert tracker.bytes['decoder'] >= 8 * 20 * 4
+
+def test_memconsumption_signature(capsys):
+    # Without arguments, as before: all live tensors
+    t = torch.zeros(3, 5)
+    memconsumption()
+    assert 'torch.Size([3, 5])' in capsys.readouterr().out
+    totals = memconsumption(_net())
+    assert totals['params'] == (10*20 + 20 + 20*10 + 10) * 4
+    del t
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+#%%
+import os, gzip, hashlib, threading
+import pytest
+torch = pytest.importorskip('torch')
+np = pytest.importorskip('numpy')
+pytest.importorskip('PIL')
+pytest.importorskip('tqdm')
+pytest.importorskip('six')
+from unsuper.data import mnist_data
+from unsuper.data.mnist_data import MNIST
+
+#%%
+def _idx_images(images):
+    header = [2051, images.shape[0], images.shape[1], images.shape[2]]
+    return b''.join([h.to_bytes(4, 'big') for h in header]) + images.tobytes()
+
+def _idx_labels(labels):
+    header = [2049, labels.shape[0]]
+    return b''.join([h.to_bytes(4, 'big') for h in header]) + labels.tobytes()
+
+@pytest.fixture
+def mirror(tmp_path):
+    """ Small gzipped idx files in a local folder. Returns the file:// url of
+        the folder, the resources with their md5 checksums and the data """
+    rng = np.random.RandomState(0)
+    data = {'train': (rng.randint(0, 256, (6, 28, 28)).astype(np.uint8),
+                      np.array([0, 1, 1, 2, 0, 1], dtype=np.uint8)),
+            'test': (rng.randint(0, 256, (3, 28, 28)).astype(np.uint8),
+                     np.array([2, 0, 1], dtype=np.uint8))}
+    files = {'train-images-idx3-ubyte.gz': _idx_images(data['train'][0]),
+             'train-labels-idx1-ubyte.gz': _idx_labels(data['train'][1]),
+             't10k-images-idx3-ubyte.gz': _idx_images(data['test'][0]),
+             't10k-labels-idx1-ubyte.gz': _idx_labels(data['test'][1])}
+    folder = tmp_path / 'mirror'
+    folder.mkdir()
+    resources = [ ]
+    for filename, content in files.items():
+        with gzip.open(str(folder / filename), 'wb') as f:
+            f.write(content)
+        resources.append((filename, hashlib.md5((folder / filename).read_bytes()).hexdigest()))
+    return folder.as_uri(), resources, data
+
+@pytest.fixture
+def fetches(monkeypatch):
+    """ Records the urls that are fetched. All fetches must wait for each other
+        on a barrier, which only passes if the four files are downloaded
+        concurrently """
+    urls, barrier, fetch = [ ], threading.Barrier(4, timeout=10), mnist_data._fetch
+    def concurrent_fetch(url, fpath, chunk_size=1024 * 1024):
+        urls.append(url)
+        barrier.wait()
+        fetch(url, fpath, chunk_size)
+    monkeypatch.setattr(mnist_data, '_fetch', concurrent_fetch)
+    return urls
+
+#%%
+def test_download_from_file_mirror(tmp_path, monkeypatch, mirror, fetches):
+    url, resources, data = mirror
+    monkeypatch.setattr(MNIST, 'resources', resources)
+    root = str(tmp_path / 'root')
+    dataset = MNIST(root, train=True, download=True, classes=[0, 1],
+                    mirror=url, download_workers=4)
+
+    # Each file fetched once, concurrently, from the mirror
+    assert sorted(fetches) == sorted([url + '/' + f for f, _ in resources])
+
+    # Only the wanted classes, in the original order
+    images, labels = data['train']
+    keep = np.isin(labels, [0, 1])
+    assert (dataset.data.numpy() == images[keep]).all()
+    assert (dataset.targets.numpy() == labels[keep]).all()
+    test = MNIST(root, train=False, download=True, mirror=url)
+    assert (test.data.numpy() == data['test'][0]).all()
+    assert len(fetches) == 4 # already processed, so nothing is fetched again
+
+    # The gzip files are removed after extraction and no partial files remain
+    raw = os.listdir(os.path.join(root, 'MNIST', 'raw'))
+    assert not any([f.endswith('.gz') or f.endswith('.part') for f in raw])
+
+def test_download_md5_mismatch(tmp_path, monkeypatch, mirror, fetches):
+    url, resources, _ = mirror
+    resources[1] = (resources[1][0], 32 * '0')
+    monkeypatch.setattr(MNIST, 'resources', resources)
+    root = str(tmp_path / 'root')
+    with pytest.raises(RuntimeError, match='md5'):
+        MNIST(root, train=True, download=True, mirror=url, download_workers=4)
+
+    # The corrupt file is removed and nothing is processed
+    raw = os.listdir(os.path.join(root, 'MNIST', 'raw'))
+    assert resources[1][0] not in raw
+    assert not any([f.endswith('.part') for f in raw])
+    assert not os.listdir(os.path.join(root, 'MNIST', 'processed'))
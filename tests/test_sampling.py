@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+#%%
+import pytest
+torch = pytest.importorskip('torch')
+from unsuper.helper.sampling import gaussian_sampler
+
+#%%
+def _params(batch_size=4, latent_dim=3):
+    mu = torch.randn(batch_size, latent_dim, requires_grad=True)
+    var = torch.rand(batch_size, latent_dim).add(0.5).requires_grad_()
+    return mu, var
+
+#%%
+@pytest.mark.parametrize('noise', ['normal', 'antithetic', 'sobol'])
+def test_noise_is_standard_normal(noise):
+    torch.manual_seed(0)
+    eps = gaussian_sampler(noise).sample_noise(64, 64, 2, 'cpu')
+    assert eps.shape == (64, 64, 2)
+    assert eps.mean().abs() < 0.05
+    assert (eps.var() - 1).abs() < 0.05
+
+def test_antithetic_pairs():
+    torch.manual_seed(0)
+    for n_samples in [2, 5]:
+        eps = gaussian_sampler('antithetic').sample_noise(3, n_samples, 2, 'cpu')
+        half = (n_samples + 1) // 2
+        assert torch.equal(eps[:, half:], -eps[:, :n_samples-half])
+
+def test_sobol_is_more_uniform_than_normal():
+    # Quasi random points have a smaller error of the sample mean
+    torch.manual_seed(0)
+    err = {noise: torch.stack([gaussian_sampler(noise).sample_noise(1, 256, 1, 'cpu').mean()
+                               for _ in range(20)]).abs().mean()
+           for noise in ['normal', 'sobol']}
+    assert err['sobol'] < err['normal']
+
+@pytest.mark.parametrize('noise', ['normal', 'antithetic', 'sobol'])
+def test_samples_are_reparameterized(noise):
+    torch.manual_seed(0)
+    mu, var = _params()
+    sampler = gaussian_sampler(noise)
+    z = sampler(mu, var, eq_samples=2, iw_samples=3)
+    assert z.shape == (4*6, 3)
+    z.sum().backward()
+    assert torch.allclose(mu.grad, torch.full_like(mu, 6.0))
+    assert var.grad is not None
+
+#%%
+def test_two_forwards_before_backward():
+    # The graph of the first call must still be valid after the second call
+    torch.manual_seed(0)
+    mu, var = _params()
+    sampler = gaussian_sampler()
+    z1 = sampler(mu, var, 1, 4)
+    z2 = sampler(mu, var, 1, 4)
+    (z1**2 + z2**2).sum().backward()
+    assert not torch.equal(z1, z2)
+
+def test_buffer_is_reused_without_autograd():
+    torch.manual_seed(0)
+    mu, var = _params()
+    sampler = gaussian_sampler()
+    with torch.no_grad():
+        z1 = sampler(mu, var, 1, 8)
+        ptr = sampler._eps.data_ptr()
+        z2 = sampler(mu, var, 1, 4) # smaller batch, same buffer
+        assert sampler._eps.data_ptr() == ptr
+    assert not torch.equal(z1[:16], z2)
+    # Training after evaluation does not touch the buffer
+    sampler(mu, var, 1, 8).sum().backward()
+    assert sampler._eps.data_ptr() == ptr
+
+def test_first_call_under_inference_mode():
+    mu, var = _params()
+    sampler = gaussian_sampler()
+    with torch.inference_mode():
+        sampler(mu, var)
+    with torch.no_grad():
+        sampler(mu, var)
+    sampler(mu, var).sum().backward()
+
+@pytest.mark.parametrize('noise', ['normal', 'antithetic'])
+def test_compiles_without_graph_breaks(noise):
+    if not hasattr(torch, 'compile'):
+        pytest.skip('torch.compile not available')
+    torch.manual_seed(0)
+    mu, var = _params()
+    sampler = gaussian_sampler(noise)
+    fn = torch.compile(lambda m, v: sampler(m, v, 2, 2), fullgraph=True, backend='eager')
+    z = fn(mu, var)
+    z.sum().backward()
+    assert z.shape == (16, 3)
+    assert torch.allclose(mu.grad, torch.full_like(mu, 4.0))
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+#%%
+import pytest
+torch = pytest.importorskip('torch')
+from unsuper.helper.schedulers import kl_annealing, switch_schedule, get_lr_scheduler
+
+#%%
+def test_constant_annealing():
+    assert [kl_annealing('constant')(s) for s in [1, 5, 100]] == [1.0, 1.0, 1.0]
+
+def test_linear_annealing():
+    schedule = kl_annealing('linear', warmup_steps=4)
+    assert [schedule(s) for s in range(1, 7)] == [0.25, 0.5, 0.75, 1.0, 1.0, 1.0]
+    # No warmup gives the full weight from the first step
+    assert kl_annealing('linear', warmup_steps=0)(1) == 1.0
+
+def test_cyclical_annealing():
+    schedule = kl_annealing('cyclical', cycle_steps=4, ratio=0.5)
+    weights = [schedule(s) for s in range(1, 13)]
+    assert weights == 3*[0.5, 1.0, 1.0, 1.0]
+
+def test_annealing_arguments():
+    with pytest.raises(AssertionError):
+        kl_annealing('cyclical')
+    with pytest.raises(AssertionError):
+        kl_annealing('exponential')
+
+#%%
+def test_switch_jumps_after_start():
+    schedule = switch_schedule(start_steps=3)
+    assert [schedule(s) for s in range(1, 6)] == [0.0, 0.0, 0.0, 1.0, 1.0]
+    assert switch_schedule()(1) == 1.0
+
+def test_switch_ramp():
+    schedule = switch_schedule(start_steps=2, ramp_steps=4)
+    assert [schedule(s) for s in range(1, 9)] == [0.0, 0.0, 0.25, 0.5, 0.75, 1.0, 1.0, 1.0]
+
+#%%
+def _optimizer(lr=0.1):
+    return torch.optim.SGD([torch.nn.Parameter(torch.zeros(1))], lr=lr)
+
+def _lrs(scheduler, optimizer, n_steps):
+    lrs = [ ]
+    for _ in range(n_steps):
+        lrs.append(optimizer.param_groups[0]['lr'])
+        optimizer.step()
+        scheduler.step()
+    return lrs
+
+def test_constant_lr():
+    assert get_lr_scheduler('constant', _optimizer(), 10) is None
+
+def test_cosine_lr():
+    optimizer = _optimizer()
+    lrs = _lrs(get_lr_scheduler('cosine', optimizer, 10), optimizer, 10)
+    assert lrs[0] == pytest.approx(0.1)
+    assert all([l1 > l2 for l1, l2 in zip(lrs[:-1], lrs[1:])])
+    assert optimizer.param_groups[0]['lr'] == pytest.approx(0.0, abs=1e-8)
+
+def test_onecycle_lr_peaks_at_the_optimizer_lr():
+    optimizer = _optimizer()
+    # OneCycleLR fails if it is stepped more than total_steps times
+    lrs = _lrs(get_lr_scheduler('onecycle', optimizer, 20), optimizer, 20)
+    assert max(lrs) == pytest.approx(0.1)
+    assert lrs[0] < 0.1 and lrs[-1] < lrs[0]
+
+#%%
+def test_trainer_applies_schedules_every_step(tmp_path):
+    pytest.importorskip('tensorboardX')
+    pytest.importorskip('torchvision')
+    from unsuper.trainer import vae_trainer
+    from unsuper.models import get_model
+    from unsuper.helper.encoder_decoder import get_encoder, get_decoder
+    torch.manual_seed(0)
+    img_size = (1, 28, 28)
+    model = get_model('vae')(input_shape = img_size,
+                             latent_dim = 2,
+                             encoder = get_encoder('mlp'),
+                             decoder = get_decoder('mlp'),
+                             outputdensity = 'bernoulli',
+                             ST_type = 'affine')
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+    trainer = vae_trainer(img_size, model, optimizer)
+    calls = [ ]
+    train_step = trainer.train_step
+    def recording_step(data, eq_samples, iw_samples, switch, kl_weight):
+        calls.append((switch, kl_weight))
+        return train_step(data, eq_samples, iw_samples, switch, kl_weight=kl_weight)
+    trainer.train_step = recording_step
+
+    data = torch.utils.data.TensorDataset(torch.rand(30, *img_size).round(), torch.zeros(30))
+    trainloader = torch.utils.data.DataLoader(data, batch_size=10)
+    # 3 steps per epoch, and the default schedules follow the warmup epoch
+    trainer.fit(trainloader, n_epochs=2, warmup=1, logdir=str(tmp_path), beta=0.5,
+                lr_scheduler=get_lr_scheduler('cosine', optimizer, 6))
+    switches, kl_weights = zip(*calls)
+    assert switches == (0.0, 0.0, 0.0, 1.0, 1.0, 1.0)
+    assert kl_weights == pytest.approx([0.5/3, 1.0/3, 0.5, 0.5, 0.5, 0.5])
+    assert optimizer.param_groups[0]['lr'] == pytest.approx(0.0, abs=1e-8)
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+#%%
+import json, threading, urllib.request, urllib.error
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+torch = pytest.importorskip('torch')
+pytest.importorskip('torchvision')
+from unsuper.helper.encoder_decoder import get_encoder, get_decoder
+from unsuper.models import get_model
+from unsuper.helper.export import reconstruction_graph
+from unsuper.serving import inference_server, micro_batcher
+
+#%%
+img_size = (1, 28, 28)
+n_clients = 12
+
+@pytest.fixture
+def server():
+    torch.manual_seed(0)
+    model = get_model('vae')(input_shape = img_size,
+                             latent_dim = 2,
+                             encoder = get_encoder('mlp'),
+                             decoder = get_decoder('mlp'),
+                             outputdensity = 'bernoulli')
+    # Port 0 binds an ephemeral port. A long max_latency such that the
+    # concurrent requests end up in the same micro batches
+    server = inference_server(model, img_size, port=0, max_batch_size=16,
+                              max_latency=0.2).start()
+    yield server
+    server.shutdown()
+
+def _post(server, path, body):
+    url = 'http://{0}:{1}{2}'.format(*server.address, path)
+    req = urllib.request.Request(url, data=json.dumps(body).encode(),
+                                 headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(req, timeout=30) as res:
+        return json.loads(res.read())
+
+def _get(server, path):
+    url = 'http://{0}:{1}{2}'.format(*server.address, path)
+    with urllib.request.urlopen(url, timeout=30) as res:
+        return json.loads(res.read())
+
+def _concurrent(fn, args):
+    # All clients wait on the barrier, such that the requests arrive together
+    barrier = threading.Barrier(len(args))
+    def call(a):
+        barrier.wait()
+        return fn(a)
+    with ThreadPoolExecutor(len(args)) as pool:
+        return list(pool.map(call, args))
+
+#%%
+def test_concurrent_encode_matches_model(server):
+    torch.manual_seed(1)
+    # Requests of different sizes, such that the split of a batch is tested
+    xs = [torch.rand(1 + i % 3, *img_size) for i in range(n_clients)]
+    results = _concurrent(lambda x: _post(server, '/encode', {'data': x.tolist()}), xs)
+
+    with torch.no_grad():
+        for x, res in zip(xs, results):
+            z = server.model.latent_representation(x)[0]
+            assert torch.allclose(torch.tensor(res['latents'][0]), z, atol=1e-5)
+
+    metrics = _get(server, '/metrics')['encode']
+    assert metrics['requests'] == n_clients
+    assert metrics['items'] == sum([x.shape[0] for x in xs])
+    assert metrics['batches'] < n_clients
+    assert metrics['largest_batch_size'] <= 16
+
+def test_concurrent_reconstruct_matches_model(server):
+    torch.manual_seed(2)
+    xs = [torch.rand(3, *img_size) for _ in range(n_clients)]
+    results = _concurrent(lambda x: _post(server, '/reconstruct', {'data': x.tolist()}), xs)
+    with torch.no_grad():
+        for x, res in zip(xs, results):
+            # Deterministic, through the latent means
+            rec = reconstruction_graph(server.model)(x)
+            assert torch.allclose(torch.tensor(res['reconstruction']), rec, atol=1e-5)
+    # 36 images can not fit in one micro batch of 16
+    metrics = _get(server, '/metrics')['reconstruct']
+    assert metrics['items'] == 3*n_clients
+    assert metrics['largest_batch_size'] <= 16
+
+def test_large_requests_are_split(server):
+    torch.manual_seed(3)
+    x = torch.rand(40, *img_size)
+    res = _post(server, '/encode', {'data': x.tolist()})
+    with torch.no_grad():
+        z = server.model.latent_representation(x)[0]
+    assert torch.allclose(torch.tensor(res['latents'][0]), z, atol=1e-5)
+
+    results = _concurrent(lambda n: _post(server, '/sample', {'n': n}), [1, 5, 37, 16])
+    for n, res in zip([1, 5, 37, 16], results):
+        assert torch.tensor(res['samples']).shape == (n, *img_size)
+    assert _get(server, '/metrics')['sample']['largest_batch_size'] <= 16
+
+    with pytest.raises(urllib.error.HTTPError) as e:
+        _post(server, '/sample', {'n': 0})
+    assert e.value.code == 400
+
+def test_unknown_endpoint(server):
+    with pytest.raises(urllib.error.HTTPError) as e:
+        _post(server, '/does_not_exist', {})
+    assert e.value.code == 404
+
+#%%
+def test_micro_batcher_results_and_errors():
+    batches = [ ]
+    def fn(payloads):
+        batches.append(len(payloads))
+        if -1 in payloads:
+            raise ValueError('bad payload')
+        return [2*p for p in payloads]
+
+    batcher = micro_batcher(fn, max_batch_size=4, max_latency=0.2)
+    try:
+        results = _concurrent(lambda p: batcher.submit(p).result(timeout=30), list(range(10)))
+        assert results == [2*p for p in range(10)]
+        # The maximum batch size is respected, and requests are coalesced
+        assert max(batches) <= 4 and len(batches) < 10
+
+        # An exception is passed on to all requests in the batch
+        with pytest.raises(ValueError):
+            batcher.submit(-1).result(timeout=30)
+        assert batcher.metrics.summary()['requests'] == 11
+    finally:
+        batcher.close()
+
+def test_micro_batcher_respects_max_batch_size():
+    batches = [ ]
+    def fn(payloads):
+        batches.append(sum(payloads))
+        return payloads
+
+    batcher = micro_batcher(fn, max_batch_size=8, max_latency=0.2)
+    try:
+        # Multi item requests, the payload is the size of the request
+        sizes = [3, 5, 2, 7, 1, 8, 4, 6, 3, 2]
+        results = _concurrent(lambda n: batcher.submit(n, n).result(timeout=30), sizes)
+        assert results == sizes
+        assert max(batches) <= 8 and sum(batches) == sum(sizes)
+        assert batcher.metrics.summary()['largest_batch_size'] <= 8
+        with pytest.raises(ValueError):
+            batcher.submit(9, 9)
+    finally:
+        batcher.close()
+
+def test_micro_batcher_close_resolves_all_requests():
+    release = threading.Event()
+    def fn(payloads):
+        release.wait(timeout=30)
+        return payloads
+
+    batcher = micro_batcher(fn, max_batch_size=2, max_latency=0.0)
+    # The first batch blocks the worker, the rest is still queued on close
+    futures = [batcher.submit(i) for i in range(7)]
+    closer = threading.Thread(target=batcher.close)
+    closer.start()
+    release.set()
+    closer.join(timeout=30)
+    assert not closer.is_alive()
+    for i, f in enumerate(futures):
+        assert f.result(timeout=1) == i
+    with pytest.raises(RuntimeError):
+        batcher.submit(7)
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+#%%
+import pytest
+torch = pytest.importorskip('torch')
+np = pytest.importorskip('numpy')
+from unsuper.helper.statistics import batch_statistics
+from unsuper.helper.traversal import traversal_renderer
+
+#%%
+def test_should_log_counts_epochs():
+    stats = batch_statistics(every=3)
+    # Sparse and repeated evaluations, as with the convergence monitor
+    logged = [e for e in [1, 1, 2, 3, 4, 4, 6, 7, 11, 12, 20] if stats.should_log(e)]
+    assert logged == [1, 4, 7, 11, 20]
+
+def test_should_log_every_epoch():
+    stats = batch_statistics()
+    assert [stats.should_log(e) for e in [1, 2, 2, 3]] == [True, True, False, True]
+
+def test_compute_matches_numpy():
+    torch.manual_seed(0)
+    values = torch.randn(500, 4) * torch.tensor([1.0, 2.0, 0.1, 5.0])
+    values[:, 2] = 3.0 # constant column
+    stats = batch_statistics(bins=10).compute(values)
+    v = values.numpy()
+    assert np.allclose(stats['mean'].numpy(), v.mean(0), atol=1e-5)
+    assert np.allclose(stats['min'].numpy(), v.min(0)) and np.allclose(stats['max'].numpy(), v.max(0))
+    assert np.allclose(stats['sum_squares'].numpy(), (v**2).sum(0), rtol=1e-5)
+    assert (stats['bucket_counts'].sum(1) == 500).all()
+    for j in [0, 1, 3]:
+        counts, _ = np.histogram(v[:, j], bins=10, range=(v[:, j].min(), v[:, j].max()))
+        assert (np.abs(stats['bucket_counts'][j].numpy() - counts) <= 1).all()
+
+def test_tags_of_2d_latent_spaces_are_unchanged():
+    assert traversal_renderer.tag(2) == 'meshgrid'
+    assert traversal_renderer.tag(5) == 'traversal'
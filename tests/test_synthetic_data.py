@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+#%%
+import os
+import pytest
+torch = pytest.importorskip('torch')
+np = pytest.importorskip('numpy')
+pytest.importorskip('torchvision')
+from unsuper.data.synthetic_data import generate_dataset, SYNTHETIC
+from unsuper.helper.encoder_decoder import get_encoder, get_decoder
+from unsuper.helper.export import decoder_graph
+from unsuper.models import get_model
+
+#%%
+img_size = (1, 28, 28)
+
+def _model(model_name):
+    torch.manual_seed(0)
+    return get_model(model_name)(input_shape = img_size,
+                                 latent_dim = 2,
+                                 encoder = get_encoder('mlp'),
+                                 decoder = get_decoder('mlp'),
+                                 outputdensity = 'bernoulli',
+                                 ST_type = 'affine')
+
+def _expected(model, dataset):
+    """ The images decoded from the stored latent codes """
+    model.eval()
+    with torch.no_grad():
+        x = decoder_graph(model)(*[torch.tensor(np.asarray(z)) for z in dataset.latent])
+    model.train()
+    return x
+
+#%%
+@pytest.mark.parametrize('model_name', ['vae', 'vitae_ci'])
+def test_round_trip_float32(tmp_path, model_name):
+    model = _model(model_name)
+    # Batch size that does not divide the number of points
+    dataset = generate_dataset(model, 23, str(tmp_path), batch_size=10)
+    assert model.training
+    assert len(dataset) == 23 and len(dataset.latent) == model.latent_spaces
+    assert dataset.data.dtype == torch.float32
+    assert torch.allclose(dataset.data, _expected(model, dataset), atol=1e-6)
+
+    # Reloading the files gives the same data, and items are float images
+    reloaded = SYNTHETIC(str(tmp_path))
+    assert torch.equal(reloaded.data, dataset.data)
+    img, target = reloaded[3]
+    assert img.dtype == torch.float32 and img.shape == img_size and target == 0
+
+@pytest.mark.parametrize('dtype, atol', [('float16', 1e-3), ('uint8', 0.5/255 + 1e-6)])
+def test_round_trip_reduced_precision(tmp_path, dtype, atol):
+    model = _model('vae')
+    dataset = generate_dataset(model, 12, str(tmp_path), batch_size=5, dtype=dtype)
+    images = torch.stack([dataset[i][0] for i in range(len(dataset))])
+    assert images.dtype == torch.float32
+    assert torch.allclose(images, _expected(model, dataset).clamp(0, 1), atol=atol)
+    assert os.path.getsize(os.path.join(str(tmp_path), 'images.npy')) < 12*28*28*4
+
+def test_unknown_dtype(tmp_path):
+    with pytest.raises(AssertionError):
+        generate_dataset(_model('vae'), 3, str(tmp_path), dtype='int16')
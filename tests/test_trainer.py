@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+#%%
+import pytest
+torch = pytest.importorskip('torch')
+pytest.importorskip('tensorboardX')
+pytest.importorskip('torchvision')
+from torch import nn
+from unsuper.trainer import vae_trainer
+from unsuper.models import get_model
+from unsuper.helper.encoder_decoder import get_encoder, get_decoder
+from unsuper.helper.sampling import gaussian_sampler
+
+#%%
+img_size = (1, 28, 28)
+
+@pytest.fixture(autouse=True)
+def fixed_noise(monkeypatch):
+    """ The same noise for every data point, such that runs that split the
+        batch differently or draw from the generator in another order still
+        see the same samples """
+    def sample_noise(self, batch_size, n_samples, latent_dim, device, dtype=torch.float32):
+        eps = torch.linspace(-1.5, 1.5, n_samples*latent_dim, device=device, dtype=dtype)
+        return eps.reshape(1, n_samples, latent_dim).expand(batch_size, -1, -1)
+    monkeypatch.setattr(gaussian_sampler, 'sample_noise', sample_noise)
+
+def _model(model_name='vae', **kwargs):
+    torch.manual_seed(0)
+    return get_model(model_name)(input_shape = img_size,
+                                 latent_dim = 2,
+                                 encoder = get_encoder('mlp'),
+                                 decoder = get_decoder('mlp'),
+                                 outputdensity = 'bernoulli',
+                                 ST_type = 'affinediff',
+                                 **kwargs)
+
+def _data(batch_size=10):
+    torch.manual_seed(1)
+    return torch.rand(batch_size, *img_size).round()
+
+def _step(model, data, estimator='iwae', **kwargs):
+    """ Loss and gradients of one training step (the optimizer has lr 0, such
+        that the step does not change the model) """
+    trainer = vae_trainer(img_size, model, torch.optim.SGD(model.parameters(), lr=0.0),
+                          estimator=estimator, **kwargs)
+    loss, recon, kl = trainer.train_step(data, 1, 2, 0.7, kl_weight=0.5)
+    grads = torch.cat([p.grad.flatten() if p.grad is not None else torch.zeros(p.numel())
+                       for p in model.parameters()])
+    return torch.stack([loss, recon] + list(kl)), grads
+
+def _assert_same(a, b, rtol=1e-5, atol=1e-6):
+    for x, y in zip(a, b):
+        assert torch.allclose(x, y, rtol=rtol, atol=atol), (x - y).abs().max().item()
+
+#%%
+def _compile_works():
+    if not hasattr(torch, 'compile'):
+        return False
+    try:
+        torch.compile(lambda x: 2*x + 1)(torch.ones(3))
+        return True
+    except Exception:
+        return False
+
+@pytest.mark.filterwarnings('error::RuntimeWarning') # no silent fallback to eager
+@pytest.mark.parametrize('model_name', ['vae', 'vitae_ci'])
+def test_compiled_step_matches_eager(model_name):
+    if not _compile_works():
+        pytest.skip('torch.compile does not work on this machine')
+    data = _data()
+    reference = _step(_model(model_name), data)
+    model = _model(model_name)
+    compiled = _step(model, data, compile_mode='default')
+    _assert_same(reference, compiled, rtol=1e-4, atol=1e-5)
+
+#%%
+def _freeze_batchnorm(model):
+    # Batchnorm in train mode normalizes with the statistics of each chunk,
+    # which is the documented difference to a full batch step
+    for m in model.modules():
+        if isinstance(m, nn.modules.batchnorm._BatchNorm): m.eval()
+    return model
+
+@pytest.mark.parametrize('estimator', ['iwae', 'dreg'])
+@pytest.mark.parametrize('model_name', ['vae', 'vitae_ci', 'vitae_ui'])
+def test_micro_batches_match_full_batch(model_name, estimator):
+    data = _data(10)
+    reference = _step(_freeze_batchnorm(_model(model_name)), data, estimator)
+    # Chunks of 4, 4 and 2
+    chunked = _step(_freeze_batchnorm(_model(model_name)), data, estimator,
+                    micro_batch_size=4)
+    _assert_same(reference, chunked)
+
+def test_micro_batch_larger_than_batch():
+    data = _data(10)
+    _assert_same(_step(_model(), data), _step(_model(), data, micro_batch_size=32))
+
+#%%
+@pytest.mark.parametrize('model_name, checkpoint', [('vae', ['encoder', 'decoder']),
+                                                    ('vitae_ci', ['encoder', 'decoder', 'stn']),
+                                                    ('vitae_ui', ['stn'])])
+def test_checkpointing_matches_plain_step(model_name, checkpoint):
+    data = _data()
+    reference = _step(_model(model_name), data)
+    checkpointed = _step(_model(model_name, checkpoint=checkpoint), data)
+    _assert_same(reference, checkpointed)
+
+def test_checkpointing_with_micro_batches():
+    data = _data(10)
+    reference = _step(_freeze_batchnorm(_model('vitae_ci')), data)
+    model = _freeze_batchnorm(_model('vitae_ci', checkpoint=['encoder', 'stn']))
+    _assert_same(reference, _step(model, data, micro_batch_size=3))
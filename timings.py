@@ -53,6 +53,7 @@ def argparser():
     ds.add_argument('--num_points', type=int, default=10000, help='number of points in each class')
     ds.add_argument('--logdir', type=str, default='beta_final8', help='where to store results')
     ds.add_argument('--dataset', type=str, default='mnist', help='dataset to use')
+    ds.add_argument('--cache_dir', type=str, default='', help='where preprocessed datasets are cached (e.g. unsuper/data/cache), empty string to disable')
     
     # Parse and return
     args = parser.parse_args()
@@ -70,7 +71,8 @@ trainloader, testloader = mnist_data_loader(root='unsuper/data',
                                             download=True,
                                             classes=args.classes,
                                             num_points=args.num_points,
-                                            batch_size=args.batch_size)
+                                            batch_size=args.batch_size,
+                                            cache_dir=args.cache_dir or None)
 img_size = (1, 28, 28)
 
 # Construct model
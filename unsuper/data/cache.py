@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#%%
+import os, hashlib, json, tempfile
+import torch
+import torch.utils.data as data
+
+#%%
+def _flatten(transform):
+    """ All transforms inside (possibly nested) Compose objects """
+    if hasattr(transform, 'transforms'):
+        return sum([_flatten(t) for t in transform.transforms], [ ])
+    return [transform]
+
+#%%
+def transform_spec(transform):
+    """ String that identifies a transform, or None if its output can not be
+        cached. That is the case for random transforms, and for Lambda
+        transforms, whose repr is the same for every function """
+    if transform is None:
+        return 'None'
+    for t in _flatten(transform):
+        name = type(t).__name__
+        if name.startswith('Random') or name == 'Lambda':
+            return None
+    return repr(transform)
+
+#%%
+def file_digest(path, chunk_size=1024 * 1024):
+    """ sha256 of the contents of a file, read in chunks """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+#%%
+def cache_key(source, **spec):
+    """ Hash of the contents of the source file and the specification of how
+        the dataset was made from it. The key only depends on the contents, 
+        so a copied or touched source still hits the cache, and a changed
+        source never does """
+    spec = dict(spec, source=file_digest(source))
+    return hashlib.sha256(json.dumps(spec, sort_keys=True, default=str).encode()).hexdigest()
+
+#%%
+def _materialize(dataset, batch_size=1024):
+    """ All (image, target) pairs of a dataset as two tensors """
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size)
+    imgs, targets = [ ], [ ]
+    for x, y in loader:
+        imgs.append(x)
+        targets.append(torch.as_tensor(y))
+    return torch.cat(imgs), torch.cat(targets)
+
+#%%
+def _load(path):
+    try:
+        return torch.load(path, mmap=True)
+    except TypeError: # older torch without mmap
+        return torch.load(path)
+
+#%%
+def _save(obj, path):
+    """ Writes to a temporary file in the same folder and renames it, such that
+        concurrent readers never see a partially written file, and concurrent
+        writers of the same key just replace each other's identical files """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            torch.save(obj, f)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp): os.unlink(tmp)
+        raise
+
+#%%
+def cached_dataset(cache_dir, source, build, **spec):
+    """ Loads the tensors of a dataset (after class filtering, capping of the
+        number of points and transforms) from a cache on disk, and only builds
+        the dataset if they are not found
+    Arguments:
+        cache_dir: str, folder of the cache (None disables the cache)
+        source: str, file the dataset is made from (may not exist before build)
+        build: function without arguments that constructs the dataset
+        spec: everything else that determines the dataset, e.g. train, classes,
+            num_points, transform (random and Lambda transforms are never
+            cached)
+    Output:
+        dataset: TensorDataset with the final images and targets, or the built
+            dataset if it can not be cached
+    """
+    spec = {k: transform_spec(v) if 'transform' in k else v for k, v in spec.items()}
+    if cache_dir is None or None in spec.values():
+        return build()
+    if not os.path.exists(cache_dir): os.makedirs(cache_dir, exist_ok=True)
+
+    # The source may only exist after build (e.g. when it downloads it)
+    path = lambda: os.path.join(cache_dir, cache_key(source, **spec) + '.pt')
+    cached = path() if os.path.exists(source) else None
+    if cached is not None and os.path.exists(cached):
+        imgs, targets = _load(cached)
+        return data.TensorDataset(imgs, targets)
+
+    dataset = build()
+    imgs, targets = _materialize(dataset)
+    _save((imgs, targets), cached or path())
+    return data.TensorDataset(imgs, targets)
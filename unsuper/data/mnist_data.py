@@ -17,6 +17,8 @@ import torch
 import codecs
 import errno
 import hashlib
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
 #%%
@@ -58,9 +60,25 @@ def makedir_exist_ok(dirpath):
             raise
 
 #%%
-def download_url(url, root, filename, md5):
+def _fetch(url, fpath, chunk_size=1024 * 1024):
+    """ Streams url (http(s):// or file://) to a temporary file next to fpath,
+        which is renamed to fpath when complete """
     from six.moves import urllib
+    tmp = fpath + '.part'
+    try:
+        with urllib.request.urlopen(url) as response, open(tmp, 'wb') as f:
+            total = response.headers.get('Content-Length') if response.headers else None
+            with tqdm(desc=os.path.basename(fpath), total=int(total) if total else None,
+                      unit='B', unit_scale=True) as pbar:
+                for chunk in iter(lambda: response.read(chunk_size), b''):
+                    f.write(chunk)
+                    pbar.update(len(chunk))
+        os.replace(tmp, fpath)
+    finally:
+        if os.path.exists(tmp): os.unlink(tmp)
 
+#%%
+def download_url(url, root, filename, md5):
     root = os.path.expanduser(root)
     fpath = os.path.join(root, filename)
 
@@ -69,21 +87,21 @@ def download_url(url, root, filename, md5):
     # downloads file
     if os.path.isfile(fpath) and check_integrity(fpath, md5):
         print('Using downloaded and verified file: ' + fpath)
-    else:
-        try:
-            print('Downloading ' + url + ' to ' + fpath)
-            urllib.request.urlretrieve(
-                url, fpath,
-                reporthook=gen_bar_updater(tqdm(unit='B', unit_scale=True))
-            )
-        except:
-            if url[:5] == 'https':
-                url = url.replace('https:', 'http:')
-                print('Failed download. Trying https -> http instead.'
-                      ' Downloading ' + url + ' to ' + fpath)
-                urllib.request.urlretrieve(
-                    url, fpath,
-                    reporthook=gen_bar_updater(tqdm(unit='B', unit_scale=True)))
+        return
+    try:
+        print('Downloading ' + url + ' to ' + fpath)
+        _fetch(url, fpath)
+    except Exception:
+        if url[:5] != 'https':
+            raise
+        url = url.replace('https:', 'http:')
+        print('Failed download. Trying https -> http instead.'
+              ' Downloading ' + url + ' to ' + fpath)
+        _fetch(url, fpath)
+    if not check_integrity(fpath, md5):
+        os.unlink(fpath)
+        raise RuntimeError('Downloaded file ' + fpath + ' from ' + url + 
+                           ' does not match its md5 checksum')
 
 #%%
 def get_int(b):
@@ -113,23 +131,32 @@ def read_label_file(path):
 class MNIST(data.Dataset):
     """ Specialized version of the torchvision.datasets.MNIST class that takes
         one additional argument "classes". This is a list of the classes that
-        should be included in the dataset.
+        should be included in the dataset. The raw files are downloaded from
+        mirror, which is either a base url (http(s):// or file:// for a local
+        copy) or a function that maps a filename to its url. The files are
+        fetched concurrently by download_workers threads and checked against
+        their md5 checksums.
     """
-    urls = [
-        'http://yann.lecun.com/exdb/mnist/train-images-idx3-ubyte.gz',
-        'http://yann.lecun.com/exdb/mnist/train-labels-idx1-ubyte.gz',
-        'http://yann.lecun.com/exdb/mnist/t10k-images-idx3-ubyte.gz',
-        'http://yann.lecun.com/exdb/mnist/t10k-labels-idx1-ubyte.gz',
+    mirror = 'http://yann.lecun.com/exdb/mnist/'
+    resources = [
+        ('train-images-idx3-ubyte.gz', 'f68b3c2dcbeaaa9fbdd348bbdeb94873'),
+        ('train-labels-idx1-ubyte.gz', 'd53e105ee54ea40749a09fcbcd1e9432'),
+        ('t10k-images-idx3-ubyte.gz', '9fb629c4189551a2d022fa330f9573f3'),
+        ('t10k-labels-idx1-ubyte.gz', 'ec29112dd5afa0611ce80d1b7f02629c'),
     ]
     training_file = 'training.pt'
     test_file = 'test.pt'
 
     def __init__(self, root, train=True, transform=None, target_transform=None, 
-                 download=False, classes=[0,1,2,3,4,5,6,7,8,9], num_points = 20000):
+                 download=False, classes=[0,1,2,3,4,5,6,7,8,9], num_points = 20000,
+                 mirror=None, download_workers=4):
         self.root = os.path.expanduser(root)
         self.transform = transform
         self.target_transform = target_transform
         self.train = train  # training set or test set
+        if mirror is not None:
+            self.mirror = mirror
+        self.download_workers = download_workers
 
         if download:
             self.download()
@@ -201,15 +228,30 @@ class MNIST(data.Dataset):
         return os.path.exists(os.path.join(self.processed_folder, self.training_file)) and \
             os.path.exists(os.path.join(self.processed_folder, self.test_file))
 
+    @property
+    def urls(self):
+        return [self.url(filename) for filename, _ in self.resources]
+
+    def url(self, filename):
+        if callable(self.mirror):
+            return self.mirror(filename)
+        return self.mirror.rstrip('/') + '/' + filename
+
     @staticmethod
-    def extract_gzip(gzip_path, remove_finished=False):
+    def extract_gzip(gzip_path, remove_finished=False, chunk_size=1024 * 1024):
         print('Extracting {}'.format(gzip_path))
+        # Decompressed in chunks, such that the file is never fully in memory
         with open(gzip_path.replace('.gz', ''), 'wb') as out_f, \
                 gzip.GzipFile(gzip_path) as zip_f:
-            out_f.write(zip_f.read())
+            shutil.copyfileobj(zip_f, out_f, chunk_size)
         if remove_finished:
             os.unlink(gzip_path)
 
+    def _download_file(self, filename, md5):
+        download_url(self.url(filename), root=self.raw_folder, filename=filename, md5=md5)
+        self.extract_gzip(gzip_path=os.path.join(self.raw_folder, filename), 
+                          remove_finished=True)
+
     def download(self):
         """Download the MNIST data if it doesn't exist in processed_folder already."""
 
@@ -219,12 +261,12 @@ class MNIST(data.Dataset):
         makedir_exist_ok(self.raw_folder)
         makedir_exist_ok(self.processed_folder)
 
-        # download files
-        for url in self.urls:
-            filename = url.rpartition('/')[2]
-            file_path = os.path.join(self.raw_folder, filename)
-            download_url(url, root=self.raw_folder, filename=filename, md5=None)
-            self.extract_gzip(gzip_path=file_path, remove_finished=True)
+        # download and extract files concurrently
+        with ThreadPoolExecutor(max_workers=self.download_workers) as pool:
+            futures = [pool.submit(self._download_file, filename, md5)
+                       for filename, md5 in self.resources]
+            for future in futures:
+                future.result() # raises errors of the workers
 
         # process and save as torch files
         print('Processing...')
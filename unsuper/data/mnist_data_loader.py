@@ -6,21 +6,35 @@ Created on Mon Oct 15 12:16:57 2018
 """
 #%%
 import torch
+import os
 from .mnist_data import MNIST
+from .cache import cached_dataset
 
 #%%
 def mnist_data_loader(root, transform=None, target_transform=None, 
                       download=False, batch_size=128, 
-                      classes=[0,1,2,3,4,5,6,7,8,9], num_points=10000):
-    # Load dataset
-    train = MNIST(root=root, train=True, transform=transform, download=download,
-                  target_transform=target_transform, classes=classes, num_points=num_points)
+                      classes=[0,1,2,3,4,5,6,7,8,9], num_points=10000,
+                      distributed=False, cache_dir=None):
+    # Load dataset (from the cache of preprocessed tensors, if given)
+    spec = dict(classes=classes, num_points=num_points, transform=transform,
+                target_transform=target_transform)
+    train = cached_dataset(cache_dir, os.path.join(root, 'MNIST', 'processed', 'training.pt'),
+                           lambda: MNIST(root=root, train=True, transform=transform, download=download,
+                                         target_transform=target_transform, classes=classes, num_points=num_points),
+                           train=True, **spec)
     
-    test = MNIST(root=root, train=False, transform=transform, download=download, 
-                 target_transform=target_transform, classes=classes, num_points=num_points)
+    test = cached_dataset(cache_dir, os.path.join(root, 'MNIST', 'processed', 'test.pt'),
+                          lambda: MNIST(root=root, train=False, transform=transform, download=download, 
+                                        target_transform=target_transform, classes=classes, num_points=num_points),
+                          train=False, **spec)
     # Create data loaders
-    trainloader = torch.utils.data.DataLoader(train, batch_size=batch_size)
-    testloader = torch.utils.data.DataLoader(test, batch_size=batch_size)
+    # (each process gets its own shard of the data, when distributed)
+    train_sampler, test_sampler = None, None
+    if distributed:
+        train_sampler = torch.utils.data.DistributedSampler(train, shuffle=False)
+        test_sampler = torch.utils.data.DistributedSampler(test, shuffle=False)
+    trainloader = torch.utils.data.DataLoader(train, batch_size=batch_size, sampler=train_sampler)
+    testloader = torch.utils.data.DataLoader(test, batch_size=batch_size, sampler=test_sampler)
     return trainloader, testloader
 
 #%%
@@ -12,21 +12,34 @@ import torch.utils.data as data
 import os
 import numpy as np
 from PIL import Image
+from .cache import cached_dataset
 
 #%%
 def perception_data_loader(root, transform=None, target_transform=None, 
                            download=False, batch_size=128, 
-                           classes=[0,1,2,3,4,5,6,7,8,9], num_points=10000):
-    # Load dataset
-    train = PERCEPTION(root=root, train=True, transform=transform, download=download,
-                       target_transform=target_transform, classes=classes, num_points=num_points)
+                           classes=[0,1,2,3,4,5,6,7,8,9], num_points=10000,
+                           distributed=False, cache_dir=None):
+    # Load dataset (from the cache of preprocessed tensors, if given)
+    spec = dict(classes=classes, num_points=num_points, transform=transform,
+                target_transform=target_transform)
+    train = cached_dataset(cache_dir, 'unsuper/data/PERCEPTION/training.npz',
+                           lambda: PERCEPTION(root=root, train=True, transform=transform, download=download,
+                                              target_transform=target_transform, classes=classes, num_points=num_points),
+                           train=True, **spec)
     
-    test = PERCEPTION(root=root, train=False, transform=transform, download=download, 
-                      target_transform=target_transform, classes=classes, num_points=num_points)
+    test = cached_dataset(cache_dir, 'unsuper/data/PERCEPTION/testing.npz',
+                          lambda: PERCEPTION(root=root, train=False, transform=transform, download=download, 
+                                             target_transform=target_transform, classes=classes, num_points=num_points),
+                          train=False, **spec)
     
     # Create data loaders
-    trainloader = torch.utils.data.DataLoader(train, batch_size=batch_size)
-    testloader = torch.utils.data.DataLoader(test, batch_size=batch_size)
+    # (each process gets its own shard of the data, when distributed)
+    train_sampler, test_sampler = None, None
+    if distributed:
+        train_sampler = torch.utils.data.DistributedSampler(train, shuffle=False)
+        test_sampler = torch.utils.data.DistributedSampler(test, shuffle=False)
+    trainloader = torch.utils.data.DataLoader(train, batch_size=batch_size, sampler=train_sampler)
+    testloader = torch.utils.data.DataLoader(test, batch_size=batch_size, sampler=test_sampler)
     return trainloader, testloader
 
 #%%
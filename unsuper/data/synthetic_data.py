@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#%%
+import os
+import numpy as np
+import torch
+import torch.utils.data as data
+
+#%%
+_dtypes = {'float32': np.float32, 'float16': np.float16, 'uint8': np.uint8}
+
+#%%
+def generate_dataset(model, n, root, batch_size=10000, dtype='float32'):
+    """ Samples a synthetic dataset from a trained model. The images and the
+        latent codes they were generated from are streamed batch by batch to
+        memory-mapped .npy files in root
+    Arguments:
+        model: model from unsuper.models.get_model
+        n: integer, number of points to generate
+        root: str, folder to store the dataset in
+        batch_size: integer, number of points sampled at the same time
+        dtype: str, storage type of the images. 'float32' (default) stores
+            the model output unchanged, 'float16' stores it in half precision
+            and 'uint8' quantizes it to [0, 255] (clamping the output to 
+            [0, 1]), which is 4x smaller but changes the data
+    Output:
+        dataset: SYNTHETIC dataset, loaded from the generated files
+    """
+    assert dtype in _dtypes, 'dtype not found, choose between: ' \
+            + ', '.join([k for k in _dtypes.keys()])
+    if not os.path.exists(root): os.makedirs(root)
+
+    images = np.lib.format.open_memmap(os.path.join(root, 'images.npy'), mode='w+',
+                                       dtype=_dtypes[dtype], shape=(n, *model.input_shape))
+    latents = [np.lib.format.open_memmap(os.path.join(root, 'latent_space' + str(j) + '.npy'),
+                                         mode='w+', dtype=np.float32, shape=(n, model.latent_dim))
+               for j in range(model.latent_spaces)]
+
+    was_training = model.training
+    model.eval()
+    try:
+        with torch.inference_mode():
+            for start in range(0, n, batch_size):
+                m = min(batch_size, n - start)
+                x, zs = model.special_sample(m)
+                if dtype == 'uint8':
+                    x = (255*x.clamp(0, 1)).round().to(torch.uint8)
+                else:
+                    x = x.to(getattr(torch, dtype))
+                torch.from_numpy(images[start:start+m]).copy_(x.reshape(m, *model.input_shape))
+                for j, z in enumerate(zs):
+                    torch.from_numpy(latents[j][start:start+m]).copy_(z)
+    finally:
+        model.train(was_training)
+
+    images.flush()
+    for l in latents: l.flush()
+    del images, latents
+    return SYNTHETIC(root)
+
+#%%
+class SYNTHETIC(data.Dataset):
+    """ Dataset generated by generate_dataset. The files are memory-mapped,
+        so no data is copied before it is indexed. All targets are 0.
+    Arguments:
+        root: str, folder with the generated files
+        transform: transformation applied to each image
+    """
+    def __init__(self, root, transform=None):
+        self.root = os.path.expanduser(root)
+        self.transform = transform
+
+        # Copy-on-write memory maps, torch wraps them without copying
+        self.data = torch.from_numpy(np.load(os.path.join(self.root, 'images.npy'), mmap_mode='c'))
+        self.latent = [ ]
+        j = 0
+        while os.path.exists(os.path.join(self.root, 'latent_space' + str(j) + '.npy')):
+            self.latent.append(torch.from_numpy(np.load(
+                    os.path.join(self.root, 'latent_space' + str(j) + '.npy'), mmap_mode='c')))
+            j += 1
+
+    def __getitem__(self, index):
+        img = self.data[index]
+        if img.dtype == torch.uint8:
+            img = img.to(torch.float32) / 255
+        else:
+            img = img.to(torch.float32)
+
+        if self.transform is not None:
+            img = self.transform(img)
+
+        return img, 0
+
+    def __len__(self):
+        return len(self.data)
+
+#%%
+def synthetic_data_loader(root, transform=None, batch_size=128):
+    # Load dataset
+    train = SYNTHETIC(root=root, transform=transform)
+
+    # Create data loader
+    trainloader = torch.utils.data.DataLoader(train, batch_size=batch_size)
+    return trainloader
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#%%
+import torch
+from torch.func import stack_module_state, functional_call, vmap, grad
+from tqdm import tqdm
+import time, os, copy
+from tensorboardX import SummaryWriter
+from .helper.losses import vae_loss, kl_scaling
+from .helper.sampling import gaussian_sampler
+from .helper.schedulers import kl_annealing, switch_schedule
+
+#%%
+class ensemble_trainer:
+    """ Trains N models of the same architecture in a single process. The
+        parameters of the models are stacked and the forward pass, loss and
+        gradient of all members are calculated at once with torch.func.vmap.
+        All members see the same batches, but get their own noise, learning
+        rate and beta. Each member is optimized with its own (vectorized) Adam
+        and logged to its own tensorboard folder
+    Arguments:
+        input_shape: shape of a single image
+        models: list of models (from unsuper.models.get_model) with the same
+            architecture, e.g. constructed with different seeds
+        lrs: list of learning rates, one for each member
+        betas: list of beta values (weight of the KL terms), one for each member
+        adam_betas: tuple, the betas of the Adam optimizer
+        adam_eps: float, the eps of the Adam optimizer
+    Methods:
+        fit - for training the members
+        train_step - a single optimization step of all members on a batch
+        unstack - the trained members as separate models
+    """
+    def __init__(self, input_shape, models, lrs, betas=None, adam_betas=(0.9, 0.999),
+                 adam_eps=1e-8):
+        assert len(models) == len(lrs), 'Need one learning rate per model'
+        betas = [1.0]*len(models) if betas is None else betas
+        assert len(models) == len(betas), 'Need one beta per model'
+        self.input_shape = input_shape
+        self.models = models
+        self.n_members = len(models)
+        self.latent_dim = models[0].latent_dim
+        self.outputdensity = models[0].outputdensity
+        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        for m in models: m.to(self.device).train()
+
+        # Stacked parameters and buffers, the model without parameters is
+        # only used for its structure
+        self.params, self.buffers = stack_module_state(models)
+        self.base = copy.deepcopy(models[0]).to('meta')
+        for m in self.base.modules():
+            if isinstance(m, gaussian_sampler):
+                # The sobol engine is drawn from outside of vmap, so all
+                # members would get the same noise
+                assert m.noise != 'sobol', 'sobol noise can not be used in an ensemble'
+                # In-place noise buffers can not be shared between members
+                m.buffered = False
+
+        # Per-member hyperparameters
+        self.lrs = torch.tensor(lrs, dtype=torch.float32, device=self.device)
+        self.betas = torch.tensor(betas, dtype=torch.float32, device=self.device)
+        self.adam_betas = adam_betas
+        self.adam_eps = adam_eps
+        self.adam_step = 0
+        self.exp_avg = {k: torch.zeros_like(p) for k, p in self.params.items()}
+        self.exp_avg_sq = {k: torch.zeros_like(p) for k, p in self.params.items()}
+
+        # Vectorized gradient of the loss of each member
+        self.vgrad = vmap(grad(self._loss, has_aux=True),
+                          in_dims=(0, 0, None, None, None, None, 0),
+                          randomness='different')
+        self.vforward = vmap(self._elbo, in_dims=(0, 0, None, None, None),
+                             randomness='different')
+
+    #%%
+    def _elbo(self, params, buffers, data, eq_samples, iw_samples, switch=1.0, kl_weight=1.0):
+        out = functional_call(self.base, (params, buffers), (data, eq_samples, iw_samples, switch))
+        lower_bound, recon_term, kl_terms = vae_loss(data, *out, eq_samples, iw_samples,
+                                                     self.latent_dim, None, None, 1.0,
+                                                     self.outputdensity, kl_weight=kl_weight)
+        return lower_bound, recon_term, torch.stack(kl_terms)
+
+    def _loss(self, params, buffers, data, eq_samples, iw_samples, switch, kl_weight):
+        lower_bound, recon_term, kl_terms = self._elbo(params, buffers, data, eq_samples,
+                                                       iw_samples, switch, kl_weight)
+        # We need to maximize the bound, so we minimize the negative bound
+        return -lower_bound, (lower_bound.detach(), recon_term.detach(), kl_terms.detach())
+
+    #%%
+    def _adam(self, grads):
+        """ Adam update of all members, with a learning rate for each member """
+        beta1, beta2 = self.adam_betas
+        self.adam_step += 1
+        bias1 = 1 - beta1**self.adam_step
+        bias2 = 1 - beta2**self.adam_step
+        with torch.no_grad():
+            for k, p in self.params.items():
+                g = grads[k]
+                self.exp_avg[k].mul_(beta1).add_(g, alpha=1-beta1)
+                self.exp_avg_sq[k].mul_(beta2).addcmul_(g, g, value=1-beta2)
+                denom = (self.exp_avg_sq[k] / bias2).sqrt_().add_(self.adam_eps)
+                lr = self.lrs.view(-1, *(p.dim()-1)*[1]) / bias1
+                p.sub_(lr * self.exp_avg[k] / denom)
+
+    #%%
+    def train_step(self, data, eq_samples=1, iw_samples=1, switch=1.0,
+                   epoch=None, warmup=None, kl_weight=None):
+        """ Forward, loss, backward and an optimizer step of all members. The
+            KL terms of each member are weighted by kl_weight (or by
+            kl_scaling(epoch, warmup) if not given) times its beta
+        Output:
+            loss, recon_term, kl_terms: tensors with a value for each member
+                (kl_terms has shape [n_members, n_latent_spaces])
+        """
+        kl_weight = (kl_scaling(epoch, warmup) if kl_weight is None else kl_weight) * self.betas
+        grads, (loss, recon_term, kl_terms) = self.vgrad(self.params, self.buffers, data,
+                                                         eq_samples, iw_samples, switch,
+                                                         kl_weight)
+        self._adam(grads)
+        return loss, recon_term, kl_terms
+
+    #%%
+    def fit(self, trainloader, n_epochs=10, warmup=1, logdir='', testloader=None,
+            eq_samples=1, iw_samples=1, kl_schedule=None, switch=None):
+        """ Fits all members to a training set. Arguments are the same as for
+            vae_trainer.fit, including the per-step kl_schedule and switch.
+            The results of member i are logged to logdir/member_i """
+        if kl_schedule is None:
+            kl_schedule = kl_annealing('linear', warmup_steps=warmup*len(trainloader))
+        if switch is None:
+            switch = switch_schedule(start_steps=warmup*len(trainloader))
+
+        writers = [SummaryWriter(log_dir=os.path.join(logdir, 'member_' + str(i)))
+                   for i in range(self.n_members)]
+        for i, w in enumerate(writers):
+            w.add_text('hyperparameters', 'lr: {0}, beta: {1}'.format(
+                    self.lrs[i].item(), self.betas[i].item()))
+
+        start = time.time()
+        for epoch in range(1, n_epochs+1):
+            progress_bar = tqdm(desc='Epoch ' + str(epoch) + '/' + str(n_epochs),
+                                total=len(trainloader.dataset), unit='samples')
+            train_loss = torch.zeros(self.n_members)
+            for i, (data, _) in enumerate(trainloader):
+                data = data.reshape(-1, *self.input_shape).to(torch.float32).to(self.device)
+                step = (epoch-1)*len(trainloader) + i + 1
+                loss, recon_term, kl_terms = self.train_step(data, eq_samples, iw_samples,
+                                                             switch(step),
+                                                             kl_weight=kl_schedule(step))
+                loss, recon_term, kl_terms = loss.cpu(), recon_term.cpu(), kl_terms.cpu()
+                train_loss += loss
+
+                progress_bar.update(data.size(0))
+                progress_bar.set_postfix({'best loss': loss.max().item()})
+
+                # Save to tensorboard
+                iteration = epoch*len(trainloader) + i
+                for j, w in enumerate(writers):
+                    w.add_scalar('train/total_loss', loss[j], iteration)
+                    w.add_scalar('train/recon_loss', recon_term[j], iteration)
+                    for l in range(kl_terms.shape[1]):
+                        w.add_scalar('train/KL_loss' + str(l), kl_terms[j,l], iteration)
+            progress_bar.close()
+
+            if testloader:
+                test_loss = self.evaluate(testloader).cpu()
+                for j, w in enumerate(writers):
+                    w.add_scalar('test/total_loss', test_loss[j], iteration)
+                if epoch == n_epochs:
+                    print('Final test loss', test_loss.tolist())
+
+        print('Total train time', time.time() - start)
+        for w in writers: w.close()
+
+    #%%
+    def evaluate(self, loader):
+        """ Average ELBO (full bound) of each member on a dataset. The model is
+            in eval mode, such that batchnorm uses (and does not update) the
+            running statistics """
+        elbo = torch.zeros(self.n_members, device=self.device)
+        self.base.eval()
+        try:
+            with torch.no_grad():
+                for data, _ in loader:
+                    data = data.reshape(-1, *self.input_shape).to(torch.float32).to(self.device)
+                    elbo += self.vforward(self.params, self.buffers, data, 1, 1)[0]
+        finally:
+            self.base.train()
+        return elbo / len(loader)
+
+    #%%
+    def unstack(self):
+        """ Copies the trained parameters and buffers back into the models """
+        with torch.no_grad():
+            for i, m in enumerate(self.models):
+                for name, p in m.named_parameters():
+                    p.copy_(self.params[name][i])
+                for name, b in m.named_buffers():
+                    b.copy_(self.buffers[name][i])
+        return self.models
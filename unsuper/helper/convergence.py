@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#%%
+import math
+
+#%%
+class convergence_monitor:
+    """ Tracks a metric that should be maximized (e.g. the test ELBO), decides
+        when training has converged and how often the metric needs to be
+        evaluated. While the metric improves the evaluation interval is halved,
+        when it does not improve the interval is doubled (up to max_interval)
+    Arguments:
+        patience: integer, number of epochs without an improvement of at least
+            min_delta before training should stop
+        min_delta: float, minimum increase of the metric that counts as an
+            improvement
+        max_interval: integer, maximum number of epochs between evaluations.
+            Is limited to half the patience, such that at least two
+            evaluations are done before stopping
+        start: integer, training is not stopped before start + patience
+            epochs. The metric is evaluated on the same schedule before start.
+            Default 0, since the test metric of the trainer is the full bound
+            and therefore comparable between epochs, also during the KL warmup
+    Methods:
+        should_evaluate - if the metric should be evaluated at a given epoch
+        update - register a new value of the metric, returns True if it
+            improved on the best value
+    """
+    def __init__(self, patience=20, min_delta=0.0, max_interval=8, start=0):
+        self.patience = patience
+        self.min_delta = min_delta
+        self.max_interval = max(1, min(max_interval, patience // 2))
+        self.start = start
+        self.best = -math.inf
+        self.best_epoch = None
+        self.interval = 1
+        self.next_eval = 0
+        self.stop = False
+
+    #%%
+    def should_evaluate(self, epoch):
+        return epoch >= self.next_eval
+
+    #%%
+    def update(self, epoch, value):
+        improved = value > self.best + self.min_delta
+        if improved:
+            self.best, self.best_epoch = value, epoch
+            self.interval = max(1, self.interval // 2)
+        else:
+            self.interval = min(self.max_interval, 2 * self.interval)
+            last = self.start if self.best_epoch is None else max(self.start, self.best_epoch)
+            self.stop = epoch - last >= self.patience
+        self.next_eval = epoch + self.interval
+        return improved
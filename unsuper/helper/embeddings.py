@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#%%
+import os
+import numpy as np
+import torch
+from torch.nn import functional as F
+
+#%%
+class embedding_exporter:
+    """ Streams latent embeddings and labels batch by batch into memory-mapped
+        .npy files, such that the full dataset is never held in memory. Only a
+        capped subset of the images are kept (as downsampled thumbnails) for
+        the sprite image of the tensorboard projector.
+    Arguments:
+        logdir: str, folder where the .npy files are written ('' for the
+            current folder)
+        name: str, prefix for the files and the tensorboard tags
+        n_points: integer, total number of points that will be exported
+        latent_dims: list of integers, dimensionality of each latent space
+        max_sprites: integer, maximum number of points that are send to the
+            tensorboard projector (with a sprite thumbnail)
+        sprite_size: integer, maximum height/width of the sprite thumbnails
+    Methods:
+        add - write a batch of latent codes, labels and images
+        write - send the sprite subset to a tensorboard writer
+    """
+    def __init__(self, logdir, name, n_points, latent_dims, max_sprites=1000,
+                 sprite_size=28):
+        self.name = name
+        self.n_points = n_points
+        self.max_sprites = min(max_sprites, n_points)
+        self.sprite_size = sprite_size
+        self.counter = 0
+        self.sprites = None
+
+        if logdir and not os.path.exists(logdir): os.makedirs(logdir)
+        self.labels = np.lib.format.open_memmap(
+                os.path.join(logdir, name + '_labels.npy'), mode='w+',
+                dtype=np.int32, shape=(n_points,))
+        self.latents = [np.lib.format.open_memmap(
+                os.path.join(logdir, name + '_latent_space' + str(j) + '.npy'),
+                mode='w+', dtype=np.float32, shape=(n_points, d))
+                for j, d in enumerate(latent_dims)]
+
+    #%%
+    def add(self, latents, labels, images=None):
+        n = labels.shape[0]
+        assert self.counter + n <= self.n_points, '''More points added than
+            allocated in the exporter '''
+        idx = slice(self.counter, self.counter + n)
+        self.labels[idx] = labels.cpu().numpy()
+        for j, z in enumerate(latents):
+            self.latents[j][idx] = z.detach().to(torch.float32).cpu().numpy()
+
+        # Only the first max_sprites points get a thumbnail
+        n_sprites = min(n, self.max_sprites - self.counter)
+        if images is not None and n_sprites > 0:
+            thumbs = self._thumbnail(images[:n_sprites]).cpu()
+            if self.sprites is None:
+                self.sprites = torch.zeros(self.max_sprites, *thumbs.shape[1:])
+            self.sprites[self.counter:self.counter+n_sprites] = thumbs
+        self.counter += n
+
+    #%%
+    def _thumbnail(self, images):
+        images = images.detach().to(torch.float32)
+        h, w = images.shape[2:]
+        scale = self.sprite_size / max(h, w)
+        if scale < 1:
+            size = (max(1, int(h*scale)), max(1, int(w*scale)))
+            images = F.interpolate(images, size=size, mode='area')
+        return images
+
+    #%%
+    def write(self, writer):
+        self.labels.flush()
+        for latent in self.latents: latent.flush()
+
+        n = min(self.counter, self.max_sprites)
+        metadata = self.labels[:n].tolist()
+        label_img = self.sprites[:n] if self.sprites is not None else None
+        for j, latent in enumerate(self.latents):
+            mat = torch.tensor(np.asarray(latent[:n]))
+
+            # Embeddings with dim < 3 needs to be appended extra non-informative dimensions
+            if mat.shape[1] < 3:
+                mat = torch.cat([mat, torch.zeros(n, 3 - mat.shape[1])], dim=1)
+
+            writer.add_embedding(mat = mat,
+                                 metadata = metadata,
+                                 label_img = label_img,
+                                 tag = self.name + '_latent_space' + str(j))
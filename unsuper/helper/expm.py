@@ -90,45 +90,87 @@ def torch_expm3x3(A):
     return expmA
 
 #%%
-def torch_expm(A):
-    """ """
-    n_A = A.shape[0]
+def torch_expm(A, max_squarings=16):
+    """ Matrix exponential of a batch of square matrices, using the scaling
+        and squaring method with a Pade 13 approximation.
+    
+    Arguments:
+        A: 3D-`Tensor` [N,n,n]. Batch of input matrices.
+        max_squarings: int, number of squarings when the function is traced,
+            exported to onnx or compiled. The squaring loop then always runs
+            this many times (selecting per matrix with torch.where), such that
+            the graph does not depend on the data. Matrices with a frobenius
+            norm above 5.37*2**max_squarings are not fully unsquared. In eager
+            mode the loop only runs as many times as the largest matrix needs
+        
+    Output:
+        expA: 3D-`Tensor` [N,n,n]. Matrix exponential for each matrix in input tensor A.
+    """
     A_fro = torch.sqrt(A.abs().pow(2).sum(dim=(1,2), keepdim=True))
     
     # Scaling step
-    maxnorm = torch.Tensor([5.371920351148152]).type(A.dtype).to(A.device)
-    zero = torch.Tensor([0.0]).type(A.dtype).to(A.device)
-    n_squarings = torch.max(zero, torch.ceil(torch_log2(A_fro / maxnorm)))
+    maxnorm = 5.371920351148152
+    n_squarings = torch.ceil(torch_log2(A_fro / maxnorm)).clamp(min=0)
     Ascaled = A / 2.0**n_squarings    
-    n_squarings = n_squarings.flatten().type(torch.int64)
     
     # Pade 13 approximation
     U, V = torch_pade13(Ascaled)
     P = U + V
     Q = -U + V
-    R, _ = torch.gesv(P, Q) # solve P = Q*R
+    R = torch_solve(Q, P) # solve P = Q*R
     
-    # Unsquaring step    
-    n = n_squarings.max()
-    res = [R]
+    # Unsquaring step
+    n = max_squarings if _is_exporting() else int(n_squarings.max())
     for i in range(n):
-        res.append(res[-1].matmul(res[-1]))
-    R = torch.stack(res)
-    expmA = R[n_squarings, torch.arange(n_A)]
-    return expmA
+        R = torch.where(n_squarings > i, R.matmul(R), R)
+    return R
+
+#%%
+def _is_exporting():
+    """ True when the graph is traced, exported to onnx or compiled, such that
+        the number of loop iterations can not depend on the data """
+    if torch.jit.is_tracing():
+        return True
+    if hasattr(torch, 'onnx') and hasattr(torch.onnx, 'is_in_onnx_export') \
+       and torch.onnx.is_in_onnx_export():
+        return True
+    if hasattr(torch, 'compiler') and hasattr(torch.compiler, 'is_compiling'):
+        return torch.compiler.is_compiling()
+    return False
+
+#%%
+def torch_solve(A, B):
+    """ Solves A X = B for a batch of matrices. 3x3 systems are solved in closed
+        form using the adjugate of A, which is faster than a batched LU for such 
+        small matrices and only uses elementwise ops (exportable to onnx) """
+    if A.shape[1:] != (3, 3):
+        if hasattr(torch, 'linalg'):
+            return torch.linalg.solve(A, B)
+        return torch.gesv(B, A)[0]
+    
+    a, b, c = A[:,0,0], A[:,0,1], A[:,0,2]
+    d, e, f = A[:,1,0], A[:,1,1], A[:,1,2]
+    g, h, i = A[:,2,0], A[:,2,1], A[:,2,2]
+    adj = torch.stack([torch.stack([e*i-f*h, c*h-b*i, b*f-c*e], dim=1),
+                       torch.stack([f*g-d*i, a*i-c*g, c*d-a*f], dim=1),
+                       torch.stack([d*h-e*g, b*g-a*h, a*e-b*d], dim=1)], dim=1)
+    det = a*adj[:,0,0] + b*adj[:,1,0] + c*adj[:,2,0]
+    return adj.matmul(B) / det[:,None,None]
 
 #%%
 def torch_log2(x):
-    return torch.log(x) / torch.log(torch.Tensor([2.0])).type(x.dtype).to(x.device)
+    return torch.log2(x)
+
+#%%
+_pade13_coef = [64764752532480000., 32382376266240000., 7771770303897600.,
+                1187353796428800., 129060195264000., 10559470521600.,
+                670442572800., 33522128640., 1323241920., 40840800.,
+                960960., 16380., 182., 1.]
 
 #%%    
 def torch_pade13(A):
-    b = torch.Tensor([64764752532480000., 32382376266240000., 7771770303897600.,
-                      1187353796428800., 129060195264000., 10559470521600.,
-                      670442572800., 33522128640., 1323241920., 40840800.,
-                      960960., 16380., 182., 1.]).type(A.dtype).to(A.device)
-        
-    ident = torch.eye(A.shape[1], dtype=A.dtype).to(A.device)
+    b = _pade13_coef
+    ident = torch.eye(A.shape[1], dtype=A.dtype, device=A.device)
     A2 = torch.matmul(A,A)
     A4 = torch.matmul(A2,A2)
     A6 = torch.matmul(A4,A2)
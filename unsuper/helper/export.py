@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#%%
+import os, time
+import torch
+from torch import nn
+from ..models.vitae_ci import VITAE_CI
+
+#%%
+def _decode(model, zs):
+    """ Mean image for a given list of latent codes """
+    if model.latent_spaces == 1:
+        return model.decoder(zs[0])[0]
+    theta_mean, _ = model.decoder1(zs[0])
+    x_mean, _ = model.decoder2(zs[1])
+    return model.stn(x_mean, theta_mean)
+
+#%%
+def _reconstruct(model, x):
+    """ Reconstruction through the latent means (no sampling) """
+    if model.latent_spaces == 1:
+        return model.decoder(model.encoder(x)[0])[0]
+    mu1, _ = model.encoder1(x)
+    theta_mean, _ = model.decoder1(mu1)
+    if isinstance(model, VITAE_CI):
+        # Semantic encoder is conditioned on the transformed image
+        x = model.stn(x, theta_mean, inverse=True)
+    mu2, _ = model.encoder2(x)
+    x_mean, _ = model.decoder2(mu2)
+    return model.stn(x_mean, theta_mean)
+
+#%%
+class encoder_graph(nn.Module):
+    """ images -> tuple of latent means """
+    def __init__(self, model):
+        super(encoder_graph, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        return tuple(self.model.latent_representation(x))
+
+#%%
+class decoder_graph(nn.Module):
+    """ latent codes (one tensor for each latent space) -> mean images """
+    def __init__(self, model):
+        super(decoder_graph, self).__init__()
+        self.model = model
+
+    def forward(self, *zs):
+        return _decode(self.model, zs)
+
+#%%
+class reconstruction_graph(nn.Module):
+    """ images -> mean reconstructions """
+    def __init__(self, model):
+        super(reconstruction_graph, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        return _reconstruct(self.model, x)
+
+#%%
+def example_inputs(model, input_shape, batch_size=16):
+    """ Example inputs for the encoder, decoder and reconstruction graphs """
+    device = next(model.parameters()).device
+    x = torch.rand(batch_size, *input_shape, device=device)
+    zs = tuple(torch.randn(batch_size, model.latent_dim, device=device)
+               for _ in range(model.latent_spaces))
+    return {'encoder': (x,), 'decoder': zs, 'reconstruction': (x,)}
+
+#%%
+def export_model(model, input_shape, folder, fmt='torchscript', batch_size=16,
+                 opset_version=17):
+    """ Exports the encoder, decoder and full reconstruction of a model, such
+        that they can be run without the python code in this repo. The graphs
+        are traced with the model in eval mode and have a dynamic batch size.
+    Arguments:
+        model: model from unsuper.models.get_model
+        input_shape: shape of a single image
+        folder: str, where to save the graphs
+        fmt: str, 'torchscript' (saved as .pt) or 'onnx' (saved as .onnx)
+        batch_size: integer, batch size of the example inputs used for tracing
+        opset_version: integer, onnx opset (grid_sample needs at least 16)
+    Output:
+        paths: dict with the path of each exported graph
+    """
+    assert fmt in ['torchscript', 'onnx'], 'fmt should be torchscript or onnx'
+    if not os.path.exists(folder): os.makedirs(folder)
+    model.eval()
+
+    graphs = {'encoder': encoder_graph(model),
+              'decoder': decoder_graph(model),
+              'reconstruction': reconstruction_graph(model)}
+    inputs = example_inputs(model, input_shape, batch_size)
+    paths = { }
+    with torch.no_grad():
+        for name, graph in graphs.items():
+            if fmt == 'torchscript':
+                paths[name] = os.path.join(folder, name + '.pt')
+                torch.jit.trace(graph, inputs[name]).save(paths[name])
+            else:
+                paths[name] = os.path.join(folder, name + '.onnx')
+                input_names = ['input' + str(i) for i in range(len(inputs[name]))]
+                n_out = model.latent_spaces if name == 'encoder' else 1
+                output_names = ['output' + str(i) for i in range(n_out)]
+                torch.onnx.export(graph, inputs[name], paths[name],
+                                  input_names=input_names,
+                                  output_names=output_names,
+                                  dynamic_axes={k: {0: 'batch'} for k in input_names + output_names},
+                                  opset_version=opset_version)
+    return paths
+
+#%%
+def load_exported(path):
+    """ Loads an exported graph as a function that takes and returns tensors """
+    if path.endswith('.pt'):
+        return torch.jit.load(path)
+
+    import onnxruntime
+    session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+    names = [i.name for i in session.get_inputs()]
+    def run(*inputs):
+        out = session.run(None, {n: i.cpu().numpy() for n, i in zip(names, inputs)})
+        out = tuple(torch.from_numpy(o) for o in out)
+        return out[0] if len(out) == 1 else out
+    return run
+
+#%%
+def check_parity(graph, exported, inputs):
+    """ Maximum absolute difference between the eager graph and its exported version """
+    with torch.no_grad():
+        out1 = graph(*inputs)
+        out2 = exported(*inputs)
+    if not isinstance(out1, tuple): out1, out2 = (out1,), (out2,)
+    return max([(o1.cpu() - o2.cpu()).abs().max().item() for o1, o2 in zip(out1, out2)])
+
+#%%
+def benchmark_latency(fn, inputs, n_runs=100, n_warmup=10):
+    """ Average number of seconds for a call to fn """
+    with torch.no_grad():
+        for _ in range(n_warmup):
+            fn(*inputs)
+        start = time.time()
+        for _ in range(n_runs):
+            fn(*inputs)
+    return (time.time() - start) / n_runs
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#%%
+import os, sys, math, time, json, contextlib
+from collections import defaultdict
+import torch
+
+#%%
+class hook:
+    """ Base class for hooks into vae_trainer.fit. All methods do nothing by
+        default, so a hook only needs to implement the ones it uses
+    Methods:
+        on_train_start(trainer, writer, logdir) - before the first epoch
+        on_batch_start(trainer, step) - before a batch is loaded
+        on_batch_end(trainer, step, stats) - after a training step, stats is
+            a dict with 'batch_size', 'loss' and 'times' (seconds per phase:
+            data, transfer, forward, backward, step, logging)
+        on_epoch_end(trainer, epoch, stats) - after the training part of an
+            epoch, stats is a dict with 'train_loss', 'time' and 'times'
+            (seconds per epoch level phase, e.g. visualization)
+        on_eval(trainer, epoch, stats) - after a test evaluation, stats is a
+            dict with 'test_loss' and 'time'
+        on_train_end(trainer) - after the last epoch
+    """
+    def on_train_start(self, trainer, writer, logdir): pass
+    def on_batch_start(self, trainer, step): pass
+    def on_batch_end(self, trainer, step, stats): pass
+    def on_epoch_end(self, trainer, epoch, stats): pass
+    def on_eval(self, trainer, epoch, stats): pass
+    def on_train_end(self, trainer): pass
+
+#%%
+class phase_timer:
+    """ Accumulates wall time per phase of a training step. If synchronize is
+        True, cuda is synchronized at the start and end of each phase, such
+        that asynchronous kernels are assigned to the right phase. The phases
+        are also labeled in torch.profiler traces. track_memory can be False,
+        'cuda' to record the peak allocated gpu memory of each phase, or 'cpu'
+        to record the resident set size of the process at the end of each phase
+        (the cpu allocator has no peak statistics per phase)
+    """
+    def __init__(self, synchronize=False):
+        self.synchronize = synchronize
+        self.track_memory = False
+        self.times = defaultdict(float)
+        self.peaks = { }
+
+    @contextlib.contextmanager
+    def __call__(self, phase):
+        if self.synchronize: torch.cuda.synchronize()
+        if self.track_memory == 'cuda': torch.cuda.reset_peak_memory_stats()
+        start = time.perf_counter()
+        try:
+            # Label the phase in torch.profiler traces
+            with torch.profiler.record_function(phase):
+                yield
+        finally:
+            if self.synchronize: torch.cuda.synchronize()
+            self.times[phase] += time.perf_counter() - start
+            if self.track_memory:
+                used = torch.cuda.max_memory_allocated() if self.track_memory == 'cuda' \
+                       else current_rss_bytes()
+                self.peaks[phase] = max(self.peaks.get(phase, 0), used)
+
+    def add(self, phase, seconds):
+        self.times[phase] += seconds
+
+    def reset(self):
+        """ Returns the accumulated times and starts over """
+        times, self.times = dict(self.times), defaultdict(float)
+        return times
+    
+    def reset_peaks(self):
+        """ Returns the recorded memory (bytes) per phase and starts over """
+        peaks, self.peaks = self.peaks, { }
+        return peaks
+
+#%%
+def current_rss_bytes():
+    """ Current resident set size of the process in bytes. Read from /proc on
+        linux, elsewhere the peak resident set size is used instead """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        peak = peak_rss_mb()
+        return 0 if math.isnan(peak) else int(peak * 2**20)
+
+#%%
+def peak_rss_mb():
+    """ Peak resident set size of the process in MB (nan if not available) """
+    try:
+        import resource
+    except ImportError:
+        return float('nan')
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10
+
+#%%
+class profiler_hook(hook):
+    """ Records wall time per phase, samples/sec, data loader wait time and
+        peak RSS. Averages over log_every steps are written to tensorboard and
+        a summary of the full run is saved as json in the logdir
+    Arguments:
+        log_every: integer, number of steps between writes to tensorboard
+        filename: str, name of the json summary in the logdir
+    """
+    def __init__(self, log_every=10, filename='profile.json'):
+        self.log_every = log_every
+        self.filename = filename
+
+    def on_train_start(self, trainer, writer, logdir):
+        self.writer = writer
+        self.path = os.path.join(logdir, self.filename)
+        self.start = time.time()
+        self.totals, self.window = defaultdict(float), defaultdict(float)
+        self.n_samples, self.n_steps = 0, 0
+        self.window_samples, self.window_steps = 0, 0
+        self.epochs = [ ]
+
+    def on_batch_end(self, trainer, step, stats):
+        for phase, t in stats['times'].items():
+            self.totals[phase] += t
+            self.window[phase] += t
+        self.n_samples += stats['batch_size']
+        self.n_steps += 1
+        self.window_samples += stats['batch_size']
+        self.window_steps += 1
+
+        if self.window_steps == self.log_every:
+            step_time = sum(self.window.values())
+            for phase, t in self.window.items():
+                self.writer.add_scalar('profile/ms_' + phase, 1000 * t / self.window_steps, step)
+            self.writer.add_scalar('profile/samples_per_sec', self.window_samples / step_time, step)
+            self.writer.add_scalar('profile/data_wait_fraction', self.window['data'] / step_time, step)
+            self.writer.add_scalar('profile/peak_rss_mb', peak_rss_mb(), step)
+            self.window = defaultdict(float)
+            self.window_samples, self.window_steps = 0, 0
+
+    def on_epoch_end(self, trainer, epoch, stats):
+        for phase, t in stats['times'].items():
+            self.totals[phase] += t
+        self.epochs.append({'epoch': epoch, 'time': stats['time'],
+                            'train_loss': stats['train_loss']})
+
+    def on_eval(self, trainer, epoch, stats):
+        self.totals['eval'] += stats['time']
+
+    def summary(self):
+        total = time.time() - self.start
+        train_time = sum([self.totals[p] for p in
+                          ['data', 'transfer', 'forward', 'backward', 'step', 'logging']])
+        return {'total_time': total,
+                'steps': self.n_steps,
+                'samples': self.n_samples,
+                'samples_per_sec': self.n_samples / max(train_time, 1e-12),
+                'data_wait_fraction': self.totals['data'] / max(train_time, 1e-12),
+                'peak_rss_mb': peak_rss_mb(),
+                'phase_time': dict(self.totals),
+                'phase_fraction': {p: t / total for p, t in self.totals.items()},
+                'ms_per_step': {p: 1000 * self.totals[p] / max(self.n_steps, 1) for p in
+                                ['data', 'transfer', 'forward', 'backward', 'step', 'logging']},
+                'epochs': self.epochs}
+
+    def on_train_end(self, trainer):
+        if trainer.rank != 0: return
+        summary = self.summary()
+        with open(self.path, 'w') as f:
+            json.dump(summary, f, indent=2)
+        print('Samples/sec: {0:.1f}, data wait: {1:.1%}, peak RSS: {2:.0f} MB'.format(
+                summary['samples_per_sec'], summary['data_wait_fraction'], summary['peak_rss_mb']))
+
+#%%
+class torch_profiler_hook(hook):
+    """ Runs torch.profiler over a window of training steps. The profiler
+        skips the first skip_first steps, then waits for wait steps, warms up
+        for warmup steps and records active steps (repeated repeat times).
+        For each recorded window a chrome trace (open in chrome://tracing or
+        perfetto) and a table of the top_k operators are saved in the logdir
+    Arguments:
+        wait, warmup, active, repeat, skip_first: integers, profiler schedule
+        top_k: integer, number of operators in the table
+        record_shapes: bool, if input shapes of the operators are recorded
+        profile_memory: bool, if memory allocations of the operators are recorded
+    """
+    def __init__(self, wait=1, warmup=1, active=3, repeat=1, skip_first=10,
+                 top_k=30, record_shapes=True, profile_memory=False):
+        self.schedule = torch.profiler.schedule(wait=wait, warmup=warmup, active=active,
+                                                repeat=repeat, skip_first=skip_first)
+        self.top_k = top_k
+        self.record_shapes = record_shapes
+        self.profile_memory = profile_memory
+        self.profiler = None
+
+    def on_train_start(self, trainer, writer, logdir):
+        self.logdir = logdir
+        self.rank = trainer.rank
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if trainer.device.type == 'cuda':
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.sort_by = 'self_cuda_time_total' if trainer.device.type == 'cuda' \
+                       else 'self_cpu_time_total'
+        self.profiler = torch.profiler.profile(activities=activities,
+                                               schedule=self.schedule,
+                                               on_trace_ready=self._trace_ready,
+                                               record_shapes=self.record_shapes,
+                                               profile_memory=self.profile_memory)
+        self.profiler.start()
+
+    def on_batch_end(self, trainer, step, stats):
+        self.profiler.step()
+
+    def on_train_end(self, trainer):
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler = None
+
+    def _trace_ready(self, prof):
+        name = 'rank' + str(self.rank) + '_step' + str(prof.step_num)
+        prof.export_chrome_trace(os.path.join(self.logdir, 'trace_' + name + '.json'))
+        table = prof.key_averages(group_by_input_shape=self.record_shapes).table(
+                sort_by=self.sort_by, row_limit=self.top_k)
+        with open(os.path.join(self.logdir, 'top_ops_' + name + '.txt'), 'w') as f:
+            f.write(table)
+        if self.rank == 0:
+            print(prof.key_averages().table(sort_by=self.sort_by, row_limit=self.top_k))
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#%%
+import torch
+
+#%%
+class knn_classifier:
+    """ k-nearest-neighbour classifier with euclidean distance and uniform
+        weights (same as the defaults of sklearn's KNeighborsClassifier).
+        Distances are calculated blockwise with matrix multiplications, and
+        only the running top-k is kept, so memory is bounded by the chunk sizes
+    Arguments:
+        k: integer, number of neighbours
+        query_chunk: integer, number of query points handled at the same time
+        train_chunk: integer, number of training points handled at the same time
+        n_threads: integer, number of threads torch should use (None keeps
+            the current setting)
+        dtype: dtype the distances are calculated in
+    Methods:
+        fit - store the training data
+        kneighbors - find the distances and indices of the k nearest neighbours
+        predict - predict labels of new data
+        score - accuracy on new data
+    """
+    def __init__(self, k=5, query_chunk=1024, train_chunk=16384, n_threads=None,
+                 dtype=torch.float32):
+        self.k = k
+        self.query_chunk = query_chunk
+        self.train_chunk = train_chunk
+        self.n_threads = n_threads
+        self.dtype = dtype
+
+    #%%
+    def _as_tensor(self, X):
+        X = torch.as_tensor(X)
+        return X.reshape(X.shape[0], -1).to(self.dtype)
+
+    #%%
+    def fit(self, X, y):
+        self.X = self._as_tensor(X)
+        self.X_sq = (self.X * self.X).sum(dim=1)
+        self.classes, self.y = torch.unique(torch.as_tensor(y).to(self.X.device),
+                                            return_inverse=True)
+        assert self.X.shape[0] >= self.k, 'Need at least k training points'
+        return self
+
+    #%%
+    def kneighbors(self, X):
+        X = self._as_tensor(X).to(self.X.device)
+        n_threads = torch.get_num_threads()
+        if self.n_threads is not None: torch.set_num_threads(self.n_threads)
+
+        dist, idx = [ ], [ ]
+        try:
+            for q in torch.split(X, self.query_chunk):
+                q_sq = (q * q).sum(dim=1, keepdim=True)
+                best_d = torch.full((q.shape[0], self.k), float('inf'),
+                                    dtype=self.dtype, device=q.device)
+                best_i = torch.zeros(q.shape[0], self.k, dtype=torch.int64,
+                                     device=q.device)
+                for start in range(0, self.X.shape[0], self.train_chunk):
+                    Xt = self.X[start:start+self.train_chunk]
+                    # ||q||^2 - 2 q x^T + ||x||^2
+                    d = torch.addmm(self.X_sq[start:start+self.train_chunk][None],
+                                    q, Xt.t(), alpha=-2) + q_sq
+                    d_k, i_k = torch.topk(d, min(self.k, d.shape[1]), dim=1, largest=False)
+
+                    # Merge with the running top-k
+                    d = torch.cat([best_d, d_k], dim=1)
+                    i = torch.cat([best_i, i_k + start], dim=1)
+                    best_d, sel = torch.topk(d, self.k, dim=1, largest=False)
+                    best_i = i.gather(1, sel)
+                dist.append(best_d.clamp(min=0).sqrt())
+                idx.append(best_i)
+        finally:
+            torch.set_num_threads(n_threads)
+        return torch.cat(dist), torch.cat(idx)
+
+    #%%
+    def predict(self, X):
+        _, idx = self.kneighbors(X)
+        neighbours = self.y[idx]
+        votes = torch.zeros(idx.shape[0], len(self.classes), device=idx.device)
+        votes.scatter_add_(1, neighbours, torch.ones_like(neighbours, dtype=votes.dtype))
+        # argmax picks the smallest class on ties, same as sklearn
+        return self.classes[votes.argmax(dim=1)]
+
+    #%%
+    def score(self, X, y):
+        y = torch.as_tensor(y).to(self.classes.device)
+        return (self.predict(X) == y).to(torch.float32).mean().item()
+
+#%%
+def knn_accuracy(Xtrain, ytrain, Xtest, ytest, k=5, **kwargs):
+    """ Fits a knn classifier on the training data and returns the test accuracy """
+    return knn_classifier(k, **kwargs).fit(Xtrain, ytrain).score(Xtest, ytest)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#%%
+import os
+import numpy as np
+import torch
+
+#%%
+def _as_loader(data, batch_size):
+    """ Wraps a dataset (or the dataset of a dataloader) in a sequential loader
+        with the requested batch size """
+    if isinstance(data, torch.utils.data.DataLoader):
+        data = data.dataset
+    return torch.utils.data.DataLoader(data, batch_size=batch_size, shuffle=False)
+
+#%%
+def _allocate(n, dims, memmap_dir, prefix):
+    """ Allocate float32 output arrays, either in memory or memory-mapped """
+    if memmap_dir is None:
+        return [np.empty((n, d), dtype=np.float32) for d in dims]
+    if not os.path.exists(memmap_dir): os.makedirs(memmap_dir)
+    return [np.lib.format.open_memmap(os.path.join(memmap_dir, prefix + str(j) + '.npy'),
+                                      mode='w+', dtype=np.float32, shape=(n, d))
+            for j, d in enumerate(dims)]
+
+#%%
+def _extract(model, loader, input_shape, fn, out):
+    """ Runs fn over all batches in the loader under inference mode, with the
+        model in eval mode (batchnorm uses its running statistics and they are
+        not updated), and copies the list of outputs directly into the arrays 
+        in out. The train/eval mode of the model is restored afterwards """
+    n = len(loader.dataset)
+    device = next(model.parameters()).device
+    labels = np.empty((n,), dtype=np.int64)
+    
+    was_training = model.training
+    model.eval()
+    try:
+        with torch.inference_mode():
+            counter = 0
+            for x, y in loader:
+                m = x.shape[0]
+                x = x.reshape(-1, *input_shape).to(device=device, dtype=torch.float32)
+                
+                # Copy directly into the (possible memory-mapped) output arrays
+                for j, res in enumerate(fn(x)):
+                    torch.from_numpy(out[j][counter:counter+m]).copy_(res.reshape(m, -1))
+                labels[counter:counter+m] = np.asarray(y)
+                counter += m
+    finally:
+        model.train(was_training)
+    return out, labels
+
+#%%
+def extract_latents(model, data, input_shape, batch_size=1024, mode='representation',
+                    out=None, memmap_dir=None):
+    """ Encodes a full dataset into all latent spaces of a model. The model is
+        run in eval mode, and its train/eval mode is restored afterwards
+    Arguments:
+        model: model from unsuper.models.get_model
+        data: dataset or dataloader with the data to encode
+        input_shape: shape of a single image
+        batch_size: integer, number of points to encode at the same time
+        mode: str, 'representation' uses model.latent_representation and
+            'semantics' uses the latent means returned by model.semantics
+        out: list of preallocated float32 arrays (one for each latent space)
+            of shape [N, latent_dim] where the latent codes are written to
+        memmap_dir: str, if given (and out is None) the latent codes are
+            written to memory-mapped .npy files in this folder
+    Output:
+        latents: list of float32 arrays [N, latent_dim], one for each latent space
+        labels: int64 array [N] with the labels of the data
+    """
+    assert mode in ['representation', 'semantics'], '''mode should be either
+        representation or semantics '''
+    loader = _as_loader(data, batch_size)
+    if out is None:
+        out = _allocate(len(loader.dataset), model.latent_spaces*[model.latent_dim],
+                        memmap_dir, 'latent_space')
+    assert len(out) == model.latent_spaces, '''Need one output array for each
+        latent space '''
+    
+    if mode == 'representation':
+        fn = model.latent_representation
+    else:
+        fn = lambda x: model.semantics(x)[3]
+    return _extract(model, loader, input_shape, fn, out)
+
+#%%
+def extract_reconstructions(model, data, input_shape, batch_size=1024, 
+                            out=None, memmap_dir=None):
+    """ Reconstructs a full dataset through model.semantics. The model is run
+        in eval mode, and its train/eval mode is restored afterwards
+    Arguments:
+        model: model from unsuper.models.get_model
+        data: dataset or dataloader with the data to reconstruct
+        input_shape: shape of a single image
+        batch_size: integer, number of points to reconstruct at the same time
+        out: preallocated float32 array of shape [N, prod(input_shape)]
+        memmap_dir: str, if given (and out is None) the reconstructions are
+            written to a memory-mapped .npy file in this folder
+    Output:
+        recon: float32 array [N, prod(input_shape)] with flattened reconstructions
+        labels: int64 array [N] with the labels of the data
+    """
+    loader = _as_loader(data, batch_size)
+    if out is None:
+        out = _allocate(len(loader.dataset), [int(np.prod(input_shape))],
+                        memmap_dir, 'reconstruction')[0]
+    fn = lambda x: [model.semantics(x)[0]]
+    recon, labels = _extract(model, loader, input_shape, fn, [out])
+    return recon[0], labels
@@ -7,14 +7,16 @@ Created on Fri Oct 12 12:39:59 2018
 """
 
 #%%
-import numpy as np
 import torch
 import math
+from .utility import float32_op
 c = - 0.5 * math.log(2*math.pi)
 
 #%%
+@float32_op
 def vae_loss(x, x_mu, x_var, z, z_mus, z_vars, eq_samples, iw_samples, 
-             latent_dim, epoch, warmup, beta, outputdensity):
+             latent_dim, epoch, warmup, beta, outputdensity, kl_weight=None,
+             estimator='iwae', surrogate=None):
     """ Calculates the ELBO for a variational autoencoder
     Arguments:
         x: input data [batch_size, *input_dim]
@@ -29,13 +31,36 @@ def vae_loss(x, x_mu, x_var, z, z_mus, z_vars, eq_samples, iw_samples,
         epoch: int, which epoch we are at
         warmup: int, how many warmup epoch to do
         outputdensity: str, output density of generative model
+        kl_weight: float or tensor, weight of the KL terms. If given it replaces
+            kl_scaling(epoch, warmup) * beta (a tensor avoids recompilation
+            when the loss is compiled)
+        estimator: str, gradient estimator for the encoder. The value of the 
+            bound is the same for all of them, only the gradients differ
+            'iwae' - standard gradient of the importance weighted bound
+            'stl' - sticking the landing, the score function term is removed
+                by evaluating log q with stopped encoder parameters. z_mus and
+                z_vars must then come from model.posterior called with 
+                detached parameters (see utility.detached_call), such that 
+                gradients only flow through the samples, also the path from
+                the first latent through the second encoder in VITAE_CI
+            'dreg' - doubly reparameterized, as stl but the gradient of each
+                sample path is weighted by the squared normalized importance
+                weight instead of the normalized importance weight. Needs 
+                surrogate
+        surrogate: (x_mu, x_var) from model.likelihood(z) called with detached
+            parameters, only used by 'dreg'. A zero valued term is added to
+            the bound that reweights the gradient reaching the encoder through
+            the samples exactly once per sample, while the decoder gets the
+            standard gradient
     Output:
         lower_bound: lower bound that should be maximized
         recon_term: reconstruction term for the ELBO
         kl_term: kl terms (multiple if multiple latents) in the ELBO term
     """
+    assert estimator in ['iwae', 'stl', 'dreg'], 'estimator should be iwae, stl or dreg'
+    assert estimator != 'dreg' or surrogate is not None, 'dreg needs the surrogate'
     eps = 1e-5 # to control underflow in variance estimates
-    weight =  kl_scaling(epoch, warmup) * beta
+    weight = kl_scaling(epoch, warmup) * beta if kl_weight is None else kl_weight
     
     batch_size = x.shape[0]
     x = x.view(batch_size, 1, 1, -1)
@@ -54,21 +79,35 @@ def vae_loss(x, x_mu, x_var, z, z_mus, z_vars, eq_samples, iw_samples,
     
     log_pz = [log_stdnormal(zs) for zs in z]
     log_qz = [log_normal2(zs, m, torch.log(l+eps)) for zs,m,l in zip(z, z_mus, z_vars)]
-    
-    if outputdensity == 'bernoulli':
-        x_mu = x_mu.clamp(1e-5, 1-1e-5)
-        log_px = (x * x_mu.log() + (1-x) * (1-x_mu).log())
-    elif outputdensity == 'gaussian':
-        log_px = log_normal2(x, x_mu, torch.log(x_var+eps), eps)
-    else:
-        ValueError('Unknown output density')
+    log_px = log_likelihood(x, x_mu, x_var, outputdensity, eps)
     a = log_px.sum(dim=3) + weight*(sum([p.sum(dim=3) for p in log_pz]) - sum([p.sum(dim=3) for p in log_qz]))
     a_max = torch.max(a, dim=2, keepdim=True)[0] #(batch_size, nsamples, 1)
     lower_bound = torch.mean(a_max) + torch.mean(torch.log(torch.mean(torch.exp(a-a_max), dim=2)))
+    if estimator == 'dreg' and torch.is_grad_enabled():
+        # The bound gives the gradient w_k * d a_k / dz_k to each sample path.
+        # The same weights with detached decoder parameters only reach the 
+        # encoder, and adding (w_k^2 - w_k) times them gives w_k^2 * d a_k / dz_k
+        x_mu_sg = surrogate[0].view(batch_size, eq_samples, iw_samples, -1)
+        x_var_sg = surrogate[1].view(batch_size, eq_samples, iw_samples, -1)
+        a_sg = log_likelihood(x, x_mu_sg, x_var_sg, outputdensity, eps).sum(dim=3) + \
+               weight*(sum([p.sum(dim=3) for p in log_pz]) - sum([p.sum(dim=3) for p in log_qz]))
+        w = torch.softmax(a, dim=2).detach()
+        lower_bound = lower_bound + torch.mean(((w**2 - w) * (a_sg - a_sg.detach())).sum(dim=2))
     recon_term = log_px.sum(dim=3).mean()
     kl_term = [(lp-lq).sum(dim=3).mean() for lp,lq in zip(log_pz, log_qz)]
     return lower_bound, recon_term, kl_term
 
+#%%
+def log_likelihood(x, x_mu, x_var, outputdensity, eps=1e-5):
+    """ Log probability of the output density elementwise """
+    if outputdensity == 'bernoulli':
+        x_mu = x_mu.clamp(1e-5, 1-1e-5)
+        return x * x_mu.log() + (1-x) * (1-x_mu).log()
+    elif outputdensity == 'gaussian':
+        return log_normal2(x, x_mu, torch.log(x_var+eps), eps)
+    else:
+        raise ValueError('Unknown output density')
+
 #%%
 def log_stdnormal(x):
     """ Log probability of standard normal distribution elementwise """
@@ -85,4 +124,4 @@ def kl_scaling(epoch=None, warmup=None):
     if epoch is None or warmup is None:
         return 1
     else:
-        return float(np.min([epoch / warmup, 1]))
\ No newline at end of file
+        return min(epoch / warmup, 1.0)
\ No newline at end of file
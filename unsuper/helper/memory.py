@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#%%
+import os, json
+from collections import defaultdict
+import torch
+from .hooks import hook
+
+#%%
+_kinds = ['params', 'buffers', 'grads', 'optimizer', 'activations']
+
+def tensor_bytes(t):
+    return t.numel() * t.element_size()
+
+def _group(name, depth):
+    """ Name of the submodule (at given depth) that a parameter/module belongs to """
+    return '.'.join(name.split('.')[:depth]) or '<root>'
+
+def _module_name(param_name):
+    return param_name.rsplit('.', 1)[0] if '.' in param_name else ''
+
+#%%
+def module_memory(model, optimizer=None, depth=1):
+    """ Bytes of parameters, buffers, gradients and optimizer state for each
+        submodule of a model
+    Arguments:
+        model: torch.nn.Module
+        optimizer: torch.optim.Optimizer or None
+        depth: integer, depth of the submodules that memory is grouped by
+            (1 = direct children, e.g. encoder1, decoder1, stn)
+    Output:
+        report: dict, submodule name -> dict with bytes of each kind
+    """
+    report = defaultdict(lambda: dict.fromkeys(_kinds, 0))
+    state = optimizer.state if optimizer is not None else { }
+    for name, p in model.named_parameters():
+        g = _group(_module_name(name), depth)
+        report[g]['params'] += tensor_bytes(p)
+        if p.grad is not None:
+            report[g]['grads'] += tensor_bytes(p.grad)
+        for v in state.get(p, { }).values():
+            if torch.is_tensor(v): report[g]['optimizer'] += tensor_bytes(v)
+    for name, b in model.named_buffers():
+        report[_group(_module_name(name), depth)]['buffers'] += tensor_bytes(b)
+    return dict(report)
+
+#%%
+class activation_tracker:
+    """ Context manager that attributes the bytes of the tensors saved for the
+        backward pass to the submodule (at given depth) whose forward created
+        them. Parameters that are saved (e.g. weights of a Linear layer) and
+        tensors saved multiple times are only counted once. Stages that are
+        checkpointed do not save activations, and are therefore not counted
+    Arguments:
+        model: torch.nn.Module
+        depth: integer, depth of the submodules to attribute activations to
+    """
+    def __init__(self, model, depth=1):
+        self.model = model
+        self.depth = depth
+        self.bytes = defaultdict(int)
+
+    def __enter__(self):
+        self.bytes = defaultdict(int)
+        self.stack = ['<root>']
+        self.seen = set(p.data_ptr() for p in self.model.parameters())
+        self.handles = [ ]
+        for name, m in self.model.named_modules():
+            if name and name.count('.') == self.depth - 1:
+                self.handles.append(m.register_forward_pre_hook(
+                        lambda m, i, name=name: self.stack.append(name)))
+                self.handles.append(m.register_forward_hook(
+                        lambda m, i, o: self.stack.pop()))
+        self.saved_hooks = torch.autograd.graph.saved_tensors_hooks(self._pack, lambda t: t)
+        self.saved_hooks.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        self.saved_hooks.__exit__(*args)
+        for h in self.handles: h.remove()
+
+    def _pack(self, t):
+        key = (t.data_ptr(), t.shape)
+        if t.data_ptr() not in self.seen and key not in self.seen:
+            self.seen.add(key)
+            self.bytes[self.stack[-1]] += tensor_bytes(t)
+        return t
+
+#%%
+def memory_report(model, optimizer=None, activations=None, depth=1):
+    """ Combines module_memory with the activations from an activation_tracker
+    Output:
+        report: dict, submodule name -> dict with bytes of each kind and the total
+        totals: dict, bytes of each kind summed over all submodules
+    """
+    report = module_memory(model, optimizer, depth)
+    for name, b in (activations or { }).items():
+        report.setdefault(name, dict.fromkeys(_kinds, 0))['activations'] += b
+    for r in report.values():
+        r['total'] = sum([r[k] for k in _kinds])
+    totals = {k: sum([r[k] for r in report.values()]) for k in _kinds + ['total']}
+    return report, totals
+
+#%%
+def top_consumers(report, k=10):
+    """ The k largest (submodule, kind, bytes) entries of a memory report """
+    entries = [(name, kind, r[kind]) for name, r in report.items() for kind in _kinds]
+    return sorted(entries, key=lambda e: -e[2])[:k]
+
+#%%
+def print_report(report, totals):
+    mb = lambda b: b / 2**20
+    print('{0:20s}'.format('module') + ''.join(['{0:>13s}'.format(k + ' MB')
+                                                for k in _kinds + ['total']]))
+    for name, r in sorted(report.items(), key=lambda e: -e[1]['total']):
+        print('{0:20s}'.format(name) + ''.join(['{0:13.2f}'.format(mb(r[k]))
+                                                for k in _kinds + ['total']]))
+    print('{0:20s}'.format('total') + ''.join(['{0:13.2f}'.format(mb(totals[k]))
+                                               for k in _kinds + ['total']]))
+
+#%%
+class memory_hook(hook):
+    """ Trainer hook that every N steps records parameter, gradient, optimizer
+        state and activation bytes per submodule, and memory for each phase of
+        the step: the peak allocated memory on the gpu, or the resident set 
+        size of the process at the end of the phase on the cpu (tagged 
+        memory/peak_<phase>_mb and memory/rss_<phase>_mb). Other steps are not
+        affected.
+        Results are written to tensorboard, and the last report is saved as
+        json in the logdir at the end of training
+    Arguments:
+        every: integer, number of steps between measurements
+        depth: integer, depth of the submodules memory is grouped by
+        top_k: integer, number of top consumers to print
+        filename: str, name of the json report in the logdir
+    """
+    def __init__(self, every=100, depth=1, top_k=10, filename='memory.json'):
+        self.every = every
+        self.depth = depth
+        self.top_k = top_k
+        self.filename = filename
+        self.tracker = None
+        self.report = None
+
+    def on_train_start(self, trainer, writer, logdir):
+        self.writer = writer
+        self.path = os.path.join(logdir, self.filename)
+        self.mode = 'cuda' if trainer.device.type == 'cuda' else 'cpu'
+
+    def on_batch_start(self, trainer, step):
+        if step % self.every != 0: return
+        self.tracker = activation_tracker(trainer.model, self.depth).__enter__()
+        trainer.timer.track_memory = self.mode
+
+    def on_batch_end(self, trainer, step, stats):
+        if self.tracker is None: return
+        self.tracker.__exit__(None, None, None)
+        trainer.timer.track_memory = False
+        peaks = trainer.timer.reset_peaks()
+        report, totals = memory_report(trainer.model, trainer.optimizer,
+                                       self.tracker.bytes, self.depth)
+        self.tracker = None
+
+        for name, r in report.items():
+            for kind in _kinds:
+                self.writer.add_scalar('memory/' + name + '/' + kind + '_mb', r[kind] / 2**20, step)
+        for kind, b in totals.items():
+            self.writer.add_scalar('memory/total_' + kind + '_mb', b / 2**20, step)
+        prefix = 'peak' if self.mode == 'cuda' else 'rss'
+        for phase, b in peaks.items():
+            self.writer.add_scalar('memory/' + prefix + '_' + phase + '_mb', b / 2**20, step)
+        self.report = {'step': step, 'modules': report, 'totals': totals,
+                       prefix + '_per_phase': peaks,
+                       'top_consumers': top_consumers(report, self.top_k)}
+
+    def on_train_end(self, trainer):
+        if trainer.rank != 0 or self.report is None: return
+        with open(self.path, 'w') as f:
+            json.dump(self.report, f, indent=2)
+        print('Top memory consumers (step ' + str(self.report['step']) + '):')
+        for name, kind, b in self.report['top_consumers']:
+            print('  {0:20s} {1:12s} {2:10.2f} MB'.format(name, kind, b / 2**20))
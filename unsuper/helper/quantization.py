@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#%%
+import copy, time
+import torch
+from torch import nn
+from .losses import vae_loss
+from .utility import Identity
+
+#%%
+def _quantize_dynamic(model):
+    try:
+        from torch.ao.quantization import quantize_dynamic
+    except ImportError:
+        from torch.quantization import quantize_dynamic
+    return quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+#%%
+def fold_batchnorm(model):
+    """ Folds eval-mode BatchNorm1d layers into the Linear layer that directly
+        follows them in a nn.Sequential (the layout of mlp_encoder), and replaces
+        the BatchNorm with Identity. Works in place.
+
+        BN(x) = s*x + t, with s = gamma / sqrt(var + eps) and t = beta - mean*s
+        W BN(x) + b = (W*s) x + (W t + b)
+    """
+    for module in model.modules():
+        if not isinstance(module, nn.Sequential):
+            continue
+        for i in range(len(module) - 1):
+            bn, linear = module[i], module[i+1]
+            if not (isinstance(bn, nn.BatchNorm1d) and isinstance(linear, nn.Linear)):
+                continue
+            with torch.no_grad():
+                s = (bn.running_var + bn.eps).rsqrt()
+                if bn.affine: s = s * bn.weight
+                t = -bn.running_mean * s
+                if bn.affine: t = t + bn.bias
+
+                bias = linear.bias if linear.bias is not None else torch.zeros_like(linear.weight[:,0])
+                new_bias = bias + linear.weight.matmul(t)
+                linear.weight.mul_(s[None,:])
+                linear.bias = nn.Parameter(new_bias)
+            module[i] = Identity()
+    return model
+
+#%%
+def quantize_model(model, fold=True):
+    """ Returns a copy of the model where all Linear layers are dynamically
+        quantized to int8 (weights are int8, activations are quantized on the
+        fly). Only for cpu inference.
+    Arguments:
+        model: trained model from unsuper.models.get_model
+        fold: bool, if BatchNorm layers should be folded into the following Linear
+    Output:
+        qmodel: quantized copy of the model in eval mode
+    """
+    qmodel = copy.deepcopy(model).cpu().eval()
+    if fold:
+        fold_batchnorm(qmodel)
+    return _quantize_dynamic(qmodel)
+
+#%%
+def evaluate_elbo(model, loader, input_shape, n_batches=None, seed=0):
+    """ Average ELBO (1 sample) of a model over a loader, evaluated on the cpu.
+        The random seed is fixed such that different versions of the same model
+        see the same noise """
+    model.eval()
+    torch.manual_seed(seed)
+    elbo, n = 0.0, 0
+    with torch.no_grad():
+        for i, (data, _) in enumerate(loader):
+            if n_batches is not None and i >= n_batches: break
+            data = data.reshape(-1, *input_shape).to(torch.float32)
+            out = model(data, 1, 1)
+            loss, _, _ = vae_loss(data, *out, 1, 1, model.latent_dim, None, None,
+                                  1.0, model.outputdensity)
+            elbo += loss.item()
+            n += 1
+    return elbo / max(n, 1)
+
+#%%
+def benchmark_forward(model, data, n_runs=50, n_warmup=5):
+    """ Average number of seconds for a forward pass of a batch """
+    model.eval()
+    with torch.no_grad():
+        for _ in range(n_warmup):
+            model(data)
+        start = time.time()
+        for _ in range(n_runs):
+            model(data)
+    return (time.time() - start) / n_runs
+
+#%%
+def quantization_report(model, qmodel, loader, input_shape, n_batches=None):
+    """ Compares a float model with its quantized version
+    Output:
+        report: dict with the ELBO of both models, the drift of the ELBO and
+            the measured cpu forward time of both models and the speedup
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    elbo_float = evaluate_elbo(model, loader, input_shape, n_batches)
+    elbo_quant = evaluate_elbo(qmodel, loader, input_shape, n_batches)
+
+    data = next(iter(loader))[0].reshape(-1, *input_shape).to(torch.float32)
+    time_float = benchmark_forward(model, data)
+    time_quant = benchmark_forward(qmodel, data)
+    return {'elbo_float': elbo_float,
+            'elbo_quant': elbo_quant,
+            'elbo_drift': elbo_quant - elbo_float,
+            'relative_drift': abs(elbo_quant - elbo_float) / abs(elbo_float),
+            'time_float': time_float,
+            'time_quant': time_quant,
+            'speedup': time_float / time_quant}
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#%%
+import math
+import torch
+from torch import nn
+
+#%%
+def _is_compiling():
+    if hasattr(torch, 'compiler') and hasattr(torch.compiler, 'is_compiling'):
+        return torch.compiler.is_compiling()
+    return False
+
+#%%
+class gaussian_sampler(nn.Module):
+    """ Reparameterized sampling z = mu + sqrt(var) * eps from a diagonal
+        gaussian, with eq_samples x iw_samples samples for each point. The
+        standard deviation is calculated before broadcasting and the samples
+        are calculated in a single fused addcmul.
+    Arguments:
+        noise: str, type of noise
+            'normal' - iid standard normal noise
+            'antithetic' - the samples of each point come in pairs eps, -eps
+            'sobol' - scrambled sobol points mapped through the inverse normal
+                cdf (quasi random)
+        buffered: bool, if True the noise of calls without autograd (e.g.
+            evaluation under torch.no_grad or torch.inference_mode) is written
+            into a buffer that is preallocated on the first call and reused in
+            later calls (it only grows when a larger batch is seen). Calls that
+            record a graph always get fresh noise, since the graph keeps a
+            reference to it, and so do calls inside torch.compile. The buffer
+            is not registered, so the state_dict is unchanged
+    """
+    def __init__(self, noise='normal', buffered=True):
+        super(gaussian_sampler, self).__init__()
+        assert noise in ['normal', 'antithetic', 'sobol'], \
+            'noise should be normal, antithetic or sobol'
+        self.noise = noise
+        self.buffered = buffered
+        self._eps = None
+        self._sobol = None
+
+    #%%
+    def _buffer(self, shape, device, dtype):
+        # Flat buffer that only grows, such that batches of different sizes
+        # (e.g. the last batch of an epoch) reuse it
+        n = math.prod(shape)
+        if self._eps is None or self._eps.numel() < n or \
+           self._eps.device != device or self._eps.dtype != dtype:
+            # A normal tensor, also if the first call is under inference mode,
+            # such that later calls under torch.no_grad can still write to it
+            with torch.inference_mode(False):
+                self._eps = torch.empty(n, device=device, dtype=dtype)
+        return self._eps[:n].view(shape)
+
+    #%%
+    def _sobol_normal(self, n, dim):
+        if self._sobol is None or self._sobol.dimension != dim:
+            self._sobol = torch.quasirandom.SobolEngine(dim, scramble=True)
+        u = self._sobol.draw(n).clamp(1e-6, 1-1e-6)
+        return math.sqrt(2) * torch.erfinv(2*u - 1)
+
+    #%%
+    def sample_noise(self, batch_size, n_samples, latent_dim, device, dtype=torch.float32):
+        """ Noise of shape [batch_size, n_samples, latent_dim] """
+        shape = (batch_size, n_samples, latent_dim)
+        if self.noise == 'sobol':
+            eps = self._sobol_normal(batch_size*n_samples, latent_dim)
+            # Drawn on the cpu by the engine, so no buffer is used
+            return eps.reshape(shape).to(device=device, dtype=dtype)
+
+        # For antithetic noise only the first half is drawn
+        half = (n_samples + 1) // 2 if self.noise == 'antithetic' else n_samples
+        if self.buffered and not torch.is_grad_enabled() and not _is_compiling():
+            eps = self._buffer(shape, device, dtype)
+            eps[:, :half].normal_()
+            if half < n_samples:
+                eps[:, half:].copy_(eps[:, :n_samples-half]).neg_()
+        else:
+            # Out of place, such that autograd, torch.compile and
+            # torch.func.vmap never see the noise change after the call
+            eps = torch.randn(batch_size, half, latent_dim, device=device, dtype=dtype)
+            if half < n_samples:
+                eps = torch.cat([eps, -eps[:, :n_samples-half]], dim=1)
+        return eps
+
+    #%%
+    def forward(self, mu, var, eq_samples=1, iw_samples=1):
+        batch_size, latent_dim = mu.shape
+        # Noise in (at least) float32, also when the encoder runs in bfloat16
+        eps = self.sample_noise(batch_size, eq_samples*iw_samples, latent_dim,
+                                mu.device, torch.promote_types(mu.dtype, torch.float32))
+        z = torch.addcmul(mu[:,None,:], var.sqrt()[:,None,:], eps)
+        return z.reshape(-1, latent_dim)
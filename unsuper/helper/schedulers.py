@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#%%
+import torch
+
+#%%
+class kl_annealing:
+    """ Weight of the KL terms as a function of the training step (counted
+        from 1), between 0 and 1. It is multiplied with beta by the trainer
+    Arguments:
+        kind: str, type of annealing
+            'constant' - always 1
+            'linear' - increases linearly from 0 to 1 over warmup_steps, then 1
+            'cyclical' - repeats a cycle of cycle_steps, where the weight
+                increases linearly over the first ratio of the cycle and is 1
+                for the rest of it
+        warmup_steps: integer, number of steps of the linear warmup
+        cycle_steps: integer, number of steps in each cycle
+        ratio: float, share of each cycle where the weight increases
+    """
+    def __init__(self, kind='linear', warmup_steps=1, cycle_steps=None, ratio=0.5):
+        assert kind in ['constant', 'linear', 'cyclical'], \
+            'kind should be constant, linear or cyclical'
+        assert kind != 'cyclical' or cycle_steps is not None, \
+            'cyclical annealing needs cycle_steps'
+        self.kind = kind
+        self.warmup_steps = max(warmup_steps, 1)
+        self.cycle_steps = cycle_steps
+        self.ratio = ratio
+
+    def __call__(self, step):
+        if self.kind == 'constant':
+            return 1.0
+        if self.kind == 'linear':
+            return min(step / self.warmup_steps, 1.0)
+        position = ((step - 1) % self.cycle_steps + 1) / self.cycle_steps
+        return min(position / self.ratio, 1.0)
+
+#%%
+class switch_schedule:
+    """ The switch between a fixed output variance (0) and the learned output
+        variance (1) as a function of the training step (counted from 1)
+    Arguments:
+        start_steps: integer, number of steps with switch 0
+        ramp_steps: integer, number of steps after start_steps over which the
+            switch increases linearly to 1 (0 means that it jumps to 1)
+    """
+    def __init__(self, start_steps=0, ramp_steps=0):
+        self.start_steps = start_steps
+        self.ramp_steps = ramp_steps
+
+    def __call__(self, step):
+        if step <= self.start_steps:
+            return 0.0
+        if self.ramp_steps == 0:
+            return 1.0
+        return min((step - self.start_steps) / self.ramp_steps, 1.0)
+
+#%%
+def get_lr_scheduler(name, optimizer, total_steps):
+    """ Learning rate scheduler that is stepped after every optimizer step.
+        The learning rate of the optimizer is the peak learning rate
+    Arguments:
+        name: str, 'constant' (returns None), 'onecycle' or 'cosine'
+        optimizer: torch.optim.Optimizer
+        total_steps: integer, total number of training steps
+    """
+    assert name in ['constant', 'onecycle', 'cosine'], \
+        'lr schedule should be constant, onecycle or cosine'
+    if name == 'onecycle':
+        return torch.optim.lr_scheduler.OneCycleLR(
+                optimizer, max_lr=[g['lr'] for g in optimizer.param_groups],
+                total_steps=total_steps)
+    if name == 'cosine':
+        return torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=total_steps)
+    return None
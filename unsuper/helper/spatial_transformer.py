@@ -10,9 +10,10 @@ import torch
 from torch import nn
 from torch.nn import functional as F
 from .expm import torch_expm
-from .utility import construct_affine
+from .utility import construct_affine, float32_op
 
 #%%
+@float32_op
 def expm(theta): 
     n_theta = theta.shape[0] 
     zero_row = torch.zeros(n_theta, 1, 3, dtype=theta.dtype, device=theta.device) 
@@ -22,24 +23,51 @@ def expm(theta):
     return theta 
 
 #%%
-class ST_Affine(nn.Module):
+class _AffineWarp(nn.Module):
+    """ Base class for the affine transformers. The homogeneous identity grid
+        of the fixed input shape is cached per (device, dtype), such that the
+        sampling grid is a single batched matmul with theta. Same result as 
+        F.affine_grid + F.grid_sample with align_corners=False """
     def __init__(self, input_shape):
-        super(ST_Affine, self).__init__()
+        super(_AffineWarp, self).__init__()
         self.input_shape = input_shape
+        self._grids = { }
+    
+    def base_grid(self, device, dtype):
+        """ Identity grid [H*W, 3] with rows (x, y, 1) """
+        key = (device, dtype)
+        if key not in self._grids:
+            H, W = self.input_shape[-2:]
+            # Not an inference tensor, since it is saved for backward in training
+            with torch.inference_mode(False):
+                xs = (2*torch.arange(W, device=device, dtype=dtype) + 1) / W - 1
+                ys = (2*torch.arange(H, device=device, dtype=dtype) + 1) / H - 1
+                self._grids[key] = torch.stack([xs.repeat(H), ys.repeat_interleave(W),
+                                                torch.ones(H*W, device=device, dtype=dtype)], dim=1)
+        return self._grids[key]
+    
+    def warp(self, x, theta):
+        """ Warps the images x [N, C, H, W] with the affine matrices theta [N, 2, 3] """
+        H, W = self.input_shape[-2:]
+        grid = torch.matmul(self.base_grid(theta.device, theta.dtype), theta.transpose(1, 2))
+        return F.grid_sample(x, grid.view(-1, H, W, 2), align_corners=False)
+
+#%%
+class ST_Affine(_AffineWarp):
+    def __init__(self, input_shape):
+        super(ST_Affine, self).__init__(input_shape)
         
+    @float32_op
     def forward(self, x, theta, inverse=False):
         if inverse:
-            A = theta[:,:4]
-            b = theta[:,4:]
-            A = torch.inverse(A.view(-1, 2, 2)).reshape(-1, 4)
-            b = -b
+            # Closed form inverse of the 2x2 part
+            a, b, c, d = theta[:,0:1], theta[:,1:2], theta[:,2:3], theta[:,3:4]
+            A = torch.cat((d, -b, -c, a), dim=1) / (a*d - b*c)
+            b = -theta[:,4:]
             theta = torch.cat((A,b), dim=1)
             
         theta = theta.view(-1, 2, 3)
-        output_size = torch.Size([x.shape[0], *self.input_shape])
-        grid = F.affine_grid(theta, output_size)
-        x = F.grid_sample(x, grid)
-        return x
+        return self.warp(x, theta)
     
     def trans_theta(self, theta):
         return theta
@@ -48,11 +76,11 @@ class ST_Affine(nn.Module):
         return 6
 
 #%%
-class ST_AffineDecomp(nn.Module):
+class ST_AffineDecomp(_AffineWarp):
     def __init__(self, input_shape):
-        super(ST_AffineDecomp, self).__init__()
-        self.input_shape = input_shape
+        super(ST_AffineDecomp, self).__init__(input_shape)
         
+    @float32_op
     def forward(self, x, theta, inverse=False):
         # theta = [sx, sy, angle, shear, tx, ty]
         if inverse:
@@ -61,10 +89,7 @@ class ST_AffineDecomp(nn.Module):
             
         theta = construct_affine(theta)
         theta = theta.view(-1, 2, 3)
-        output_size = torch.Size([x.shape[0], *self.input_shape])
-        grid = F.affine_grid(theta, output_size)
-        x = F.grid_sample(x, grid)
-        return x
+        return self.warp(x, theta)
             
     def trans_theta(self, theta):
         return theta
@@ -73,20 +98,17 @@ class ST_AffineDecomp(nn.Module):
         return 6
 
 #%%
-class ST_AffineDiff(nn.Module):
+class ST_AffineDiff(_AffineWarp):
     def __init__(self, input_shape):
-        super(ST_AffineDiff, self).__init__()
-        self.input_shape = input_shape
+        super(ST_AffineDiff, self).__init__(input_shape)
         
+    @float32_op
     def forward(self, x, theta, inverse=False):
         if inverse:
             theta = -theta
         theta = theta.view(-1, 2, 3)
         theta = expm(theta)
-        output_size = torch.Size([x.shape[0], *self.input_shape])
-        grid = F.affine_grid(theta, output_size)
-        x = F.grid_sample(x, grid)
-        return x
+        return self.warp(x, theta)
     
     def trans_theta(self, theta):
         return expm(theta)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#%%
+import torch
+
+#%%
+class batch_statistics:
+    """ Moments and fixed-bin histograms of many parameters at once. The
+        statistics of all columns of a [N, P] tensor are computed with a few
+        tensor ops on its device and copied to the cpu in a single transfer,
+        instead of one sync and one auto-binning per parameter
+    Arguments:
+        bins: integer, number of histogram bins (evenly spaced between the
+            min and max of each parameter)
+        every: integer, should_log is only True when at least N epochs have
+            passed since the last logged epoch, such that the values need not
+            even be computed. Counted in epochs (not calls), so that sparse
+            test evaluations or repeated calls in the same epoch do not shift it
+    Methods:
+        compute - statistics of each column of a tensor
+        should_log - if statistics should be logged in a given epoch
+        log - writes histograms and means of each column to tensorboard
+    """
+    def __init__(self, bins=50, every=1):
+        self.bins = bins
+        self.every = every
+        self.last_epoch = None
+
+    #%%
+    def compute(self, values):
+        """ Statistics of each column of values (a [N, P] tensor)
+        Output:
+            stats: dict with cpu tensors min, max, mean, sum, sum_squares (size
+                P), bucket_limits and bucket_counts (size P x bins) and num
+        """
+        values = values.detach().to(torch.float32)
+        n, p = values.shape
+        lo, hi = values.min(dim=0)[0], values.max(dim=0)[0]
+        width = (hi - lo).clamp_min(1e-12) / self.bins
+        idx = ((values - lo) / width).long().clamp_(0, self.bins-1)
+        counts = torch.zeros(p, self.bins, device=values.device)
+        counts.scatter_add_(1, idx.t(), torch.ones_like(idx.t(), dtype=counts.dtype))
+        limits = lo[:,None] + width[:,None] * torch.arange(1, self.bins+1, device=values.device)
+        s, s2 = values.sum(dim=0), values.pow(2).sum(dim=0)
+
+        # Single transfer of all statistics to the cpu
+        flat = torch.cat([lo, hi, s, s2, limits.flatten(), counts.flatten()]).cpu()
+        lo, hi, s, s2, limits, counts = torch.split(flat, 4*[p] + 2*[p*self.bins])
+        return {'min': lo, 'max': hi, 'mean': s / n, 'sum': s, 'sum_squares': s2,
+                'bucket_limits': limits.reshape(p, -1),
+                'bucket_counts': counts.reshape(p, -1), 'num': n}
+
+    #%%
+    def should_log(self, epoch):
+        """ True for the first call, and afterwards when at least N epochs have
+            passed since the last epoch that was logged """
+        if self.last_epoch is not None and epoch - self.last_epoch < self.every:
+            return False
+        self.last_epoch = epoch
+        return True
+
+    #%%
+    def log(self, writer, prefix, tags, values, global_step=None):
+        """ Writes a histogram (prefix + tag) and the mean (prefix + mean_ + tag)
+            of each column of values to the writer """
+        stats = self.compute(values)
+        for i, tag in enumerate(tags):
+            writer.add_histogram_raw(prefix + tag,
+                                     min=stats['min'][i].item(),
+                                     max=stats['max'][i].item(),
+                                     num=stats['num'],
+                                     sum=stats['sum'][i].item(),
+                                     sum_squares=stats['sum_squares'][i].item(),
+                                     bucket_limits=stats['bucket_limits'][i].tolist(),
+                                     bucket_counts=stats['bucket_counts'][i].tolist(),
+                                     global_step=global_step)
+            writer.add_scalar(prefix + 'mean_' + tag, stats['mean'][i].item(),
+                              global_step=global_step)
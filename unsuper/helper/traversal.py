@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#%%
+import torch
+from torchvision.utils import make_grid
+
+#%%
+class traversal_renderer:
+    """ Renders decoded points of the latent space as an image grid. For a 2d
+        latent space this is a n x n meshgrid, for higher dimensions each row
+        is a traversal of one latent dimension (the others are fixed at base,
+        zero by default). The latent points are computed once per latent_dim
+        and device and reused, decoding is done in chunks and the grid stays
+        on the device, such that the only copy to the cpu is done by the writer
+    Arguments:
+        n: integer, number of points along each dimension
+        limit: float, points are placed evenly in [-limit, limit]
+        chunk_size: integer, maximal number of points decoded at once
+        max_dims: integer, maximal number of dimensions to traverse
+    Methods:
+        points - the latent points of the grid
+        decode - applies a decoding function to the points in chunks
+        render - the image grid of the decoded points
+    """
+    def __init__(self, n=20, limit=3.0, chunk_size=512, max_dims=10):
+        self.n = n
+        self.limit = limit
+        self.chunk_size = chunk_size
+        self.max_dims = max_dims
+        self._points = { }
+
+    #%%
+    def _make_points(self, latent_dim, device):
+        """ Latent points and a mask that is 1 for the traversed entries """
+        values = torch.linspace(-self.limit, self.limit, self.n, device=device)
+        if latent_dim == 2:
+            # Same ordering as np.meshgrid(x, y) flattened: x varies along rows
+            y, x = torch.meshgrid(values, values, indexing='ij')
+            z = torch.stack([x.flatten(), y.flatten()], dim=1)
+            return z, torch.ones_like(z)
+        n_dims = min(latent_dim, self.max_dims)
+        idx = torch.arange(n_dims, device=device)
+        z = torch.zeros(n_dims, self.n, latent_dim, device=device)
+        z[idx, :, idx] = values
+        mask = torch.zeros_like(z)
+        mask[idx, :, idx] = 1
+        return z.reshape(-1, latent_dim), mask.reshape(-1, latent_dim)
+
+    #%%
+    def points(self, latent_dim, device, base=None):
+        """ Latent points of the grid, cached per latent_dim and device. The
+            traversals are centered at base (a vector of size latent_dim) """
+        key = (latent_dim, str(device))
+        if key not in self._points:
+            self._points[key] = self._make_points(latent_dim, device)
+        z, mask = self._points[key]
+        if base is not None:
+            # Only the entries that are not traversed are moved to the base
+            z = z + (1 - mask) * base.reshape(1, -1).to(device=device, dtype=z.dtype)
+        return z
+
+    #%%
+    def decode(self, fn, z):
+        """ Applies fn to z in chunks of chunk_size without gradients """
+        with torch.no_grad():
+            return torch.cat([fn(chunk) for chunk in torch.split(z, self.chunk_size)])
+
+    #%%
+    def render(self, fn, latent_dim, device, base=None):
+        """ Image grid of fn (that maps latent points to images) applied to the
+            points of the grid, with one traversal or meshgrid row per row """
+        images = self.decode(fn, self.points(latent_dim, device, base))
+        return make_grid(images, nrow=self.n)
+
+    #%%
+    @staticmethod
+    def tag(latent_dim):
+        """ Tensorboard tag of the grid. 2d latent spaces keep the 'meshgrid'
+            tags the callbacks used before, such that existing dashboards still
+            work. Higher dimensions (not logged before) use 'traversal' """
+        return 'meshgrid' if latent_dim == 2 else 'traversal'
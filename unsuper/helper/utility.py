@@ -6,16 +6,26 @@ Created on Tue Sep 18 12:56:53 2018
 @author: nsde
 """
 #%%
-import os
+import os, functools
 import torch
 from torch import nn
 
 #%% 
-def memconsumption():
-    import gc
-    for obj in gc.get_objects():
-        if torch.is_tensor(obj) or (hasattr(obj, 'data') and torch.is_tensor(obj.data)):
-            print(type(obj), obj.size())
+def memconsumption(model=None, optimizer=None, depth=1):
+    """ Prints the memory used by parameters, buffers, gradients and optimizer
+        state of each submodule of a model and the totals. Without a model,
+        the type and size of every live tensor is printed. See helper.memory
+        for activation tracking and the trainer hook """
+    if model is None:
+        import gc
+        for obj in gc.get_objects():
+            if torch.is_tensor(obj) or (hasattr(obj, 'data') and torch.is_tensor(obj.data)):
+                print(type(obj), obj.size())
+        return
+    from .memory import memory_report, print_report
+    report, totals = memory_report(model, optimizer, depth=depth)
+    print_report(report, totals)
+    return totals
 
 #%%
 def get_dir(file):
@@ -72,6 +82,76 @@ class BatchReshape(nn.Module):
     def forward(self, x):
         return x.view(-1, *self.shape)
 
+#%%
+def _to_float32(x):
+    if torch.is_tensor(x) and x.is_floating_point():
+        return x.to(torch.float32)
+    if isinstance(x, (list, tuple)):
+        return type(x)(_to_float32(xi) for xi in x)
+    return x
+
+def _device_type(args):
+    for a in args:
+        if torch.is_tensor(a): return a.device.type
+        if isinstance(a, (list, tuple)) and a and torch.is_tensor(a[0]): return a[0].device.type
+    return 'cpu'
+
+def float32_op(fn):
+    """ Decorator for numerically sensitive functions. Runs fn with autocast 
+        disabled and all floating point tensor arguments (also inside lists) 
+        casted to float32 """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        args = _to_float32(args)
+        kwargs = {k: _to_float32(v) for k, v in kwargs.items()}
+        with torch.autocast(device_type=_device_type(args), enabled=False):
+            return fn(*args, **kwargs)
+    return wrapper
+
+#%%
+class stage_checkpointer:
+    """ Runs named stages of a model, where the chosen stages are 
+        checkpointed: their intermediate activations are not stored for the
+        backward pass, but recomputed during it. Only used when gradients are
+        needed. Stages containing batchnorm will update the running statistics
+        twice when recomputed
+    Arguments:
+        stages: list of str, the stages a model has
+        checkpoint: list of str or None, the stages to checkpoint
+    """
+    def __init__(self, stages, checkpoint=None):
+        checkpoint = [ ] if checkpoint is None else list(checkpoint)
+        for c in checkpoint:
+            assert c in stages, 'Stage ' + c + ' not found, choose between: ' \
+                    + ', '.join(stages)
+        self.checkpoint = set(checkpoint)
+        
+    def __call__(self, stage, fn, *args):
+        if stage in self.checkpoint and torch.is_grad_enabled():
+            from torch.utils.checkpoint import checkpoint
+            return checkpoint(fn, *args, use_reentrant=False)
+        return fn(*args)
+
+#%%
+class _method_call(nn.Module):
+    """ Module whose forward calls a method of another module """
+    def __init__(self, module, method):
+        super(_method_call, self).__init__()
+        self.module = module
+        self.method = method
+        
+    def forward(self, *args):
+        return getattr(self.module, self.method)(*args)
+
+def detached_call(module, method, *args):
+    """ Calls module.method(*args) with detached parameters (and copies of the
+        buffers, such that batchnorm statistics are not updated twice). 
+        Gradients then only flow through the arguments, not into the 
+        parameters of the module """
+    state = {'module.' + k: p.detach() for k, p in module.named_parameters()}
+    state.update({'module.' + k: b.clone() for k, b in module.named_buffers()})
+    return torch.func.functional_call(_method_call(module, method), state, args)
+
 #%%
 def affine_decompose(A):
     sx = (A[:,0,0].pow(2) + A[:,1,0].pow(2)).sqrt()
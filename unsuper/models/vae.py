@@ -10,11 +10,14 @@ Created on Mon Nov  5 12:33:13 2018
 import torch
 from torch import nn
 import numpy as np
-from torchvision.utils import make_grid
+from ..helper.utility import stage_checkpointer
+from ..helper.sampling import gaussian_sampler
+from ..helper.traversal import traversal_renderer
 
 #%%
 class VAE(nn.Module):
-    def __init__(self, input_shape, latent_dim, encoder, decoder, outputdensity, **kwargs):
+    def __init__(self, input_shape, latent_dim, encoder, decoder, outputdensity, 
+                 checkpoint=None, noise='normal', **kwargs):
         super(VAE, self).__init__()
         # Constants
         self.input_shape = input_shape
@@ -34,20 +37,37 @@ class VAE(nn.Module):
         # Define encoder and decoder
         self.encoder = encoder(input_shape, latent_dim)
         self.decoder = decoder(input_shape, latent_dim, outputnonlin)
+        
+        # Stages that are recomputed in the backward pass instead of stored
+        self.stage = stage_checkpointer(['encoder', 'decoder'], checkpoint)
+        
+        # Reparameterized sampling of the latent space
+        self.sampler = gaussian_sampler(noise)
+        
+        # Visualization of the latent space
+        self.renderer = traversal_renderer()
     
     #%%
-    def reparameterize(self, mu, var, eq_samples=1, iw_samples=1):
-        batch_size, latent_dim = mu.shape
-        eps = torch.randn(batch_size, eq_samples, iw_samples, latent_dim, device=var.device)
-        return (mu[:,None,None,:] + var[:,None,None,:].sqrt() * eps).reshape(-1, latent_dim)
+    def forward(self, x, eq_samples=1, iw_samples=1, switch=1.0):
+        z_mu, z_var = self.stage('encoder', self.encoder, x)
+        z = self.sampler(z_mu, z_var, eq_samples, iw_samples)
+        x_mu, x_var = self.stage('decoder', self.decoder, z)
+        x_var = switch*x_var + (1-switch)*(1**2)
+        return x_mu, x_var, [z], [z_mu], [z_var]
     
     #%%
-    def forward(self, x, eq_samples=1, iw_samples=1, switch=1.0):
+    def posterior(self, x, z):
+        """ Parameters of q(z|x), given the samples z (unused, since there is
+            only one latent space) """
         z_mu, z_var = self.encoder(x)
-        z = self.reparameterize(z_mu, z_var, eq_samples, iw_samples)
-        x_mu, x_var = self.decoder(z)
+        return [z_mu], [z_var]
+    
+    #%%
+    def likelihood(self, z, switch=1.0):
+        """ Parameters of p(x|z), given the samples z """
+        x_mu, x_var = self.decoder(z[0])
         x_var = switch*x_var + (1-switch)*(1**2)
-        return x_mu, x_var, [z], [z_mu], [z_var]
+        return x_mu, x_var
     
     #%%
     def sample(self, n):
@@ -68,7 +88,7 @@ class VAE(nn.Module):
     #%%
     def semantics(self, x, eq_samples=1, iw_samples=1, switch=1.0):
         z_mu, z_var = self.encoder(x)
-        z = self.reparameterize(z_mu, z_var, eq_samples, iw_samples)
+        z = self.sampler(z_mu, z_var, eq_samples, iw_samples)
         x_mu, x_var = self.decoder(z)
         x_var = switch*x_var + (1-switch)*(1**2)
         return x_mu, x_var, [z], [z_mu], [z_var]
@@ -80,16 +100,12 @@ class VAE(nn.Module):
     
     #%%
     def callback(self, writer, loader, epoch):
-        # If 2d latent space we can make a fine meshgrid of sampled points
-        if self.latent_dim == 2:
-            device = next(self.parameters()).device
-            x = np.linspace(-3, 3, 20)
-            y = np.linspace(-3, 3, 20)
-            z = np.stack([array.flatten() for array in np.meshgrid(x,y)], axis=1)
-            z = torch.tensor(z, dtype=torch.float32)
-            out_mu, out_var = self.decoder(z.to(device))
-            writer.add_image('samples/meshgrid', make_grid(out_mu.cpu(), nrow=20),
-                             global_step=epoch)
+        # Fine meshgrid of sampled points if 2d latent space, else traversals
+        # of each latent dimension
+        device = next(self.parameters()).device
+        grid = self.renderer.render(lambda z: self.decoder(z)[0], self.latent_dim, device)
+        writer.add_image('samples/' + self.renderer.tag(self.latent_dim), grid,
+                         global_step=epoch)
     
 #%%
 if __name__ == '__main__':
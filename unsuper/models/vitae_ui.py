@@ -10,12 +10,16 @@ import torch
 from torch import nn
 import numpy as np
 from torchvision.utils import make_grid
-from ..helper.utility import affine_decompose, Identity
+from ..helper.utility import affine_decompose, Identity, stage_checkpointer
 from ..helper.spatial_transformer import get_transformer
+from ..helper.sampling import gaussian_sampler
+from ..helper.traversal import traversal_renderer
+from ..helper.statistics import batch_statistics
 
 #%%
 class VITAE_UI(nn.Module):
-    def __init__(self, input_shape, latent_dim, encoder, decoder, outputdensity, ST_type, **kwargs):
+    def __init__(self, input_shape, latent_dim, encoder, decoder, outputdensity, ST_type, 
+                 checkpoint=None, noise='normal', stats_every=1, **kwargs):
         super(VITAE_UI, self).__init__()
         # Constants
         self.input_shape = input_shape
@@ -41,31 +45,57 @@ class VITAE_UI(nn.Module):
         
         self.encoder2 = encoder(input_shape, latent_dim)
         self.decoder2 = decoder(input_shape, latent_dim, outputnonlin)
+        
+        # Stages that are recomputed in the backward pass instead of stored
+        self.stage = stage_checkpointer(['encoder', 'decoder', 'stn'], checkpoint)
+        
+        # Reparameterized sampling of each latent space
+        self.sampler1 = gaussian_sampler(noise)
+        self.sampler2 = gaussian_sampler(noise)
+        
+        # Visualization of the latent spaces
+        self.renderer = traversal_renderer()
+        self.stats = batch_statistics(every=stats_every)
 
-    #%%
-    def reparameterize(self, mu, var, eq_samples=1, iw_samples=1):
-        batch_size, latent_dim = mu.shape
-        eps = torch.randn(batch_size, eq_samples, iw_samples, latent_dim, device=var.device)
-        return (mu[:,None,None,:] + var[:,None,None,:].sqrt() * eps).reshape(-1, latent_dim)
-    
     #%%
     def forward(self, x, eq_samples=1, iw_samples=1, switch=1.0):
         # Encode/decode transformer space
-        mu1, var1 = self.encoder1(x)
-        z1 = self.reparameterize(mu1, var1, eq_samples, iw_samples)
-        theta_mean, theta_var = self.decoder1(z1)
+        mu1, var1 = self.stage('encoder', self.encoder1, x)
+        z1 = self.sampler1(mu1, var1, eq_samples, iw_samples)
+        theta_mean, theta_var = self.stage('decoder', self.decoder1, z1)
         
         # Encode/decode semantic space
-        mu2, var2 = self.encoder2(x)
-        z2 = self.reparameterize(mu2, var2, eq_samples, iw_samples)
-        x_mean, x_var = self.decoder2(z2)
+        mu2, var2 = self.stage('encoder', self.encoder2, x)
+        z2 = self.sampler2(mu2, var2, eq_samples, iw_samples)
+        x_mean, x_var = self.stage('decoder', self.decoder2, z2)
         
         # Transform output
-        x_mean = self.stn(x_mean, theta_mean, inverse=False)
-        x_var = self.stn(x_var, theta_mean, inverse=False)
+        x_mean, x_var = self.stage('stn', self._detransform, x_mean, x_var, theta_mean)
         x_var = switch*x_var + (1-switch)*0.02**2
         
         return x_mean, x_var, [z1, z2], [mu1, mu2], [var1, var2]
+    
+    #%%
+    def _detransform(self, x_mean, x_var, theta_mean):
+        return self.stn(x_mean, theta_mean, inverse=False), \
+               self.stn(x_var, theta_mean, inverse=False)
+
+    #%%
+    def posterior(self, x, z):
+        """ Parameters of q(z1|x) and q(z2|x), given the samples [z1, z2] 
+            (unused, since the latent spaces are independent given x) """
+        mu1, var1 = self.encoder1(x)
+        mu2, var2 = self.encoder2(x)
+        return [mu1, mu2], [var1, var2]
+    
+    #%%
+    def likelihood(self, z, switch=1.0):
+        """ Parameters of p(x|z1,z2), given the samples [z1, z2] """
+        theta_mean, theta_var = self.decoder1(z[0])
+        x_mean, x_var = self.decoder2(z[1])
+        x_mean, x_var = self._detransform(x_mean, x_var, theta_mean)
+        x_var = switch*x_var + (1-switch)*0.02**2
+        return x_mean, x_var
 
     #%%
     def sample(self, n):
@@ -121,10 +151,10 @@ class VITAE_UI(nn.Module):
     #%%
     def semantics(self, x, eq_samples=1, iw_samples=1, switch=1.0):
         mu1, var1 = self.encoder1(x)
-        z1 = self.reparameterize(mu1, var1, eq_samples, iw_samples)
+        z1 = self.sampler1(mu1, var1, eq_samples, iw_samples)
         theta_mean, theta_var = self.decoder1(z1)
         mu2, var2 = self.encoder2(x)
-        z2 = self.reparameterize(mu2, var2, eq_samples, iw_samples)
+        z2 = self.sampler2(mu2, var2, eq_samples, iw_samples)
         x_mean, x_var = self.decoder2(z2)
         return x_mean, x_var, [z1, z2], [mu1, mu2], [var1, var2]
     
@@ -149,36 +179,24 @@ class VITAE_UI(nn.Module):
                           global_step=epoch)
         del samples
         
-        # Lets log a histogram of the transformation
-        theta = self.sample_transformation(1000)
-        for i in range(theta.shape[1]):
-            writer.add_histogram('transformation/a' + str(i), theta[:,i], 
-                                 global_step=epoch, bins='auto')
-            writer.add_scalar('transformation/mean_a' + str(i), theta[:,i].mean(),
-                              global_step=epoch)
-        
-        # Also to a decomposition of the matrix and log these values
-        if self.stn.dim() == 6:
-            values = affine_decompose(theta.view(-1, 2, 3))
-            tags = ['sx', 'sy', 'm', 'theta', 'tx', 'ty']
-            for i in range(6):
-                writer.add_histogram('transformation/' + tags[i], values[i],
-                                     global_step=epoch, bins='auto')
-                writer.add_scalar('transformation/mean_' + tags[i], values[i].mean(),
-                                  global_step=epoch)
-            del values
-        del theta
+        # Lets log histograms and means of the transformation and (if affine) 
+        # its decomposition, all computed at once
+        if self.stats.should_log(epoch):
+            theta = self.sample_transformation(1000)
+            tags = ['a' + str(i) for i in range(theta.shape[1])]
+            values = theta
+            if self.stn.dim() == 6:
+                tags += ['sx', 'sy', 'm', 'theta', 'tx', 'ty']
+                values = torch.cat([theta, torch.stack(affine_decompose(theta.view(-1, 2, 3)), dim=1)], dim=1)
+            self.stats.log(writer, 'transformation/', tags, values, global_step=epoch)
+            del theta, values
             
-        # If 2d latent space we can make a fine meshgrid of sampled points
-        if self.latent_dim == 2:
-            device = next(self.parameters()).device
-            x = np.linspace(-3, 3, 20)
-            y = np.linspace(-3, 3, 20)
-            z = np.stack([array.flatten() for array in np.meshgrid(x,y)], axis=1)
-            z = torch.tensor(z, dtype=torch.float32)
-            trans = torch.tensor(np.zeros(self.stn.dim()), dtype=torch.float32).repeat(20*20, 1)
-            x_mean, x_var = self.decoder2(z.to(device))
-            out = self.stn(x_mean, trans.to(device))
-            writer.add_image('samples/meshgrid', make_grid(out.cpu(), nrow=20),
-                             global_step=epoch)
-            del out
\ No newline at end of file
+        # Fine meshgrid of sampled points if 2d latent space, else traversals
+        # of each latent dimension
+        device = next(self.parameters()).device
+        trans = torch.zeros(1, self.stn.dim(), device=device)
+        grid = self.renderer.render(lambda z: self.stn(self.decoder2(z)[0], trans.expand(len(z), -1)),
+                                    self.latent_dim, device)
+        writer.add_image('samples/' + self.renderer.tag(self.latent_dim), grid,
+                         global_step=epoch)
+        del grid
\ No newline at end of file
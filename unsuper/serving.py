@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#%%
+import json, queue, threading, time
+from collections import deque
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+import torch
+from .helper.export import reconstruction_graph
+
+#%%
+class _request:
+    def __init__(self, payload, size):
+        self.payload = payload
+        self.size = size
+        self.time = time.time()
+        self.future = Future()
+
+#%%
+class batch_metrics:
+    """ Keeps track of throughput and latency of a micro batcher """
+    def __init__(self, window=1000):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.requests = 0
+        self.items = 0
+        self.batches = 0
+        self.largest_batch = 0
+        self.latencies = deque(maxlen=window)
+
+    def update(self, batch):
+        now = time.time()
+        n = sum([r.size for r in batch])
+        with self.lock:
+            self.requests += len(batch)
+            self.items += n
+            self.batches += 1
+            self.largest_batch = max(self.largest_batch, n)
+            self.latencies.extend([now - r.time for r in batch])
+
+    def summary(self):
+        with self.lock:
+            elapsed = time.time() - self.start
+            lat = 1000*np.array(self.latencies) if self.latencies else np.zeros(1)
+            return {'requests': self.requests,
+                    'items': self.items,
+                    'batches': self.batches,
+                    'mean_batch_size': self.items / max(self.batches, 1),
+                    'largest_batch_size': self.largest_batch,
+                    'throughput_items_per_sec': self.items / elapsed,
+                    'latency_ms_mean': float(lat.mean()),
+                    'latency_ms_p50': float(np.percentile(lat, 50)),
+                    'latency_ms_p95': float(np.percentile(lat, 95)),
+                    'latency_ms_p99': float(np.percentile(lat, 99))}
+
+#%%
+class micro_batcher:
+    """ Coalesces concurrent requests into micro batches. A batch is run when
+        it contains max_batch_size items or when the oldest request in it has
+        waited max_latency seconds, whatever comes first. A request that does
+        not fit in the current batch starts the next one
+    Arguments:
+        fn: function that takes a list of payloads and returns a list with one
+            result per payload
+        max_batch_size: integer, maximum number of items in a micro batch
+        max_latency: float, maximum number of seconds a request waits for
+            other requests to join its batch
+    Methods:
+        submit - queue a payload of size items (at most max_batch_size), 
+            returns a concurrent.futures.Future
+        close - stop the worker thread, requests that are still queued fail
+            with a RuntimeError
+    """
+    def __init__(self, fn, max_batch_size=256, max_latency=0.005):
+        self.fn = fn
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.metrics = batch_metrics()
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, payload, size=1):
+        if size > self.max_batch_size:
+            raise ValueError('Request of size {0} is larger than the maximum '
+                             'batch size {1}'.format(size, self.max_batch_size))
+        request = _request(payload, size)
+        # The lock makes sure that nothing is queued after the stop signal
+        with self.lock:
+            if self.closed:
+                raise RuntimeError('micro batcher is closed')
+            self.queue.put(request)
+        return request.future
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        stop, pending = False, None
+        while not stop:
+            request = pending if pending is not None else self.queue.get()
+            pending = None
+            if request is None:
+                break
+            batch, n = [request], request.size
+            deadline = request.time + self.max_latency
+            while n < self.max_batch_size:
+                # After the deadline, only requests that are already queued
+                # are added to the batch
+                timeout = max(deadline - time.time(), 0)
+                try:
+                    request = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if request is None:
+                    stop = True
+                    break
+                if n + request.size > self.max_batch_size:
+                    pending = request
+                    break
+                batch.append(request)
+                n += request.size
+            self._process(batch)
+
+        # Nothing is queued after the stop signal, but fail anything left
+        # rather than letting clients wait forever
+        while True:
+            try:
+                request = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is not None:
+                request.future.set_exception(RuntimeError('micro batcher is closed'))
+
+    def _process(self, batch):
+        try:
+            results = self.fn([r.payload for r in batch])
+            for r, res in zip(batch, results):
+                r.future.set_result(res)
+        except Exception as e:
+            for r in batch:
+                r.future.set_exception(e)
+        self.metrics.update(batch)
+
+#%%
+class inference_server:
+    """ HTTP server that exposes a trained model. Concurrent requests to the
+        same endpoint are coalesced into micro batches, and requests with more
+        than max_batch_size items are split over several micro batches.
+        Reconstructions go through the latent means, so they are deterministic.
+        Endpoints (all POST with a json body, except /metrics):
+            /encode - {"data": images} -> {"latents": [z_1, ..., z_m]}
+            /reconstruct - {"data": images} -> {"reconstruction": images}
+            /sample - {"n": int} -> {"samples": images}
+            /sample_only_trans - {"n": int, "data": image} -> {"samples": images}
+                (only for models with a transformer)
+            /metrics (GET) - throughput and latency of each endpoint
+    Arguments:
+        model: trained model from unsuper.models.get_model
+        input_shape: shape of a single image
+        host: str, host to bind to
+        port: integer, port to bind to (0 picks a free port)
+        max_batch_size: integer, maximum number of items in a micro batch
+        max_latency: float, maximum seconds a request waits for its batch
+    Methods:
+        start - serve in a background thread
+        serve_forever - serve in the calling thread
+        shutdown - stop the server
+    """
+    def __init__(self, model, input_shape, host='127.0.0.1', port=8000,
+                 max_batch_size=256, max_latency=0.005):
+        self.model = model.eval()
+        self.reconstruction = reconstruction_graph(self.model)
+        self.input_shape = input_shape
+        self.max_batch_size = max_batch_size
+        self.device = next(model.parameters()).device
+        self.lock = threading.Lock()
+
+        endpoints = {'/encode': self._encode,
+                     '/reconstruct': self._reconstruct,
+                     '/sample': self._sample}
+        if hasattr(model, 'sample_only_trans'):
+            endpoints['/sample_only_trans'] = self._sample_only_trans
+        self.batchers = {k: micro_batcher(fn, max_batch_size, max_latency)
+                         for k, fn in endpoints.items()}
+
+        self.httpd = ThreadingHTTPServer((host, port), _make_handler(self))
+        self.address = self.httpd.server_address
+        self.thread = None
+
+    #%%
+    def _run(self, fn, *args):
+        with self.lock, torch.inference_mode():
+            return fn(*args)
+
+    def _images(self, payloads):
+        x = torch.cat([p.reshape(-1, *self.input_shape) for p in payloads])
+        return x.to(device=self.device, dtype=torch.float32)
+
+    def _encode(self, payloads):
+        sizes = [p.shape[0] for p in payloads]
+        zs = self._run(self.model.latent_representation, self._images(payloads))
+        zs = [z.cpu().split(sizes) for z in zs]
+        return [[z[i] for z in zs] for i in range(len(payloads))]
+
+    def _reconstruct(self, payloads):
+        sizes = [p.shape[0] for p in payloads]
+        out = self._run(self.reconstruction, self._images(payloads))
+        return out.cpu().split(sizes)
+
+    def _sample(self, payloads):
+        out = self._run(self.model.sample, sum(payloads))
+        return out.cpu().split(payloads)
+
+    def _sample_only_trans(self, payloads):
+        # Repeat each image by the requested number of samples, and sample one
+        # transformation for every row (same as model.sample_only_trans)
+        sizes = [n for n, _ in payloads]
+        imgs = torch.cat([img.reshape(1, *self.input_shape).repeat(n, 1, 1, 1)
+                          for n, img in payloads])
+        out = self._run(self._transform, imgs.to(device=self.device, dtype=torch.float32))
+        return out.cpu().split(sizes)
+
+    def _transform(self, imgs):
+        z1 = torch.randn(imgs.shape[0], self.model.latent_dim, device=self.device)
+        theta_mean, _ = self.model.decoder1(z1)
+        return self.model.stn(imgs, theta_mean)
+
+    #%%
+    def _submit(self, path, payloads, sizes):
+        """ Submit all parts of a request before waiting, such that they can
+            share micro batches with other requests """
+        futures = [self.batchers[path].submit(p, n) for p, n in zip(payloads, sizes)]
+        return [f.result() for f in futures]
+
+    def _split_images(self, body):
+        x = torch.tensor(body['data'], dtype=torch.float32).reshape(-1, *self.input_shape)
+        if x.shape[0] == 0:
+            raise ValueError('data should contain at least one image')
+        xs = x.split(self.max_batch_size)
+        return xs, [c.shape[0] for c in xs]
+
+    def _split_n(self, body):
+        n = int(body.get('n', 1))
+        if n < 1:
+            raise ValueError('n should be at least 1')
+        return [min(self.max_batch_size, n - i) for i in range(0, n, self.max_batch_size)]
+
+    def handle(self, path, body):
+        """ Dispatch a decoded json request to the micro batcher of the endpoint """
+        if path == '/encode':
+            xs, sizes = self._split_images(body)
+            res = self._submit(path, xs, sizes)
+            return {'latents': [torch.cat(z).tolist() for z in zip(*res)]}
+        elif path == '/reconstruct':
+            xs, sizes = self._split_images(body)
+            return {'reconstruction': torch.cat(self._submit(path, xs, sizes)).tolist()}
+        elif path == '/sample':
+            sizes = self._split_n(body)
+            return {'samples': torch.cat(self._submit(path, sizes, sizes)).tolist()}
+        elif path == '/sample_only_trans' and path in self.batchers:
+            sizes = self._split_n(body)
+            img = torch.tensor(body['data'], dtype=torch.float32)
+            res = self._submit(path, [(n, img) for n in sizes], sizes)
+            return {'samples': torch.cat(res).tolist()}
+        raise KeyError(path)
+
+    def metrics(self):
+        return {k[1:]: b.metrics.summary() for k, b in self.batchers.items()}
+
+    #%%
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        for b in self.batchers.values():
+            b.close()
+        if self.thread is not None:
+            self.thread.join()
+
+#%%
+def _make_handler(server):
+    class handler(BaseHTTPRequestHandler):
+        def _reply(self, code, obj):
+            out = json.dumps(obj).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(out)))
+            self.end_headers()
+            self.wfile.write(out)
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                self._reply(200, server.metrics())
+            else:
+                self._reply(404, {'error': 'Unknown endpoint ' + self.path})
+
+        def do_POST(self):
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                body = json.loads(self.rfile.read(length) or b'{}')
+                self._reply(200, server.handle(self.path, body))
+            except KeyError as e:
+                self._reply(404, {'error': 'Unknown endpoint or field ' + str(e)})
+            except Exception as e:
+                self._reply(400, {'error': str(e)})
+
+        def log_message(self, format, *args):
+            pass
+    return handler
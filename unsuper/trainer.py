@@ -7,11 +7,35 @@ Created on Fri Oct 12 12:18:45 2018
 """
 #%%
 import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 from torchvision.utils import make_grid
 from tqdm import tqdm
-import time, os, datetime
+import time, os, datetime, contextlib, copy, warnings
 from tensorboardX import SummaryWriter
-from .helper.losses import vae_loss
+from .helper.losses import vae_loss, kl_scaling
+from .helper.schedulers import kl_annealing, switch_schedule
+from .helper.embeddings import embedding_exporter
+from .helper.hooks import phase_timer
+from .helper.utility import detached_call
+
+#%%
+def _compile_errors():
+    """ Exceptions that torch.compile raises when it can not compile a
+        function (other exceptions are errors in the model itself) """
+    try:
+        from torch._dynamo import exc
+    except ImportError:
+        return ()
+    return tuple([getattr(exc, name) for name in 
+                  ['BackendCompilerFailed', 'Unsupported', 'InternalTorchDynamoError']
+                  if hasattr(exc, name)])
+
+#%%
+class _null_writer:
+    """ Stand-in for the SummaryWriter on processes that are not rank 0 """
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
 
 #%%
 class vae_trainer:
@@ -21,30 +45,88 @@ class vae_trainer:
         model: model (of type torch.nn.Module) to train
         optimizer: optimizer (of type torch.optim.Optimizer) that will be used 
             for the training
+        precision: str, 'fp32' or 'bf16'. With 'bf16' the encoder/decoder
+            layers run under bfloat16 autocast, while the loss, the matrix
+            exponential and the spatial transformers stay in float32
+        compile_mode: str or None, if given the forward pass and loss (and 
+            thereby also the backward pass) are compiled with torch.compile 
+            using this mode ('default', 'reduce-overhead' or 'max-autotune').
+            If compilation fails, a warning is given and training continues
+            in eager mode. Graph breaks and recompilations do not fail, run
+            with TORCH_LOGS=graph_breaks,recompiles to see them
+        micro_batch_size: integer or None, if given each batch is split into
+            chunks of this size that are run forward and backward one at a 
+            time, with the gradients accumulated before the optimizer step. 
+            Since all terms of the bound are means over the batch, chunk losses
+            are weighted by their share of the batch and the update equals the
+            full batch update (up to batchnorm statistics). Trades memory for 
+            time, memory per chunk scales with micro_batch_size x eq_samples 
+            x iw_samples
+        estimator: str, gradient estimator used in training, 'iwae', 'stl' 
+            or 'dreg' (see helper.losses.vae_loss). stl and dreg give encoder
+            gradients with a better signal-to-noise ratio for many iw_samples.
+            stl runs the encoders once more (with detached parameters), dreg
+            also the decoders
+        
+        If torch.distributed is initialized when the trainer is created (e.g.
+        when launched with torchrun), the model is wrapped in 
+        DistributedDataParallel. Only rank 0 logs to tensorboard and saves
+        embeddings, and the reported losses are summed over all ranks
     Methods:
         fit - for training the network
-        save_embeddings - embeds data into the learned spaces, saves to tensorboard
+        train_step - a single optimization step on a batch
+        chunk_step - forward and backward of a chunk, without optimizer step
+        save_embeddings - embeds data into the learned spaces, streams them to
+            memory-mapped files in the logdir and saves a subset to tensorboard
     """
-    def __init__(self, input_shape, model, optimizer):
+    def __init__(self, input_shape, model, optimizer, precision='fp32', 
+                 compile_mode=None, micro_batch_size=None, estimator='iwae'):
+        assert precision in ['fp32', 'bf16'], 'precision should be fp32 or bf16'
         self.model = model
         self.optimizer = optimizer
         self.input_shape = input_shape
         self.outputdensity = model.outputdensity
+        self.precision = precision
+        self.micro_batch_size = micro_batch_size
+        self.estimator = estimator
         self.use_cuda = True
         
+        # Distributed setup
+        self.distributed = dist.is_available() and dist.is_initialized()
+        self.rank = dist.get_rank() if self.distributed else 0
+        self.world_size = dist.get_world_size() if self.distributed else 1
+        
         # Get the device
         if torch.cuda.is_available() and self.use_cuda:
-            self.device = torch.device('cuda')
+            self.device = torch.device('cuda', self.rank % torch.cuda.device_count())
         else:
             self.device = torch.device('cpu')
             
         # Move model to gpu (if avaible)
         if torch.cuda.is_available() and self.use_cuda:
-            self.model.cuda()
+            self.model.to(self.device)
+        
+        # Model used in the training step. The variance towers are not used
+        # by all models/densities, so DDP needs to look for unused parameters
+        self.train_model = self.model
+        if self.distributed:
+            device_ids = [self.device] if self.device.type == 'cuda' else None
+            self.train_model = DistributedDataParallel(self.model, device_ids=device_ids,
+                                                       find_unused_parameters=True)
+        
+        # Wall time per phase of the training steps
+        self.timer = phase_timer()
+        
+        # Compiled forward pass + loss
+        self.compiled_forward_loss = None
+        if compile_mode is not None:
+            self.compiled_forward_loss = torch.compile(self.forward_loss, mode=compile_mode)
+            self.compile_errors = _compile_errors()
     
     #%%
     def fit(self, trainloader, n_epochs=10, warmup=1, logdir='',
-            testloader=None, eq_samples=1, iw_samples=1, beta=1.0, eval_epoch=10000):
+            testloader=None, eq_samples=1, iw_samples=1, beta=1.0, eval_epoch=10000,
+            monitor=None, hooks=None, kl_schedule=None, switch=None, lr_scheduler=None):
         """ Fits the supplied model to a training set 
         Arguments:
             trainloader: dataloader (of type torch.utils.data.DataLoader) that
@@ -61,6 +143,24 @@ class vae_trainer:
             iw_samples: integer, number of samples the mean-log is calculated over
             eval_epoch: how many epochs that should pass between calculating the
                 L5000 loglikelihood (very expensive to do)
+            monitor: convergence_monitor or None. If given (and a testloader),
+                the test set is only evaluated when the monitor asks for it,
+                training stops when the test ELBO has not improved for 
+                monitor.patience epochs, and the best model is saved to
+                logdir/best_model.pt and restored at the end
+            hooks: list of hooks (see unsuper.helper.hooks), that are called
+                at the start/end of each batch, at the end of each epoch, after
+                each test evaluation and at the start/end of training
+            kl_schedule: function of the training step that gives the weight
+                (times beta) of the KL terms (see unsuper.helper.schedulers).
+                Default is a linear increase over the warmup epochs. It only
+                applies to training, the test ELBO and L5000 always use the 
+                full bound (KL weight 1)
+            switch: function of the training step that gives the switch between
+                fixed and learned output variance. Default switches after the
+                warmup epochs
+            lr_scheduler: torch.optim.lr_scheduler that is stepped after each
+                training step (e.g. from get_lr_scheduler)
         """
         # Assert that input is okay
         assert isinstance(trainloader, torch.utils.data.DataLoader), '''Trainloader
@@ -69,114 +169,175 @@ class vae_trainer:
             number of epochs '''
         
         # Print stats
-        print('Number of training points: ', len(trainloader.dataset))
-        if testloader: print('Number of test points:     ', len(testloader.dataset))
+        main_process = self.rank == 0
+        if main_process:
+            print('Number of training points: ', len(trainloader.dataset))
+            if testloader: print('Number of test points:     ', len(testloader.dataset))
         
         # Dir to log results
         logdir = datetime.datetime.now().strftime('%Y_%m_%d_%H_%M') if logdir is None else logdir
-        if not os.path.exists(logdir): os.makedirs(logdir)
+        if main_process and not os.path.exists(logdir): os.makedirs(logdir)
+        
+        # Summary writer (only rank 0 writes)
+        writer = SummaryWriter(log_dir=logdir) if main_process else _null_writer()
         
-        # Summary writer
-        writer = SummaryWriter(log_dir=logdir)
+        # Hooks, with synchronized timing on gpu such that the phase times are correct
+        hooks = [ ] if hooks is None else hooks
+        self.timer = phase_timer(synchronize=len(hooks) > 0 and self.device.type == 'cuda')
+        self.call_hooks(hooks, 'on_train_start', writer, logdir)
+        
+        # Schedules, that are updated every step
+        if kl_schedule is None:
+            kl_schedule = kl_annealing('linear', warmup_steps=warmup*len(trainloader))
+        if switch is None:
+            switch = switch_schedule(start_steps=warmup*len(trainloader))
         
         # Main loop
         start = time.time()
+        best_state = None
         for epoch in range(1, n_epochs+1):
+            epoch_start = time.time()
             progress_bar = tqdm(desc='Epoch ' + str(epoch) + '/' + str(n_epochs), 
-                                total=len(trainloader.dataset), unit='samples')
+                                total=len(trainloader.dataset), unit='samples',
+                                disable=not main_process)
+            if isinstance(trainloader.sampler, torch.utils.data.DistributedSampler):
+                trainloader.sampler.set_epoch(epoch)
             train_loss = 0
             # Training loop
             self.model.train()
+            self.timer.reset()
+            self.call_hooks(hooks, 'on_batch_start', epoch*len(trainloader))
+            data_start = time.perf_counter()
             for i, (data, _) in enumerate(trainloader):
-                # Zero gradient
-                self.optimizer.zero_grad()
-            
-                # Feed forward data
-                data = data.reshape(-1, *self.input_shape).to(torch.float32).to(self.device)
-                switch = 1.0 if epoch > warmup else 0.0
-                out = self.model(data, eq_samples, iw_samples, switch)
-                
-                # Calculat loss
-                loss, recon_term, kl_terms = vae_loss(data, *out, 
-                                                      eq_samples, iw_samples, 
-                                                      self.model.latent_dim, 
-                                                      epoch, warmup, beta,
-                                                      self.outputdensity)
-                train_loss += float(loss.item())
-                
-                # Backpropegate and optimize
-                # We need to maximize the bound, so in this case we need to
-                # minimize the negative bound
-                (-loss).backward()
-                self.optimizer.step()
+                iteration = epoch*len(trainloader) + i
+                step = (epoch-1)*len(trainloader) + i + 1
+                self.timer.add('data', time.perf_counter() - data_start)
                 
-                # Write to consol
-                progress_bar.update(data.size(0))
-                progress_bar.set_postfix({'loss': loss.item()})
+                # Feed forward data, calculate loss and optimize
+                with self.timer('transfer'):
+                    data = data.reshape(-1, *self.input_shape).to(torch.float32).to(self.device)
+                kl_weight = beta * kl_schedule(step)
+                loss, recon_term, kl_terms = self.train_step(data, eq_samples, 
+                                                             iw_samples, switch(step),
+                                                             kl_weight=kl_weight)
+                if lr_scheduler is not None:
+                    lr_scheduler.step()
                 
-                # Save to tensorboard
-                iteration = epoch*len(trainloader) + i
-                writer.add_scalar('train/total_loss', loss, iteration)
-                writer.add_scalar('train/recon_loss', recon_term, iteration)
+                with self.timer('logging'):
+                    train_loss += float(loss.item())
+                    
+                    # Write to consol
+                    progress_bar.update(data.size(0)*self.world_size)
+                    progress_bar.set_postfix({'loss': loss.item()})
+                    
+                    # Save to tensorboard
+                    writer.add_scalar('train/total_loss', loss, iteration)
+                    writer.add_scalar('train/recon_loss', recon_term, iteration)
+                    writer.add_scalar('train/kl_weight', kl_weight, iteration)
+                    writer.add_scalar('train/lr', self.optimizer.param_groups[0]['lr'], iteration)
+                    
+                    for j, kl_loss in enumerate(kl_terms):
+                        writer.add_scalar('train/KL_loss' + str(j), kl_loss, iteration)
                 
-                for j, kl_loss in enumerate(kl_terms):
-                    writer.add_scalar('train/KL_loss' + str(j), kl_loss, iteration)
-                del loss, recon_term, kl_loss, out
+                self.call_hooks(hooks, 'on_batch_end', iteration, 
+                                {'batch_size': data.size(0), 'loss': loss.item(),
+                                 'times': self.timer.reset()})
+                del loss, recon_term, kl_loss
+                if i + 1 < len(trainloader):
+                    self.call_hooks(hooks, 'on_batch_start', iteration + 1)
+                data_start = time.perf_counter()
                 
+            train_loss = self.reduce(train_loss) / self.world_size
             progress_bar.set_postfix({'Average ELBO': train_loss / len(trainloader)})
             progress_bar.close()
             
             # Log for the training set
-            with torch.no_grad():
-                n = 10
-                data_train = next(iter(trainloader))[0].to(torch.float32).to(self.device)
-                data_train = data[:n].reshape(-1, *self.input_shape)
-                recon_data_train = self.model(data_train)[0]
-                writer.add_image('train/recon', make_grid(torch.cat([data_train, 
-                             recon_data_train]).cpu(), nrow=n), global_step=epoch)
-                samples = self.model.sample(n*n)    
-                writer.add_image('samples/samples', make_grid(samples.cpu(), nrow=n), 
-                                 global_step=epoch)
-                del data_train, recon_data_train, samples
+            n = 10
+            if main_process:
+                with torch.no_grad(), self.timer('visualization'):
+                    data_train = next(iter(trainloader))[0].to(torch.float32).to(self.device)
+                    data_train = data[:n].reshape(-1, *self.input_shape)
+                    recon_data_train = self.model(data_train)[0]
+                    writer.add_image('train/recon', make_grid(torch.cat([data_train, 
+                                 recon_data_train]).cpu(), nrow=n), global_step=epoch)
+                    samples = self.model.sample(n*n)    
+                    writer.add_image('samples/samples', make_grid(samples.cpu(), nrow=n), 
+                                     global_step=epoch)
+                    del data_train, recon_data_train, samples
             
-            if testloader:
+            self.call_hooks(hooks, 'on_epoch_end', epoch,
+                            {'train_loss': train_loss / len(trainloader),
+                             'time': time.time() - epoch_start,
+                             'times': self.timer.reset()})
+            
+            stop = False
+            if testloader and (monitor is None or monitor.should_evaluate(epoch) \
+                               or epoch == n_epochs):
+                eval_start = time.time()
                 with torch.no_grad():
-                    # Evaluate on test set (L1 log like)
+                    # Evaluate on test set (L1 log like). This is the full
+                    # bound (KL weight 1, learned variance), independent of the
+                    # schedules and beta, such that it is comparable between
+                    # epochs (e.g. for the convergence monitor)
                     self.model.eval()
                     test_loss, test_recon, test_kl = 0, 0, len(kl_terms)*[0]
                     for i, (data, _) in enumerate(testloader):
                         data = data.reshape(-1, *self.input_shape).to(torch.float32).to(self.device)
-                        out = self.model(data, 1, 1)    
+                        with self.autocast():
+                            out = self.model(data, 1, 1)    
                         loss, recon_term, kl_terms = vae_loss(data, *out, 1, 1, 
                                                               self.model.latent_dim, 
-                                                              epoch, warmup, beta,
+                                                              None, None, 1.0,
                                                               self.outputdensity)
                         test_loss += loss.item()
                         test_recon += recon_term.item()
                         test_kl = [l1+l2 for l1,l2 in zip(kl_terms, test_kl)]
+                    test_loss = self.reduce(test_loss)
             
                     writer.add_scalar('test/total_loss', test_loss, iteration)
                     writer.add_scalar('test/recon_loss', recon_term, iteration)
                     for j, kl_loss in enumerate(kl_terms):
                         writer.add_scalar('test/KL_loss' + str(j), kl_loss, iteration)
             
-                    data_test = next(iter(testloader))[0].to(torch.float32).to(self.device)[:n]
-                    data_test = data_test.reshape(-1, *self.input_shape)
-                    recon_data_test = self.model(data_test)[0]
-                    writer.add_image('test/recon', make_grid(torch.cat([data_test, 
-                             recon_data_test]).cpu(), nrow=n), global_step=epoch)
-                    if (epoch==n_epochs):
-                        print('Final test loss', test_loss)
-                    del data, out, loss, recon_term, kl_terms, data_test, recon_data_test
-
-                    # Callback, if a model have something special to log
-                    self.model.callback(writer, testloader, epoch)
-                    
+                    if main_process:
+                        data_test = next(iter(testloader))[0].to(torch.float32).to(self.device)[:n]
+                        data_test = data_test.reshape(-1, *self.input_shape)
+                        recon_data_test = self.model(data_test)[0]
+                        writer.add_image('test/recon', make_grid(torch.cat([data_test, 
+                                 recon_data_test]).cpu(), nrow=n), global_step=epoch)
+                        del data_test, recon_data_test
+                        
+                        # Callback, if a model have something special to log
+                        self.model.callback(writer, testloader, epoch)
+                    del data, out, loss, recon_term, kl_terms
+                
+                self.call_hooks(hooks, 'on_eval', epoch, 
+                                {'test_loss': test_loss, 'time': time.time() - eval_start})
+                
+                # Early stopping, keep track of the best model
+                if monitor is not None:
+                    elbo = test_loss / (len(testloader) * self.world_size)
+                    if monitor.update(epoch, elbo):
+                        best_state = copy.deepcopy(self.model.state_dict())
+                        if main_process:
+                            torch.save(best_state, os.path.join(logdir, 'best_model.pt'))
+                    writer.add_scalar('test/eval_interval', monitor.interval, iteration)
+                    stop = monitor.stop
+                
+                # Restore the best model before the final evaluation
+                last_epoch = stop or (epoch==n_epochs)
+                if last_epoch and best_state is not None:
+                    self.model.load_state_dict(best_state)
+                if last_epoch and main_process:
+                    print('Final test loss', test_loss)
+                
+                with torch.no_grad():
                     # If testset and we are at a eval epoch (or last epoch), 
                     # calculate L5000 (very expensive to do)
-                    if (epoch % eval_epoch == 0) or (epoch==n_epochs):
+                    if (epoch % eval_epoch == 0) or last_epoch:
                         progress_bar = tqdm(desc='Calculating log(p(x))', 
-                                            total=len(testloader.dataset), unit='samples')
+                                            total=len(testloader.dataset), unit='samples',
+                                            disable=not main_process)
                         test_loss, test_recon, test_kl = 0, 0, self.model.latent_spaces*[0]
                         for i, (data, _) in enumerate(testloader):
                             data = data.reshape(-1, *self.input_shape).to(torch.float32).to(self.device)
@@ -186,73 +347,170 @@ class vae_trainer:
                                 out = self.model(d[None], 1, 1000)
                                 loss, _, _ = vae_loss(d, *out, 1, 1000  ,
                                                       self.model.latent_dim, 
-                                                      epoch, warmup, beta,
+                                                      None, None, 1.0,
                                                       self.outputdensity)
                                 test_loss += loss.item()
-                                progress_bar.update()
+                                progress_bar.update(self.world_size)
                         progress_bar.close()
+                        test_loss = self.reduce(test_loss)
                         writer.add_scalar('test/L5000', test_loss, iteration)
+            
+            if stop:
+                if main_process:
+                    print('Stopping early at epoch', epoch, ', best epoch', monitor.best_epoch)
+                break
                         
-        print('Total train time', time.time() - start)
+        if main_process: print('Total train time', time.time() - start)
+        self.call_hooks(hooks, 'on_train_end')
         
-        # Save the embeddings
-        print('Saving embeddings, maybe?')
-        with torch.no_grad():
-            try:
-                self.save_embeddings(writer, trainloader, name='train')
-            except Exception as e:
-                print('Did not save embeddings for training set')
-                print(e)
-            if testloader: 
+        # Save the embeddings (only rank 0)
+        if main_process:
+            print('Saving embeddings, maybe?')
+            with torch.no_grad():
                 try:
-                    self.save_embeddings(writer, testloader, name='test')
+                    self.save_embeddings(writer, trainloader, name='train', logdir=logdir)
                 except Exception as e:
-                    print('Did not save embeddings for test set')
+                    print('Did not save embeddings for training set')
                     print(e)
+                if testloader: 
+                    try:
+                        self.save_embeddings(writer, testloader, name='test', logdir=logdir)
+                    except Exception as e:
+                        print('Did not save embeddings for test set')
+                        print(e)
 
         # Close summary writer
         writer.close()
         
     #%%
-    def save_embeddings(self, writer, loader, name='embedding'):
-        # Constants
-        N = len(loader.dataset)
-        m = self.model.latent_spaces
+    def call_hooks(self, hooks, name, *args):
+        """ Calls method name on all hooks """
+        for h in hooks:
+            getattr(h, name)(self, *args)
+    
+    #%%
+    def reduce(self, value):
+        """ Sum of a python number over all processes """
+        if not self.distributed:
+            return value
+        value = torch.tensor(float(value), dtype=torch.float64)
+        dist.all_reduce(value, op=dist.ReduceOp.SUM)
+        return value.item()
+    
+    #%%
+    def autocast(self):
+        """ Autocast context for the forward pass, depending on the precision """
+        return torch.autocast(device_type=self.device.type, dtype=torch.bfloat16,
+                              enabled=self.precision == 'bf16')
+    
+    #%%
+    def forward_loss(self, data, eq_samples, iw_samples, switch, kl_weight):
+        """ Forward pass and loss, this is the part that gets compiled """
+        with self.autocast():
+            out = self.train_model(data, eq_samples, iw_samples, switch)
+            
+            # For stl and dreg, log q (and for dreg also log p(x|z)) is 
+            # evaluated once more with detached parameters
+            surrogate = None
+            if self.estimator in ['stl', 'dreg']:
+                x_mu, x_var, z, _, _ = out
+                z_mus, z_vars = detached_call(self.model, 'posterior', data, z)
+                out = (x_mu, x_var, z, z_mus, z_vars)
+                if self.estimator == 'dreg':
+                    surrogate = detached_call(self.model, 'likelihood', z, switch)
+        
+        # Calculat loss (always in float32)
+        return vae_loss(data, *out, eq_samples, iw_samples, 
+                        self.model.latent_dim, None, None, 1.0,
+                        self.outputdensity, kl_weight=kl_weight,
+                        estimator=self.estimator, surrogate=surrogate)
+    
+    #%%
+    def train_step(self, data, eq_samples=1, iw_samples=1, switch=1.0, 
+                   epoch=None, warmup=None, beta=1.0, kl_weight=None):
+        """ Runs forward, loss, backward and an optimizer step on a batch.
+            If micro_batch_size is set, the batch is processed in chunks and
+            the gradients are accumulated before the step. The KL terms are
+            weighted by kl_weight, or kl_scaling(epoch, warmup) * beta if it
+            is not given
+        Output:
+            loss, recon_term, kl_terms: detached outputs of vae_loss, for the
+                full batch
+        """
+        # Zero gradient
+        self.optimizer.zero_grad()
+        
+        if kl_weight is None:
+            kl_weight = kl_scaling(epoch, warmup) * beta
+        if self.compiled_forward_loss is not None:
+            # Tensors instead of python floats, such that new values do not 
+            # trigger a recompilation
+            switch = torch.tensor(switch, device=self.device)
+            kl_weight = torch.tensor(kl_weight, device=self.device)
+        
+        chunks = [data] if self.micro_batch_size is None else \
+                 torch.split(data, self.micro_batch_size)
+        loss, recon_term, kl_terms = 0, 0, 0
+        for i, chunk in enumerate(chunks):
+            # Only synchronize gradients between processes on the last chunk
+            skip_sync = self.distributed and i < len(chunks) - 1
+            with self.train_model.no_sync() if skip_sync else contextlib.nullcontext():
+                l, r, kl = self.chunk_step(chunk, eq_samples, iw_samples, 
+                                           switch, kl_weight, chunk.shape[0] / data.shape[0])
+            loss, recon_term = loss + l, recon_term + r
+            kl_terms = kl if i == 0 else [k1+k2 for k1,k2 in zip(kl_terms, kl)]
+        
+        with self.timer('step'):
+            self.optimizer.step()
+        return loss, recon_term, kl_terms
+    
+    #%%
+    def chunk_step(self, data, eq_samples, iw_samples, switch, kl_weight, weight=1.0):
+        """ Forward and backward of a (chunk of a) batch, where the loss is 
+            weighted by the share of the batch the chunk has 
+        Output:
+            loss, recon_term, kl_terms: weighted and detached outputs of vae_loss
+        """
+        # Feed forward data and calculate loss
+        with self.timer('forward'):
+            if self.compiled_forward_loss is not None:
+                try:
+                    loss, recon_term, kl_terms = self.compiled_forward_loss(
+                            data, eq_samples, iw_samples, switch, kl_weight)
+                except self.compile_errors as e:
+                    warnings.warn('torch.compile failed, falling back to eager '
+                                  'mode: ' + repr(e), RuntimeWarning)
+                    self.compiled_forward_loss = None
+            if self.compiled_forward_loss is None:
+                loss, recon_term, kl_terms = self.forward_loss(data, eq_samples, iw_samples,
+                                                               switch, kl_weight)
         
-        # Data structures for holding the embeddings
-        all_data = torch.zeros(N, *self.input_shape, dtype=torch.float32)
-        all_label = torch.zeros(N, dtype=torch.int32)
-        all_latent = [ ]
-        for j in range(m):
-            all_latent.append(torch.zeros(N, self.model.latent_dim, dtype=torch.float32))
+        # Backpropegate, we need to maximize the bound, so in this case we 
+        # need to minimize the negative bound
+        with self.timer('backward'):
+            (-weight*loss).backward()
+        return weight*loss.detach(), weight*recon_term.detach(), \
+               [weight*kl.detach() for kl in kl_terms]
         
-        # Loop over all data and get embeddings
-        counter = 0
+    #%%
+    def save_embeddings(self, writer, loader, name='embedding', logdir='',
+                        max_sprites=1000, sprite_size=28):
+        """ Embeds all data in the loader into the learned latent spaces. The
+            embeddings are streamed to memory-mapped files in logdir and a
+            subset of max_sprites points are send to the tensorboard projector
+        """
+        exporter = embedding_exporter(logdir, name, len(loader.dataset),
+                                      self.model.latent_spaces*[self.model.latent_dim],
+                                      max_sprites=max_sprites,
+                                      sprite_size=sprite_size)
+        
+        # Loop over all data (not only the shard of this process) and get embeddings
+        if isinstance(loader.sampler, torch.utils.data.DistributedSampler):
+            loader = torch.utils.data.DataLoader(loader.dataset, batch_size=loader.batch_size)
         for i, (data, label) in enumerate(loader):
-            n = data.shape[0]
             data = data.reshape(-1, *self.input_shape).to(torch.float32).to(self.device)
-            label = label.to(self.device)
             z = self.model.latent_representation(data)
-            all_data[counter:counter+n] = data.cpu()
-            for j in range(m):
-                all_latent[j][counter:counter+n] = z[j].cpu()
-            all_label[counter:counter+n] = label.cpu()
-            counter += n
+            exporter.add(z, label, data)
             
         # Save the embeddings
-        for j in range(m):
-            
-            # Embeddings with dim < 3 needs to be appended extra non-informative dimensions
-            N, n = all_latent[j].shape
-            if n == 1:
-                all_latent[j] = torch.cat([all_latent[j], torch.zeros(N, 2)], dim = 1)
-            if n == 2:
-                all_latent[j] = torch.cat([all_latent[j], torch.zeros(N, 1)], dim = 1)
-            
-            # Maximum bound for the sprite image
-            writer.add_embedding(mat = all_latent[j],
-                                 metadata = all_label,
-                                 label_img = all_data,
-                                 tag = name + '_latent_space' + str(j))
-        
-        
+        exporter.write(writer)